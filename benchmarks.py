@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+"""Benchmarks of check_python_syntax
+
+Synthetic trees are generated in temp directory, then each stage of checking is timed on its own
+(directory walk, interpreter discovery, subprocess startup, compilation at each level, JSON serialization),
+and whole checks are timed in serial, parallel, fail-fast and cached modes.
+Startup of command line tool is timed on a single file, with imports measured by -X importtime (Python 3.7+).
+
+Usage:
+    python benchmarks.py [--scale 0.1] [--output results.json]
+    python benchmarks.py --save-baseline baseline.json
+    python benchmarks.py --baseline baseline.json [--tolerance 0.25]
+
+With --baseline, exit code is 1 if any benchmark is slower than in baseline by more than tolerance.
+Exit code is also 1 if imports of single file check take longer than STARTUP_IMPORT_BUDGET.
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import check_python_syntax
+
+
+def _write(file_name, content):
+    directory = os.path.dirname(file_name)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(file_name, 'w') as file:
+        file.write(content)
+
+
+def _module(index, lines=2, valid=True):
+    """Return source of synthetic module with given number of functions."""
+    functions = ''.join('def f%d(x):\n    return x * %d + %d\n\n' % (i, index, i) for i in range(max(1, lines // 3)))
+    return functions if valid else functions + 'def broken(x:\n    return x\n'
+
+
+def generate_tree(root_dir, files_count, files_per_dir=100):
+    """Create tree of small python files, every 10th file is invalid. Return list of file names."""
+    file_names = []
+    for i in range(files_count):
+        file_name = os.path.join(root_dir, 'package_%d' % (i // files_per_dir),
+                                 'module_with_reasonably_long_name_%d.py' % i)
+        _write(file_name, 'def f(x):\n    return x * %d\n' % i if i % 10 else 'def f(x:\n    return x * %d\n' % i)
+        file_names.append(file_name)
+    return file_names
+
+
+# Synthetic trees: {name: function(root_dir, scale)}
+def _small_files(root_dir, scale):
+    """Many small valid files"""
+    for i in range(int(5000 * scale)):
+        _write(os.path.join(root_dir, 'package_%d' % (i // 100), 'module_%d.py' % i), _module(i))
+
+
+def _huge_files(root_dir, scale):
+    """A few huge files"""
+    for i in range(4):
+        _write(os.path.join(root_dir, 'generated_%d.py' % i), _module(i, lines=int(150000 * scale)))
+
+
+def _deep_nesting(root_dir, scale):
+    """Deep directory nesting with a few files on every level, and ignored directories"""
+    for branch in range(max(1, int(20 * scale))):
+        directory = os.path.join(root_dir, 'branch_%d' % branch)
+        for level in range(40):
+            directory = os.path.join(directory, 'level_%d' % level)
+            _write(os.path.join(directory, 'module.py'), _module(level))
+            _write(os.path.join(directory, 'data.txt'), 'not python')
+        for i in range(50):
+            _write(os.path.join(root_dir, 'branch_%d' % branch, 'node_modules', 'lib_%d' % i, 'index.py'), _module(i))
+
+
+def _mixed(root_dir, scale):
+    """Mix of valid and invalid files"""
+    for i in range(int(3000 * scale)):
+        _write(os.path.join(root_dir, 'package_%d' % (i // 100), 'module_%d.py' % i), _module(i, lines=30, valid=i % 3 != 0))
+
+
+TREES = [
+    ('small_files', _small_files),
+    ('huge_files', _huge_files),
+    ('deep_nesting', _deep_nesting),
+    ('mixed', _mixed),
+]
+
+
+def _timed(function, repeat):
+    """Return minimal wall time of function over repeat runs, and result of the last run."""
+    best = None
+    result = None
+    for i in range(repeat):
+        started = time.time()
+        result = function()
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def benchmark_tree(root_dir, cache_dir, repeat=3):
+    """Time stages and modes of checking of given tree. Return {benchmark_name: seconds}."""
+    results = {}
+    results['walk'], (not_found, all_files) = _timed(lambda: check_python_syntax._collect_files([root_dir]), repeat)
+    results['compile'], compiled = _timed(lambda: check_python_syntax._compile_files(all_files), repeat)
+    for level in check_python_syntax.LEVELS:
+        engine = check_python_syntax.ENGINE_LEVELS.get(level, 'memory')
+        results['level_' + level], _ = _timed(lambda: check_python_syntax._compile_files(all_files, engine=engine), repeat)
+    # Compilation plus parsing with grammar of older version
+    feature_version = check_python_syntax._emulated_feature_version('3.7')
+    if feature_version is not None:
+        results['level_emulated'], _ = _timed(
+            lambda: check_python_syntax._compile_files(all_files, feature_version=feature_version), repeat)
+    results['json_serialization'], output = _timed(lambda: json.dumps(compiled), repeat)
+    results['json_parsing'], _ = _timed(lambda: json.loads(output), repeat)
+    results['serial'], _ = _timed(lambda: check_python_syntax.check_python_syntax([root_dir]), repeat)
+    results['parallel'], _ = _timed(lambda: check_python_syntax.check_python_syntax([root_dir], jobs=0), repeat)
+    # Trees without errors are checked completely, but files are compiled while they are found
+    results['fail_fast'], _ = _timed(lambda: check_python_syntax.check_python_syntax([root_dir], max_errors=1), repeat)
+    # Fill cache, then time warm runs
+    check_python_syntax.check_python_syntax([root_dir], cache_dir=cache_dir)
+    results['cached'], _ = _timed(lambda: check_python_syntax.check_python_syntax([root_dir], cache_dir=cache_dir), repeat)
+    results['child_interpreter'], _ = _timed(lambda: check_python_syntax._check_in_child(sys.executable, [root_dir]),
+                                             repeat)
+    return results
+
+
+def benchmark_process(repeat=3):
+    """Time stages which don't depend on tree. Return {benchmark_name: seconds}."""
+    results = {}
+    results['interpreter_discovery'], _ = _timed(
+        lambda: check_python_syntax.InterpreterRegistry().interpreters(), repeat)
+    results['subprocess_startup'], _ = _timed(lambda: check_python_syntax._check_in_child(sys.executable, []), repeat)
+    return results
+
+
+# Budget of imports made by command line tool to check a single file, in seconds (see benchmark_startup)
+STARTUP_IMPORT_BUDGET = 0.035
+
+
+def _import_times(arguments, cwd=None):
+    """Run python -X importtime with given arguments. Return {module: cumulative seconds} of top-level imports."""
+    env = dict(os.environ)
+    # Bytecode cache is used, as in installed package
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    process = subprocess.Popen([sys.executable, '-X', 'importtime'] + arguments, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, cwd=cwd, env=env)
+    error_output = process.communicate()[1].decode('utf-8', 'replace')
+    times = {}
+    for line in error_output.splitlines():
+        fields = line.split('|')
+        # Nested imports are indented by two more spaces
+        if line.startswith('import time:') and len(fields) == 3 and fields[2][:2] != '  ' and fields[1].strip().isdigit():
+            times[fields[2].strip()] = int(fields[1]) / 1e6
+    return times
+
+
+def benchmark_startup(repeat=3):
+    """Time command line check of a single file in new process, as editors and git hooks run it.
+
+    Returns {benchmark_name: seconds}:
+        single_file: wall time of the whole process
+        imports: time of imports made by the tool (-X importtime), without imports of bare interpreter
+    """
+    results = {}
+    temp_dir = tempfile.mkdtemp(prefix='check-python-syntax-benchmark-')
+    try:
+        file_name = os.path.join(temp_dir, 'module.py')
+        _write(file_name, _module(0))
+        # Installed entry point imports module, like another interpreter does
+        arguments = check_python_syntax._module_command(sys.executable, ['--cache-dir', os.path.join(temp_dir, 'cache'),
+                                                                         file_name])
+        env = dict(os.environ)
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        # Warm up bytecode cache
+        subprocess.call(arguments, stdout=subprocess.PIPE, env=env)
+        results['single_file'], _ = _timed(lambda: subprocess.call(arguments, stdout=subprocess.PIPE, env=env), repeat)
+        if sys.version_info[:2] >= (3, 7):
+            interpreter_modules = set(_import_times(['-c', 'pass']))
+            results['imports'] = min(sum(seconds for name, seconds in _import_times(arguments[1:]).items()
+                                         if name not in interpreter_modules) for i in range(repeat))
+    finally:
+        shutil.rmtree(temp_dir)
+    return results
+
+
+def benchmark_child_interpreter(files_count, timeout=600):
+    """Check big tree through child interpreter (regression test for pipe deadlock).
+
+    Returns elapsed time in seconds.
+    """
+    root_dir = tempfile.mkdtemp(prefix='check-python-syntax-benchmark-')
+    try:
+        generate_tree(root_dir, files_count)
+        started = time.time()
+        result = check_python_syntax._check_in_child(sys.executable, [root_dir], timeout=timeout)
+        elapsed = time.time() - started
+        if len(result) != files_count:
+            raise AssertionError('Expected %d results, got %r' % (files_count, result.get('<exception>', len(result))))
+        return elapsed
+    finally:
+        shutil.rmtree(root_dir)
+
+
+def run_benchmarks(scale=1.0, repeat=3, trees=None):
+    """Run all benchmarks. Return {benchmark_name: seconds}, e.g. {'small_files/walk': 0.05, ...}"""
+    results = {}
+    for name, seconds in benchmark_process(repeat).items():
+        results['process/' + name] = seconds
+    for name, seconds in benchmark_startup(repeat).items():
+        results['startup/' + name] = seconds
+    for tree_name, generate in TREES:
+        if trees and tree_name not in trees:
+            continue
+        temp_dir = tempfile.mkdtemp(prefix='check-python-syntax-benchmark-')
+        try:
+            root_dir = os.path.join(temp_dir, 'tree')
+            generate(root_dir, scale)
+            for name, seconds in benchmark_tree(root_dir, os.path.join(temp_dir, 'cache'), repeat).items():
+                results['%s/%s' % (tree_name, name)] = seconds
+        finally:
+            shutil.rmtree(temp_dir)
+    results['child_interpreter_10k_files'] = benchmark_child_interpreter(max(1, int(10000 * scale)))
+    return results
+
+
+def compare_with_baseline(results, baseline, tolerance=0.25, min_difference=0.005):
+    """Return list of (benchmark_name, baseline_seconds, seconds) for benchmarks slower than baseline.
+
+    Benchmark is slower if it takes more than (1 + tolerance) times baseline, and at least min_difference seconds more
+    (very short timings are too noisy).
+    """
+    regressions = []
+    for name in sorted(results):
+        if name in baseline:
+            if results[name] > baseline[name] * (1 + tolerance) and results[name] - baseline[name] > min_difference:
+                regressions.append((name, baseline[name], results[name]))
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+    arguments_parser = argparse.ArgumentParser(description='Benchmark check_python_syntax')
+    arguments_parser.add_argument('--scale', type=float, default=1.0, help='size of generated trees (default: 1.0)')
+    arguments_parser.add_argument('--repeat', type=int, default=3, help='number of runs, minimal time is taken')
+    arguments_parser.add_argument('--tree', action='append', dest='trees', choices=[x[0] for x in TREES],
+                                  help='run benchmarks only for given tree (can be repeated)')
+    arguments_parser.add_argument('--output', help='write results to JSON file')
+    arguments_parser.add_argument('--save-baseline', dest='save_baseline', metavar='FILE', help='save results as baseline')
+    arguments_parser.add_argument('--baseline', metavar='FILE', help='compare results with baseline')
+    arguments_parser.add_argument('--tolerance', type=float, default=0.25,
+                                  help='allowed slowdown relative to baseline (default: 0.25)')
+    arguments = arguments_parser.parse_args(sys.argv[1:])
+
+    results = run_benchmarks(scale=arguments.scale, repeat=arguments.repeat, trees=arguments.trees)
+    for name in sorted(results):
+        print('%-45s %9.4f s' % (name, results[name]))
+    document = {
+        'python': '%d.%d.%d' % sys.version_info[:3],
+        'version': check_python_syntax.__version__,
+        'scale': arguments.scale,
+        'results': results,
+    }
+    for file_name in (arguments.output, arguments.save_baseline):
+        if file_name:
+            with open(file_name, 'w') as file:
+                json.dump(document, file, sort_keys=True, indent=4, separators=(',', ': '))
+    over_budget = results.get('startup/imports', 0) > STARTUP_IMPORT_BUDGET
+    if over_budget:
+        print('OVER BUDGET startup/imports: %.4f s > %.4f s' % (results['startup/imports'], STARTUP_IMPORT_BUDGET))
+    if arguments.baseline:
+        with open(arguments.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get('scale') != arguments.scale:
+            print('Warning: baseline scale is %s, current scale is %s' % (baseline.get('scale'), arguments.scale))
+        regressions = compare_with_baseline(results, baseline['results'], tolerance=arguments.tolerance)
+        for name, baseline_seconds, seconds in regressions:
+            print('REGRESSION %s: %.4f s -> %.4f s (%+.0f%%)' % (name, baseline_seconds, seconds,
+                                                                 (seconds / baseline_seconds - 1) * 100))
+        sys.exit(int(bool(regressions) or over_budget))
+    sys.exit(int(over_budget))
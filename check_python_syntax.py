@@ -1,204 +1,3459 @@
 #!/usr/bin/env python
 """Check if code can be compiled in particular version of Python (e.g. 2.6 or 3.3)"""
 
-__version__ = "0.0.1"
+__version__ = "0.1.0"
 
 import json
 import os
-import subprocess
+import re
 import sys
-import tempfile
-import traceback
+import time
+
+
+class _LazyModule(object):
+    """Module which is imported on first access to its attributes.
+
+    Command line tool is often run for a single file (e.g. by editors and git hooks), so its startup time matters,
+    and modules which are needed only by some paths (another interpreter, error messages...) are imported lazily.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = __import__(self._name)
+        return getattr(self._module, attribute)
+
+
+heapq = _LazyModule('heapq')
+py_compile = _LazyModule('py_compile')
+subprocess = _LazyModule('subprocess')
+queue = _LazyModule('queue' if sys.version_info[0] >= 3 else 'Queue')
+tempfile = _LazyModule('tempfile')
+threading = _LazyModule('threading')
+traceback = _LazyModule('traceback')
+
+# Same as threading.Lock, for objects created at import time
+if sys.version_info[0] == 2:
+    from thread import allocate_lock
+else:
+    from _thread import allocate_lock
 
 
 def format_exception(ex):
     return ''.join(traceback.format_exception(*sys.exc_info()))
 
 
-# Some `six`-like helpers
-if sys.version_info[0] == 2:
-    def itervalues(d):
-        return d.itervalues()
-else:
-    def itervalues(d):
-        return d.values()
+# Some `six`-like helpers
+if sys.version_info[0] == 2:
+    def itervalues(d):
+        return d.itervalues()
+else:
+    def itervalues(d):
+        return d.values()
+
+
+def _check_all_files(files_or_directories, engine='memory', jobs=1, cache_dir=None, walk_options=None, stats=None,
+                     max_compile_size=None, errors_only=False, max_errors=None, feature_version=None):
+    """Check given files or directories recursively.
+
+    engine: name of compile engine from COMPILE_ENGINES
+    jobs: number of worker processes, 0 means number of CPUs
+    cache_dir: directory of persistent ResultCache, None to disable caching
+    walk_options: dict of keyword arguments for _collect_files
+    stats: _Stats to collect timing and counters, None to disable
+    max_compile_size: files larger than that many bytes are only tokenized (see _tokenize_source), None means no limit
+    errors_only: return only invalid files and '<summary>' item (see _collect_results)
+    max_errors: stop after that many invalid files (see _iter_check_files_lazily), None means check all files
+    feature_version: minor version of Python 3 to check grammar of (see _emulated_feature_version)
+
+    Return dictionary {file_name: [is_valid, message(, details)]} for all individual files.
+    """
+    return _collect_results(_iter_check_all_files(files_or_directories, engine=engine, jobs=jobs, cache_dir=cache_dir,
+                                                  walk_options=walk_options, stats=stats,
+                                                  max_compile_size=max_compile_size, max_errors=max_errors,
+                                                  feature_version=feature_version), errors_only)
+
+
+def _iter_check_all_files(files_or_directories, engine='memory', jobs=1, cache_dir=None, walk_options=None,
+                          stats=None, max_compile_size=None, max_errors=None, feature_version=None):
+    """Same as _check_all_files, but yield (file_name, [is_valid, message]) as soon as each file is compiled."""
+    if max_errors is not None:
+        return _limit_errors(_iter_check_files_lazily(files_or_directories, engine=engine, jobs=jobs,
+                                                      cache_dir=cache_dir, walk_options=walk_options, stats=stats,
+                                                      max_compile_size=max_compile_size,
+                                                      feature_version=feature_version), max_errors)
+    return _iter_check_sorted_files(files_or_directories, engine=engine, jobs=jobs, cache_dir=cache_dir,
+                                    walk_options=walk_options, stats=stats, max_compile_size=max_compile_size,
+                                    feature_version=feature_version)
+
+
+def _iter_check_sorted_files(files_or_directories, engine='memory', jobs=1, cache_dir=None, walk_options=None,
+                             stats=None, max_compile_size=None, feature_version=None):
+    """Collect all files, then compile them in sorted order, yield (file_name, [is_valid, message])."""
+    started = _Stats.start()
+    not_found, all_files = _collect_files(files_or_directories, **(walk_options or {}))
+    if stats is not None:
+        stats.stop('walk', started)
+    for target in files_or_directories:
+        if target in not_found:
+            yield target, not_found[target]
+    for item in _iter_compile_files(all_files, engine=engine, jobs=jobs, cache_dir=cache_dir, stats=stats,
+                                    max_compile_size=max_compile_size, feature_version=feature_version):
+        yield item
+
+
+def _iter_check_files_lazily(files_or_directories, engine='memory', jobs=1, cache_dir=None, walk_options=None,
+                             stats=None, max_compile_size=None, feature_version=None):
+    """Same as _iter_check_sorted_files, but files are compiled as soon as they are found, in walk order.
+
+    Nothing is collected in advance, so if generator is closed early, the walk stops
+    and outstanding work is cancelled. Walk time is included in 'compile' stage of stats.
+    """
+    walk_options = walk_options or {}
+    not_found = _missing_targets(files_or_directories, walk_options.get('changed_since'), walk_options.get('staged'))
+    for target in files_or_directories:
+        if target in not_found:
+            yield target, not_found[target]
+    file_names = _find_target_files(files_or_directories, **walk_options)
+    if jobs == 0:
+        jobs = _cpu_count()
+    if jobs > 1:
+        chunk_arguments = ((chunk, engine, cache_dir, stats is not None, max_compile_size, feature_version)
+                           for chunk in _iter_chunks(file_names, LAZY_CHUNK_SIZE))
+        items = _iter_chunks_in_pool(_compile_files_chunk, chunk_arguments, jobs, stats)
+    else:
+        items = _iter_compile_files_chunk(file_names, engine, cache_dir, stats, max_compile_size, feature_version)
+    try:
+        for item in items:
+            yield item
+    finally:
+        items.close()
+
+
+def _limit_errors(items, max_errors):
+    """Yield items (file_name, [is_valid, message]) until max_errors invalid items are yielded.
+
+    Then items generator is closed, which cancels its outstanding work.
+    """
+    errors = 0
+    try:
+        for file_name, result in items:
+            yield file_name, result
+            if not result[0]:
+                errors += 1
+                if errors >= max_errors:
+                    break
+    finally:
+        items.close()
+
+
+def _collect_results(items, errors_only=False):
+    """Return {file_name: [is_valid, message]} for iterable of (file_name, [is_valid, message]).
+
+    If errors_only is True, valid files are only counted, see _ResultSummary.
+    """
+    if not errors_only:
+        return dict(items)
+    summary = _ResultSummary()
+    for file_name, result in items:
+        summary.add(file_name, result)
+    return summary.to_dict()
+
+
+class _ResultSummary(object):
+    """Compact store of results: number of files, but messages of invalid files only.
+
+    Memory usage is proportional to number of errors, not to number of files.
+    Every directory of invalid files is stored once.
+    """
+
+    __slots__ = ('files', 'invalid', 'directories', 'errors')
+
+    def __init__(self):
+        self.files = 0
+        self.invalid = 0
+        # {directory: the same directory}, to keep one copy of each directory string
+        self.directories = {}
+        # [(directory with trailing separator, file name, result)]
+        self.errors = []
+
+    def add(self, file_name, result):
+        self.count(file_name, result)
+        if result[0]:
+            return
+        index = max(file_name.rfind('/'), file_name.rfind(os.sep)) + 1
+        directory = self.directories.setdefault(file_name[:index], file_name[:index])
+        self.errors.append((directory, file_name[index:], result))
+
+    def count(self, file_name, result):
+        """Count result without storing it."""
+        # Unexpected errors are reported, but not counted as files
+        if file_name == '<exception>':
+            return
+        self.files += 1
+        if not result[0]:
+            self.invalid += 1
+
+    def summary(self):
+        """Return {'files': number of files, 'valid': ..., 'invalid': ...}"""
+        return {'files': self.files, 'valid': self.files - self.invalid, 'invalid': self.invalid}
+
+    def to_dict(self):
+        """Return {file_name: [False, message(, details)]} for invalid files and '<summary>': [True, summary()]"""
+        result = dict((directory + name, file_result) for directory, name, file_result in self.errors)
+        result['<summary>'] = [True, self.summary()]
+        return result
+
+
+def _collect_files(files_or_directories, include=None, exclude=None, gitignore=False, changed_since=None, staged=False):
+    """Find all python files in given files or directories recursively.
+
+    Individual files are always included, include/exclude/gitignore only apply to files in directories.
+    If changed_since or staged is given, only files changed in git are included (see _git_changed_files),
+    directories are not walked at all.
+
+    Return tuple ({target: [False, 'Target not found']}, sorted list of unique file names)
+    """
+    return (_missing_targets(files_or_directories, changed_since, staged),
+            sorted(_find_target_files(files_or_directories, include=include, exclude=exclude, gitignore=gitignore,
+                                      changed_since=changed_since, staged=staged)))
+
+
+def _missing_targets(files_or_directories, changed_since=None, staged=False):
+    """Return {target: [False, 'Target not found']} for targets which are skipped by _find_target_files."""
+    git_mode = changed_since is not None or staged
+    return dict((x, [False, 'Target not found']) for x in files_or_directories
+                if not (git_mode and os.path.exists(x)) and not os.path.isdir(x) and not os.path.isfile(x))
+
+
+def _find_target_files(files_or_directories, include=None, exclude=None, gitignore=False, changed_since=None,
+                       staged=False):
+    """Find python files in given files or directories recursively (see _collect_files), yield each file once.
+
+    Files are yielded in walk order as soon as they are found, targets which are not found are skipped.
+    """
+    seen = set()
+    git_mode = changed_since is not None or staged
+    # {target: repository root}, {repository root: paths of targets relative to it}
+    roots, root_paths = {}, {}
+    if git_mode:
+        for target in files_or_directories:
+            if os.path.exists(target):
+                directory = target if os.path.isdir(target) else os.path.dirname(target)
+                root = roots[target] = _git(['rev-parse', '--show-toplevel'], cwd=directory or None)[0].strip()
+                relative_path = os.path.relpath(os.path.realpath(target), os.path.realpath(root))
+                root_paths.setdefault(root, []).append(relative_path)
+    # {repository root: changed files}, each repository is asked once about all targets in it
+    changed_files = {}
+    for file_or_directory in files_or_directories:
+        if file_or_directory in roots:
+            root = roots[file_or_directory]
+            if root not in changed_files:
+                changed_files[root] = _git_changed_files(root, changed_since=changed_since, staged=staged,
+                                                         paths=root_paths[root])
+            file_names = _filter_changed_files(changed_files[root], file_or_directory, include=include, exclude=exclude)
+        elif os.path.isdir(file_or_directory):
+            file_names = _find_all_files(file_or_directory, include=include, exclude=exclude, gitignore=gitignore)
+        elif os.path.isfile(file_or_directory):
+            file_names = [os.path.abspath(file_or_directory)]
+        else:
+            continue
+        for file_name in file_names:
+            if file_name not in seen:
+                seen.add(file_name)
+                yield file_name
+
+
+def _compile_files(all_files, engine='memory', jobs=1, cache_dir=None, stats=None, max_compile_size=None,
+                   errors_only=False, max_errors=None, feature_version=None):
+    """Try to compile all files in current interpreter and return {file_name: [is_valid, message]}"""
+    return _collect_results(_iter_compile_files(all_files, engine=engine, jobs=jobs, cache_dir=cache_dir, stats=stats,
+                                                max_compile_size=max_compile_size, max_errors=max_errors,
+                                                feature_version=feature_version), errors_only)
+
+
+# Maximum number of files sent to worker process at once, smaller chunks make results stream more smoothly
+MAX_CHUNK_SIZE = 256
+# Number of files sent to worker process at once when files are compiled as soon as they are found
+LAZY_CHUNK_SIZE = 16
+
+
+def _iter_compile_files(all_files, engine='memory', jobs=1, cache_dir=None, stats=None, max_compile_size=None,
+                        max_errors=None, feature_version=None):
+    """Try to compile all files in current interpreter, yield (file_name, [is_valid, message]) in order of all_files.
+
+    stats: _Stats to collect timing and counters (including those of parallel processes), None to disable
+    max_errors: stop after that many invalid files, None means compile all files
+    """
+    items = _iter_compile_all_files(all_files, engine=engine, jobs=jobs, cache_dir=cache_dir, stats=stats,
+                                    max_compile_size=max_compile_size, feature_version=feature_version)
+    return items if max_errors is None else _limit_errors(items, max_errors)
+
+
+def _iter_compile_all_files(all_files, engine='memory', jobs=1, cache_dir=None, stats=None, max_compile_size=None,
+                            feature_version=None):
+    """Same as _iter_compile_files, without limit of errors."""
+    if jobs == 0:
+        jobs = _cpu_count()
+    if jobs > 1 and len(all_files) > 1:
+        chunks = _split_into_chunks(all_files, max(jobs * 4, len(all_files) // MAX_CHUNK_SIZE))
+        chunk_arguments = [(chunk, engine, cache_dir, stats is not None, max_compile_size, feature_version)
+                           for chunk in chunks]
+        for item in _iter_chunks_in_pool(_compile_files_chunk, chunk_arguments, jobs, stats):
+            yield item
+    else:
+        for item in _iter_compile_files_chunk(all_files, engine, cache_dir, stats, max_compile_size, feature_version):
+            yield item
+
+
+# Number of chunks per process submitted to pool ahead of results
+CHUNKS_AHEAD = 2
+
+
+def _iter_chunks_in_pool(chunk_function, chunk_arguments, jobs, stats=None):
+    """Run chunk_function for each of chunk_arguments in pool of processes, yield items of all chunks in order.
+
+    chunk_function must return tuple (list of items, stats dict or None).
+    chunk_arguments may be a generator, then it's consumed while chunks are compiled, at most CHUNKS_AHEAD * jobs
+    chunks ahead of results, so that it stops soon when this generator is closed early.
+    """
+    import collections
+    import itertools
+    import multiprocessing
+    pool = multiprocessing.Pool(min(jobs, len(chunk_arguments)) if isinstance(chunk_arguments, list) else jobs)
+    try:
+        chunk_arguments = iter(chunk_arguments)
+        # Chunks are contiguous and their results are taken in order of submission,
+        # so results are yielded in the same order as in serial mode
+        pending = collections.deque(pool.apply_async(chunk_function, (arguments,))
+                                    for arguments in itertools.islice(chunk_arguments, CHUNKS_AHEAD * jobs))
+        while pending:
+            chunk_result, chunk_stats = pending.popleft().get()
+            for arguments in itertools.islice(chunk_arguments, 1):
+                pending.append(pool.apply_async(chunk_function, (arguments,)))
+            if chunk_stats is not None:
+                stats.merge(chunk_stats)
+            for item in chunk_result:
+                yield item
+    finally:
+        # Also cancels outstanding chunks if generator is closed early
+        pool.terminate()
+        pool.join()
+
+
+def _compile_files_chunk(arguments):
+    """Compile list of files, return tuple (list of (file_name, [is_valid, message]), stats dict or None).
+
+    Takes single tuple (file_names, engine, cache_dir, collect_stats, max_compile_size, feature_version)
+    to be usable with _iter_chunks_in_pool
+    """
+    file_names, engine, cache_dir, collect_stats, max_compile_size, feature_version = arguments
+    stats = _Stats() if collect_stats else None
+    items = list(_iter_compile_files_chunk(file_names, engine, cache_dir, stats, max_compile_size, feature_version))
+    return items, stats.to_dict() if stats is not None else None
+
+
+def _iter_compile_files_chunk(file_names, engine, cache_dir, stats=None, max_compile_size=None, feature_version=None):
+    """Compile list of files, yield (file_name, [is_valid, message])."""
+    compile_file = COMPILE_ENGINES[engine]
+    cache = (ResultCache.open(cache_dir, engine, max_compile_size=max_compile_size, feature_version=feature_version)
+             if cache_dir else None)
+    try:
+        for file_name in file_names:
+            started = _Stats.start() if stats is not None else None
+            if cache is None:
+                file_result = compile_file(file_name, max_compile_size=max_compile_size, feature_version=feature_version)
+            else:
+                file_result, source = cache.get(file_name)
+                if file_result is None:
+                    try:
+                        file_result = compile_file(file_name, source, max_compile_size=max_compile_size,
+                                                   feature_version=feature_version)
+                    finally:
+                        _close_source(source)
+                    cache.put(file_name, file_result)
+            if stats is not None:
+                stats.add_file(file_name, started)
+            yield file_name, file_result
+    finally:
+        if cache is not None:
+            if stats is not None:
+                stats.cache_hits += cache.hits
+                stats.cache_misses += cache.misses
+            cache.close()
+
+
+def _compile_sources(sources, jobs=1, stats=None, max_compile_size=None, errors_only=False, max_errors=None,
+                     engine='memory', feature_version=None):
+    """Compile list of (name, source bytes) in memory and return {name: [is_valid, message]}"""
+    return _collect_results(_iter_compile_sources(sources, jobs=jobs, stats=stats, max_compile_size=max_compile_size,
+                                                  max_errors=max_errors, engine=engine,
+                                                  feature_version=feature_version), errors_only)
+
+
+def _iter_compile_sources(sources, jobs=1, stats=None, max_compile_size=None, max_errors=None, engine='memory',
+                          feature_version=None):
+    """Compile list of (name, source bytes) in memory, yield (name, [is_valid, message]) in order of sources.
+
+    max_errors: stop after that many invalid sources, None means compile all sources
+    engine: only level of engine matters (see ENGINE_LEVELS), sources are always checked in memory
+    feature_version: see _compile_source
+    """
+    items = _iter_compile_all_sources(sources, jobs=jobs, stats=stats, max_compile_size=max_compile_size,
+                                      engine=engine, feature_version=feature_version)
+    return items if max_errors is None else _limit_errors(items, max_errors)
+
+
+def _iter_compile_all_sources(sources, jobs=1, stats=None, max_compile_size=None, engine='memory',
+                              feature_version=None):
+    """Same as _iter_compile_sources, without limit of errors."""
+    if jobs == 0:
+        jobs = _cpu_count()
+    if jobs > 1 and len(sources) > 1:
+        chunks = _split_into_chunks(sources, max(jobs * 4, len(sources) // MAX_CHUNK_SIZE))
+        chunk_arguments = [(chunk, stats is not None, max_compile_size, engine, feature_version) for chunk in chunks]
+        for item in _iter_chunks_in_pool(_compile_sources_chunk, chunk_arguments, jobs, stats):
+            yield item
+    else:
+        level = ENGINE_LEVELS.get(engine, 'compile')
+        for name, source in sources:
+            started = _Stats.start() if stats is not None else None
+            if max_compile_size is not None and len(source) > max_compile_size:
+                result = _tokenize_source(source, name)
+            else:
+                result = _compile_source(source, name, level, feature_version)
+            if stats is not None:
+                stats.add_file(name, started, size=len(source))
+            yield name, result
+
+
+def _compile_sources_chunk(arguments):
+    """Compile list of sources, return tuple (list of (name, [is_valid, message]), stats dict or None).
+
+    Takes single tuple (sources, collect_stats, max_compile_size, engine, feature_version)
+    to be usable with _iter_chunks_in_pool
+    """
+    sources, collect_stats, max_compile_size, engine, feature_version = arguments
+    stats = _Stats() if collect_stats else None
+    items = list(_iter_compile_all_sources(sources, stats=stats, max_compile_size=max_compile_size, engine=engine,
+                                           feature_version=feature_version))
+    return items, stats.to_dict() if stats is not None else None
+
+
+def _encode_sources(sources):
+    """Return sources in JSON-serializable form: [[name, base64-encoded source], ...]
+
+    Text sources are encoded to UTF-8.
+    """
+    import base64
+    return [[name, base64.b64encode(source).decode('ascii')] for name, source in _normalize_sources(sources)]
+
+
+def _decode_sources(encoded_sources):
+    """Return list of (name, source bytes) from result of _encode_sources()"""
+    import base64
+    return [(name, base64.b64decode(source.encode('ascii'))) for name, source in encoded_sources]
+
+
+def _normalize_sources(sources):
+    """Return list of (name, source bytes), text sources are encoded to UTF-8."""
+    return [(name, source if isinstance(source, bytes) else source.encode('utf-8')) for name, source in sources]
+
+
+def _iter_chunks(items, chunk_size):
+    """Yield lists of chunk_size consecutive items of iterable (the last one may be shorter)."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _split_into_chunks(items, max_chunks):
+    """Split list into at most max_chunks contiguous chunks of nearly equal size."""
+    chunk_size = max(1, -(-len(items) // max_chunks))
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+
+def _cpu_count():
+    """Return number of CPUs, 1 if unknown."""
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+def _compile_source(source, file_name, level='compile', feature_version=None):
+    """Compile source code in memory and return [is_valid, message] or [False, message, details].
+
+    level: 'compile' (generate bytecode), 'parse' (only build AST) or 'tokenize' (see _tokenize_source)
+    feature_version: minor version of Python 3 whose grammar is checked by parser of current interpreter
+        (see _emulated_feature_version), in addition to compilation if level is 'compile'
+
+    Messages are formatted exactly like py_compile.PyCompileError.msg, details are described in _error_details
+    """
+    if level == 'tokenize':
+        return _tokenize_source(source, file_name)
+    if sys.version_info[0] == 2:
+        # py_compile reads sources in universal newlines mode
+        source = source.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+    try:
+        if level == 'compile':
+            compile(source, file_name, 'exec', 0, True)
+        if level == 'parse' or feature_version is not None:
+            from _ast import PyCF_ONLY_AST
+            # Parser checks feature_version only when AST is requested
+            kwargs = {'_feature_version': feature_version} if feature_version is not None else {}
+            compile(source, file_name, 'exec', PyCF_ONLY_AST, True, **kwargs)
+    except Exception as ex:
+        if ex.__class__ is SyntaxError:
+            return [False, ''.join(traceback.format_exception_only(SyntaxError, ex)), _error_details(ex)]
+        return [False, 'Sorry: %s: %s' % (ex.__class__.__name__, ex), _error_details(ex)]
+    return [True, 'OK']
+
+
+def _error_details(ex):
+    """Return structured details of exception raised by compiler:
+        {'type': exception class name, 'message': message without location, 'line': ..., 'column': ...,
+         'end_line': ..., 'end_column': ..., 'text': source line without line break}
+
+    Line and column numbers are 1-based, as in SyntaxError. Unknown values are None.
+    End position is only known in Python 3.10+.
+    """
+    details = {'type': ex.__class__.__name__, 'message': str(ex), 'line': None, 'column': None,
+               'end_line': None, 'end_column': None, 'text': None}
+    if isinstance(ex, SyntaxError):
+        text = ex.text
+        if isinstance(text, bytes):
+            text = text.decode('utf-8', 'replace')
+        details.update(message=ex.msg, text=text.rstrip('\r\n') if text else None)
+        for key, attribute in (('line', 'lineno'), ('column', 'offset'), ('end_line', 'end_lineno'),
+                               ('end_column', 'end_offset')):
+            value = getattr(ex, attribute, None)
+            # Some errors have zero or negative offsets instead of None
+            details[key] = value if value is not None and value > 0 else None
+    return details
+
+
+# Files larger than that are memory-mapped instead of being read into memory.
+# Only hashing and tokenizing benefit: compile() copies any buffer into bytes.
+MMAP_THRESHOLD = 1024 * 1024
+
+
+def _read_source(file_name):
+    """Return file content: bytes, or read-only mmap for large files (close it with _close_source).
+
+    The mmap spares a copy when the source is only hashed or tokenized. compile() still makes
+    its own copy of the whole buffer, so peak memory of compilation is the same.
+
+    Raises IOError or OSError.
+    """
+    with open(file_name, 'rb') as source_file:
+        # compile() and hashlib accept buffers only in Python 3
+        if sys.version_info[0] >= 3 and os.fstat(source_file.fileno()).st_size > MMAP_THRESHOLD:
+            import mmap
+            try:
+                return mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error):
+                # E.g. special file system
+                pass
+        return source_file.read()
+
+
+def _close_source(source):
+    """Release source returned by _read_source."""
+    if source is not None and not isinstance(source, bytes):
+        source.close()
+
+
+# PEP 263 encoding declaration
+ENCODING_COOKIE_REGEX = re.compile(br'^[ \t\f]*#.*?coding[:=][ \t]*([-\w.]+)')
+BLANK_LINE_REGEX = re.compile(br'^[ \t\f]*(?:[#\r\n]|$)')
+
+
+def _detect_encoding(source):
+    """Return (encoding, BOM length) of source (bytes or mmap), like tokenize.detect_encoding does.
+
+    Only first two lines are looked at, the rest of source is not copied.
+    Raises SyntaxError for unknown encoding or encoding which contradicts BOM.
+    """
+    import codecs
+    bom_length = 3 if source[:3] == codecs.BOM_UTF8 else 0
+    encoding = 'utf-8' if bom_length or sys.version_info[0] >= 3 else 'ascii'
+    position = bom_length
+    for i in range(2):
+        end = source.find(b'\n', position)
+        line = source[position:end + 1 if end >= 0 else len(source)]
+        match = ENCODING_COOKIE_REGEX.match(line)
+        if match:
+            cookie = match.group(1).decode('ascii')
+            try:
+                found_encoding = codecs.lookup(cookie).name
+            except LookupError:
+                raise SyntaxError('unknown encoding: ' + cookie)
+            if bom_length and found_encoding != 'utf-8':
+                raise SyntaxError('encoding problem: %s with BOM' % cookie)
+            return found_encoding, bom_length
+        # Cookie is allowed on second line only if first line is blank or comment
+        if end < 0 or not BLANK_LINE_REGEX.match(line):
+            break
+        position = end + 1
+    return encoding, bom_length
+
+
+def _indentation_columns(indentation):
+    """Return (column with tab size 8, column with tab size 1) of end of indentation, like tokenizer of Python 3.
+
+    Indentation is inconsistent (TabError) if comparison of indentation levels depends on tab size.
+    """
+    column = alt_column = 0
+    for char in indentation:
+        if char == ' ':
+            column += 1
+            alt_column += 1
+        elif char == '\t':
+            column = (column // 8 + 1) * 8
+            alt_column += 1
+        elif char == '\f':
+            column = alt_column = 0
+    return column, alt_column
+
+
+def _tokenize_source(source, file_name):
+    """Check source (bytes or mmap) with tokenizer only, line by line.
+
+    Memory usage doesn't depend on size of source, but only encoding, unexpected indent, inconsistent dedent,
+    inconsistent tabs and spaces (in Python 3), invalid characters, unterminated strings and brackets are checked,
+    other syntax errors (e.g. missing indent after ':') are not detected.
+    Messages are formatted like messages of _compile_source.
+    """
+    import io
+    import tokenize
+    try:
+        encoding, bom_length = _detect_encoding(source)
+    except SyntaxError as ex:
+        ex.filename = file_name
+        return [False, ''.join(traceback.format_exception_only(SyntaxError, ex)), _error_details(ex)]
+    reader = io.BytesIO(source) if isinstance(source, bytes) else source
+    reader.seek(bom_length)
+
+    def readline():
+        return reader.readline().decode(encoding)
+
+    def token_error(error_class, message, token):
+        (line_number, offset), text = token[2], token[4]
+        ex = error_class(message, (file_name, line_number, offset + 1, text))
+        return [False, ''.join(traceback.format_exception_only(error_class, ex)), _error_details(ex)]
+
+    # Last two tokens which are not comments or blank lines, INDENT is valid only after ':' and NEWLINE
+    previous = [None, None]
+    # Columns of indentation levels with tab size 8 and 1, they must agree (see _indentation_columns)
+    indents = [(0, 0)]
+    try:
+        for token in tokenize.generate_tokens(readline):
+            token_type, string = token[:2]
+            if token_type == tokenize.ERRORTOKEN and not string.isspace():
+                # Tokenizer of Python 3.11 and older doesn't raise for unterminated single-quoted string
+                if string[-1:] in ('"', "'"):
+                    return token_error(SyntaxError, 'unterminated string literal (detected at line %d)' % token[2][0],
+                                       token)
+                return token_error(SyntaxError, 'invalid syntax', token)
+            if token_type == tokenize.INDENT and (previous[0] != (tokenize.OP, ':') or
+                                                  previous[1][0] != tokenize.NEWLINE):
+                return token_error(IndentationError, 'unexpected indent', token)
+            line_start = previous[1] is None or previous[1][0] in (tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT)
+            if line_start and sys.version_info[0] >= 3 and token_type not in (
+                    tokenize.COMMENT, tokenize.NL, tokenize.INDENT, tokenize.DEDENT, tokenize.ENDMARKER):
+                # First token of logical line
+                columns = _indentation_columns(token[4][:token[2][1]])
+                while len(indents) > 1 and columns[0] < indents[-1][0]:
+                    indents.pop()
+                # Inconsistent dedent is reported by tokenizer itself
+                if columns[0] == indents[-1][0] and columns[1] != indents[-1][1] or \
+                        columns[0] > indents[-1][0] and columns[1] <= indents[-1][1]:
+                    (line_number, offset), text = token[2], token[4]
+                    ex = TabError('inconsistent use of tabs and spaces in indentation',
+                                  (file_name, line_number, offset + 1, text))
+                    return [False, 'Sorry: %s: %s' % (ex.__class__.__name__, ex), _error_details(ex)]
+                if columns[0] > indents[-1][0]:
+                    indents.append(columns)
+            if token_type not in (tokenize.COMMENT, tokenize.NL):
+                previous = [previous[1], (token_type, string)]
+    except tokenize.TokenError as ex:
+        # Unexpected EOF in multi-line string or statement, line is where it starts
+        message, (line_number, offset) = ex.args
+        error = SyntaxError(message, (file_name, line_number, None, None))
+        return [False, ''.join(traceback.format_exception_only(SyntaxError, error)), _error_details(error)]
+    except SyntaxError as ex:
+        # IndentationError
+        ex.filename = file_name
+        return [False, ''.join(traceback.format_exception_only(ex.__class__, ex)), _error_details(ex)]
+    except (UnicodeDecodeError, LookupError) as ex:
+        return [False, 'Sorry: %s: %s' % (ex.__class__.__name__, ex), _error_details(ex)]
+    finally:
+        if reader is not source:
+            reader.close()
+    return [True, 'OK']
+
+
+def _compile_file_in_memory(file_name, source=None, max_compile_size=None, feature_version=None, level='compile'):
+    """Read file and compile it in memory, nothing is written to disk.
+
+    source: file content if it was already read (bytes or mmap)
+    max_compile_size: if file is larger than that, it's only tokenized
+    feature_version, level: see _compile_source
+    """
+    if source is not None:
+        if max_compile_size is not None and len(source) > max_compile_size:
+            return _tokenize_source(source, file_name)
+        return _compile_source(source, file_name, level, feature_version)
+    try:
+        source = _read_source(file_name)
+    except (IOError, OSError) as ex:
+        return [False, 'Sorry: %s: %s' % (ex.__class__.__name__, ex), _error_details(ex)]
+    try:
+        return _compile_file_in_memory(file_name, source, max_compile_size, feature_version, level)
+    finally:
+        _close_source(source)
+
+
+def _parse_file_in_memory(file_name, source=None, max_compile_size=None, feature_version=None):
+    """Read file and only parse it (like ast.parse), bytecode is not generated.
+
+    Errors detected by compiler (e.g. 'return' outside function) are not found.
+    """
+    return _compile_file_in_memory(file_name, source, max_compile_size, feature_version, level='parse')
+
+
+def _tokenize_file(file_name, source=None, max_compile_size=None, feature_version=None):
+    """Read file and only tokenize it, see _tokenize_source."""
+    return _compile_file_in_memory(file_name, source, max_compile_size, level='tokenize')
+
+
+def _compile_file_with_py_compile(file_name, source=None, max_compile_size=None, feature_version=None):
+    """Compile file using py_compile, writing bytecode to a temporary file.
+
+    source is ignored, py_compile always reads the file itself
+    max_compile_size: if file is larger than that, it's only tokenized
+    feature_version is not supported
+    """
+    if max_compile_size is not None and os.path.isfile(file_name) and os.path.getsize(file_name) > max_compile_size:
+        return _compile_file_in_memory(file_name, max_compile_size=max_compile_size)
+    temp_file_name = os.path.join(tempfile.gettempdir(), os.path.splitext(os.path.split(__file__)[1])[0] + '.tmp')
+    try:
+        py_compile.compile(file_name, cfile=temp_file_name, doraise=True)
+        return [True, 'OK']
+    except py_compile.PyCompileError as ex:
+        return [False, ex.msg, _error_details(ex.exc_value)]
+
+
+# Available ways to compile a single file:
+# {engine_name: function(file_name, source=None, max_compile_size=None, feature_version=None)
+#                -> [is_valid, message(, details)]}
+COMPILE_ENGINES = {
+    'memory': _compile_file_in_memory,
+    'py_compile': _compile_file_with_py_compile,
+    'parse': _parse_file_in_memory,
+    'tokenize': _tokenize_file,
+}
+
+# Checking levels from the fastest to the most complete, see check_python_syntax
+LEVELS = ('tokenize', 'parse', 'compile')
+# Level of each engine, engines which are not listed implement 'compile'
+ENGINE_LEVELS = {'parse': 'parse', 'tokenize': 'tokenize'}
+
+
+def _select_engine(level, engine, python_version):
+    """Return (engine, feature_version) which implement checking level for target python_version.
+
+    level: 'tokenize', 'parse', 'compile' or 'emulate' (see check_python_syntax)
+    feature_version: minor version of Python 3 whose grammar is checked in current interpreter
+        (see _emulated_feature_version), None if target interpreter should check files
+    """
+    if level != 'emulate' and level not in LEVELS:
+        raise ValueError('Unknown level: %r' % (level,))
+    if level in ENGINE_LEVELS:
+        engine = level
+    feature_version = None
+    if level == 'emulate' and engine in ('memory', 'parse'):
+        feature_version = _emulated_feature_version(python_version)
+    return engine, feature_version
+
+
+def _emulated_feature_version(python_version):
+    """Return minor version if python_version (its first version, if there are several) is older Python 3
+    which current interpreter can emulate with feature_version of its parser, otherwise None.
+
+    Parser rejects syntax which is newer than feature_version (e.g. walrus operator for 3.7),
+    but this is best effort: not every new feature is checked.
+    """
+    if python_version is None or sys.version_info[:2] < (3, 8):
+        return None
+    version = _normalize_versions_list(python_version)[0]
+    # Python 3.13 dropped support of feature versions below 3.7
+    minimum = 7 if sys.version_info[:2] >= (3, 13) else 4
+    if len(version) == 2 and version[0] == 3 and minimum <= version[1] < sys.version_info[1]:
+        return version[1]
+    return None
+
+
+def _cpu_time():
+    """Return CPU time (user and system) of current process in seconds."""
+    times = os.times()
+    return times[0] + times[1]
+
+
+def _peak_rss():
+    """Return peak resident set size of current process and its finished children in bytes, None if unknown."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in bytes on macOS, in kilobytes elsewhere
+    multiplier = 1 if sys.platform == 'darwin' else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * multiplier
+
+
+class _Stats(object):
+    """Timing and counters of one check, reported as '<stats>' result (see check_python_syntax)."""
+
+    # Number of slowest files to report
+    SLOWEST_FILES_COUNT = 10
+
+    def __init__(self):
+        # {stage: [wall seconds, CPU seconds]}
+        self.stages = {}
+        self.files = 0
+        self.bytes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Heap of (seconds, file_name)
+        self.slowest_files = []
+        # Peak RSS of other processes (parallel workers, another interpreter)
+        self.peak_rss = None
+        # Result of finish()
+        self._finished = None
+
+    @staticmethod
+    def start():
+        """Return start time for stop() or add_file()"""
+        return time.time(), _cpu_time()
+
+    def stop(self, stage, started):
+        """Add time elapsed since start() to given stage."""
+        self.add_stage(stage, time.time() - started[0], _cpu_time() - started[1])
+
+    def finish(self, started):
+        """Stop 'total' stage started at start() and return to_dict(), further calls return the same data."""
+        if self._finished is None:
+            self.stop('total', started)
+            self._finished = self.to_dict()
+        return self._finished
+
+    def add_stage(self, stage, wall, cpu):
+        totals = self.stages.setdefault(stage, [0.0, 0.0])
+        totals[0] += wall
+        totals[1] += cpu
+
+    def add_file(self, file_name, started, size=None):
+        """Count file compiled since start(), size is taken from file system if it's not known"""
+        wall = time.time() - started[0]
+        self.add_stage('compile', wall, _cpu_time() - started[1])
+        self.files += 1
+        if size is None:
+            try:
+                size = os.path.getsize(file_name)
+            except OSError:
+                size = 0
+        self.bytes += size
+        self._add_slow_file(wall, file_name)
+
+    def _add_slow_file(self, seconds, file_name):
+        """Remember file if it's one of SLOWEST_FILES_COUNT slowest files."""
+        item = (seconds, file_name)
+        if len(self.slowest_files) < self.SLOWEST_FILES_COUNT:
+            heapq.heappush(self.slowest_files, item)
+        elif item > self.slowest_files[0]:
+            heapq.heapreplace(self.slowest_files, item)
+
+    def merge(self, data):
+        """Add stats of another process (result of its to_dict())"""
+        for stage, times in data['stages'].items():
+            # Total time of another process is already counted in a stage of this one
+            if stage != 'total':
+                self.add_stage(stage, times['wall'], times['cpu'])
+        self.files += data['files']
+        self.bytes += data['bytes']
+        self.cache_hits += data['cache']['hits']
+        self.cache_misses += data['cache']['misses']
+        for file_name, seconds in data['slowest_files']:
+            self._add_slow_file(seconds, file_name)
+        if data['peak_rss'] is not None:
+            self.peak_rss = max(self.peak_rss or 0, data['peak_rss'])
+
+    def to_dict(self):
+        """Return JSON-serializable stats, see check_python_syntax"""
+        lookups = self.cache_hits + self.cache_misses
+        peak_rss = [x for x in (self.peak_rss, _peak_rss()) if x is not None]
+        return {
+            'stages': dict((stage, {'wall': wall, 'cpu': cpu}) for stage, (wall, cpu) in self.stages.items()),
+            'files': self.files,
+            'bytes': self.bytes,
+            'slowest_files': [[file_name, seconds] for seconds, file_name in sorted(self.slowest_files, reverse=True)],
+            'cache': {'hits': self.cache_hits, 'misses': self.cache_misses,
+                      'hit_rate': float(self.cache_hits) / lookups if lookups else None},
+            'peak_rss': max(peak_rss) if peak_rss else None,
+        }
+
+
+def _iter_timed(items, stats, stage):
+    """Yield items, adding time spent by producing them (but not by caller between them) to given stage of stats."""
+    wall = cpu = 0.0
+    items = iter(items)
+    try:
+        while True:
+            started = _Stats.start()
+            try:
+                item = next(items)
+            except StopIteration:
+                break
+            finally:
+                wall += time.time() - started[0]
+                cpu += _cpu_time() - started[1]
+            yield item
+    finally:
+        stats.add_stage(stage, wall, cpu)
+
+
+# Functions called with stats of every check, see add_stats_hook()
+_stats_hooks = []
+
+
+def add_stats_hook(hook):
+    """Call hook(stats) after every check_python_syntax() and iter_check_python_syntax() call.
+
+    stats is the same dict as '<stats>' result of check_python_syntax(..., stats=True),
+    it's collected for hooks even if stats argument is False.
+    Exceptions raised by hooks are written to stderr and otherwise ignored.
+    """
+    _stats_hooks.append(hook)
+
+
+def remove_stats_hook(hook):
+    """Remove hook added by add_stats_hook()"""
+    _stats_hooks.remove(hook)
+
+
+def _report_stats(stats_data):
+    """Call all stats hooks."""
+    for hook in list(_stats_hooks):
+        try:
+            hook(stats_data)
+        except Exception as ex:
+            sys.stderr.write(format_exception(ex))
+
+
+def default_cache_dir():
+    """Return default directory for persistent ResultCache."""
+    if sys.platform == 'win32' and os.environ.get('LOCALAPPDATA'):
+        base_dir = os.environ['LOCALAPPDATA']
+    else:
+        base_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base_dir, 'check-python-syntax')
+
+
+class ResultCache(object):
+    """Persistent cache of check results, stored in SQLite database in cache directory.
+
+    Results are keyed by absolute file path, file name as given (it's a part of error messages)
+    and tag (interpreter version, checker version, engine, max_compile_size and feature_version),
+    and validated by content hash. If file size and mtime didn't change, file is not read at all.
+
+    Several processes can use the same cache directory at once.
+    Least recently used entries are evicted when number of entries exceeds max_entries.
+    """
+
+    DATABASE_NAME = 'results-v3.sqlite'
+    DEFAULT_MAX_ENTRIES = 200000
+
+    def __init__(self, cache_dir, engine='memory', max_entries=DEFAULT_MAX_ENTRIES, max_compile_size=None,
+                 feature_version=None):
+        import sqlite3
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # Probably created by concurrent process
+                if not os.path.isdir(cache_dir):
+                    raise
+        self.tag = '%s %s|%s|%s' % (_python_implementation(), '.'.join(str(x) for x in sys.version_info[:3]),
+                                    _checker_version(), engine)
+        if max_compile_size is not None:
+            self.tag += '|%d' % max_compile_size
+        if feature_version is not None:
+            self.tag += '|3.%d' % feature_version
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # Stat and digest of files read by get(), used by put()
+        self._pending = {}
+        # Files whose last_used timestamp should be updated on close()
+        self._used = []
+        self._connection = sqlite3.connect(os.path.join(cache_dir, self.DATABASE_NAME), timeout=60)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'path TEXT NOT NULL, name TEXT NOT NULL, tag TEXT NOT NULL, mtime INTEGER NOT NULL, size INTEGER NOT NULL, '
+            'digest TEXT NOT NULL, is_valid INTEGER NOT NULL, message TEXT NOT NULL, details TEXT, '
+            'last_used REAL NOT NULL, '
+            'PRIMARY KEY (path, name, tag))')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+        self._connection.commit()
+
+    @classmethod
+    def open(cls, cache_dir, engine='memory', max_entries=DEFAULT_MAX_ENTRIES, max_compile_size=None,
+             feature_version=None):
+        """Return ResultCache or None if cache can't be used (no sqlite3 module, read-only directory...)"""
+        try:
+            return cls(cache_dir, engine, max_entries, max_compile_size, feature_version)
+        except Exception:
+            return None
+
+    def get(self, file_name):
+        """Return (result, source) tuple.
+
+        result: cached [is_valid, message(, details)] or None if file is not in cache or changed
+        source: file content if it had to be read (see _read_source), otherwise None
+        """
+        try:
+            stat = os.stat(file_name)
+        except OSError:
+            self.misses += 1
+            return None, None
+        mtime = _stat_mtime_ns(stat)
+        row = self._connection.execute('SELECT mtime, size, digest, is_valid, message, details FROM results '
+                                       'WHERE path=? AND name=? AND tag=?',
+                                       (os.path.abspath(file_name), file_name, self.tag)).fetchone()
+        if row is not None and row[0] == mtime and row[1] == stat.st_size:
+            self.hits += 1
+            self._used.append((file_name, mtime, row[2]))
+            return self._result(row), None
+        try:
+            source = _read_source(file_name)
+        except (IOError, OSError):
+            self.misses += 1
+            return None, None
+        digest = _digest(source)
+        if row is not None and row[2] == digest:
+            # Only mtime changed (e.g. file was touched or checked out again)
+            self.hits += 1
+            self._used.append((file_name, mtime, digest))
+            _close_source(source)
+            return self._result(row), None
+        self.misses += 1
+        self._pending[file_name] = (mtime, len(source), digest)
+        return None, source
+
+    @staticmethod
+    def _result(row):
+        result = [bool(row[3]), row[4]]
+        if row[5] is not None:
+            result.append(json.loads(row[5]))
+        return result
+
+    def put(self, file_name, result):
+        """Store result of file previously requested with get()."""
+        pending = self._pending.pop(file_name, None)
+        if pending is None:
+            return
+        mtime, size, digest = pending
+        details = json.dumps(result[2]) if len(result) > 2 else None
+        self._connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                 (os.path.abspath(file_name), file_name, self.tag, mtime, size, digest, int(result[0]),
+                                  result[1], details, time.time()))
+
+    def close(self):
+        """Commit changes, evict least recently used entries and close database."""
+        try:
+            now = time.time()
+            self._connection.executemany('UPDATE results SET last_used=?, mtime=? '
+                                         'WHERE path=? AND name=? AND tag=? AND digest=?',
+                                         [(now, mtime, os.path.abspath(file_name), file_name, self.tag, digest)
+                                          for file_name, mtime, digest in self._used])
+            count = self._connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+            if count > self.max_entries:
+                self._connection.execute('DELETE FROM results WHERE rowid IN '
+                                         '(SELECT rowid FROM results ORDER BY last_used LIMIT ?)',
+                                         (count - self.max_entries,))
+            self._connection.commit()
+        finally:
+            self._connection.close()
+
+
+def _stat_mtime_ns(stat):
+    """Return mtime in nanoseconds."""
+    mtime = getattr(stat, 'st_mtime_ns', None)
+    if mtime is None:
+        mtime = int(stat.st_mtime * 1000000000)
+    return mtime
+
+
+def _digest(data):
+    """Return hex digest of file content."""
+    import hashlib
+    return hashlib.sha1(data).hexdigest()
+
+
+_checker_version_value = None
+
+
+def _checker_version():
+    """Return version of this module and digest of its source, e.g. '0.1.0+3f786850e387'.
+
+    Cached results and results of daemon are reused only if they were produced by the same checker version,
+    so results of a modified checkout are not mixed with results of a release of the same __version__.
+    """
+    global _checker_version_value
+    if _checker_version_value is None:
+        try:
+            with open(os.path.splitext(os.path.abspath(__file__))[0] + '.py', 'rb') as source_file:
+                _checker_version_value = '%s+%s' % (__version__, _digest(source_file.read())[:12])
+        except (IOError, OSError):
+            _checker_version_value = __version__
+    return _checker_version_value
+
+
+# Names of Python implementations, as returned by platform.python_implementation()
+PYTHON_IMPLEMENTATIONS = {'cpython': 'CPython', 'pypy': 'PyPy', 'ironpython': 'IronPython', 'jython': 'Jython'}
+
+
+def _python_implementation():
+    """Return name of Python implementation, e.g. 'CPython'."""
+    # platform module is slow to import
+    if hasattr(sys, 'implementation'):
+        return PYTHON_IMPLEMENTATIONS.get(sys.implementation.name, sys.implementation.name)
+    import platform
+    return platform.python_implementation()
+
+
+# Files checked in directories by default
+DEFAULT_INCLUDE = ['*.py']
+
+# Pseudo-pattern of exclude which matches virtual environments (directories with pyvenv.cfg)
+VIRTUALENV_PATTERN = '<virtualenv>'
+
+# Directories skipped in directories by command line tool (and by library if they are passed as exclude)
+DEFAULT_EXCLUDE = ['.git', '.hg', '.svn', '.bzr', '_darcs', 'CVS', '__pycache__', '.tox', '.nox', '.eggs', '*.egg-info',
+                   'node_modules', '.mypy_cache', '.pytest_cache', '.ruff_cache', '.venv', VIRTUALENV_PATTERN]
+
+
+def _find_all_files(target_dir, include=None, exclude=None, gitignore=False):
+    """Find files in directory recursively, yield their paths (joined to target_dir).
+
+    Excluded and ignored directories are skipped without descending into them.
+
+    include: glob patterns of files to yield, default is DEFAULT_INCLUDE
+    exclude: glob patterns of files and directories to skip, nothing is skipped by default
+        Patterns without slash are matched against names, patterns with slash - against paths relative to target_dir.
+        VIRTUALENV_PATTERN matches virtual environments.
+    gitignore: skip files and directories ignored by .gitignore files (and .git/info/exclude)
+    """
+    include = _GlobSet(DEFAULT_INCLUDE if include is None else include)
+    exclude = _GlobSet(exclude or [])
+    stack = [_root_walk_context(target_dir, gitignore)]
+    while stack:
+        file_names, subdirectories = _scan_walked_directory(stack.pop(), include, exclude, gitignore)
+        for file_name in file_names:
+            yield file_name
+        # Reversed, so that directories are popped in sorted order
+        stack.extend(reversed(subdirectories))
+
+
+def _root_walk_context(target_dir, gitignore):
+    """Return walk context of target directory: (directory, path relative to target_dir, parent ignore rules)"""
+    return target_dir, '', _GitIgnore.for_directory(target_dir) if gitignore else None
+
+
+def _scan_walked_directory(context, include, exclude, gitignore):
+    """Scan one directory during walk (see _find_all_files).
+
+    context: (directory, path relative to walked directory, ignore rules of parent directories)
+
+    Returns:
+        (list of included files, list of walk contexts of subdirectories to descend into)
+    """
+    current_dir, relative_dir, ignore_rules = context
+    entries = _scan_directory(current_dir)
+    names = set(name for name, is_dir in entries)
+    if relative_dir and exclude.virtualenvs and 'pyvenv.cfg' in names:
+        # Virtual environment
+        return [], []
+    if gitignore and '.gitignore' in names:
+        ignore_rules = _GitIgnore.load(os.path.join(current_dir, '.gitignore'), strip_prefix=relative_dir,
+                                       parent=ignore_rules)
+    file_names = []
+    subdirectories = []
+    for name, is_dir in entries:
+        relative_path = relative_dir + name
+        if exclude.match(name, relative_path):
+            continue
+        if ignore_rules is not None and ignore_rules.is_ignored(relative_path, is_dir):
+            continue
+        if is_dir:
+            subdirectories.append((os.path.join(current_dir, name), relative_path + '/', ignore_rules))
+        elif include.match(name, relative_path):
+            file_names.append(os.path.join(current_dir, name))
+    return file_names, subdirectories
+
+
+class GitError(Exception):
+    """git command failed, e.g. not a git repository or unknown revision."""
+
+
+def _git(arguments, cwd=None):
+    """Run git command and return its output as list of NUL-separated items. Raises GitError."""
+    try:
+        process = subprocess.Popen(['git'] + arguments, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd)
+    except OSError as ex:
+        raise GitError('Failed to execute git: %s' % ex)
+    output, error = process.communicate()
+    if process.returncode != 0:
+        raise GitError('git %s failed: %s' % (' '.join(arguments), error.decode('utf-8', 'replace').strip()))
+    return [x for x in output.decode('utf-8', 'surrogateescape' if sys.version_info[0] >= 3 else 'replace').split('\0') if x]
+
+
+def _git_changed_files(root, changed_since=None, staged=False, paths=None):
+    """Return set of absolute paths of existing files changed in git repository.
+
+    changed_since: revision, files changed between it and working tree, plus untracked files
+    staged: files changed in index compared to HEAD
+    paths: only files and directories with these paths relative to root are looked at, None means whole repository
+
+    Added, copied, modified, renamed (new name) and type-changed files are included, deleted ones are not.
+    """
+    # Untracked files are found by scanning working tree, so it's limited to given paths
+    pathspecs = [':(literal)' + x.replace(os.sep, '/') for x in paths] if paths is not None else []
+    # --no-renames is not used, so renamed files are reported once, by new name
+    file_names = []
+    if changed_since is not None:
+        file_names.extend(_git(['diff', '--name-only', '-z', '--diff-filter=ACMRT', '-M', changed_since, '--'] +
+                               pathspecs, cwd=root))
+        file_names.extend(_git(['ls-files', '--others', '--exclude-standard', '-z', '--'] + pathspecs, cwd=root))
+    if staged:
+        file_names.extend(_git(['diff', '--cached', '--name-only', '-z', '--diff-filter=ACMRT', '-M', '--'] +
+                               pathspecs, cwd=root))
+    result = set()
+    for file_name in file_names:
+        path = os.path.normpath(os.path.join(root, file_name))
+        # File may be deleted in working tree after it was staged
+        if os.path.isfile(path):
+            result.add(path)
+    return result
+
+
+def _filter_changed_files(changed_files, target, include=None, exclude=None):
+    """Return files from changed_files which are target itself or inside target directory.
+
+    Files inside directory are filtered by include and exclude patterns (see _find_all_files).
+    """
+    absolute_target = os.path.realpath(target)
+    if not os.path.isdir(target):
+        return [os.path.abspath(target)] if absolute_target in changed_files else []
+    include = _GlobSet(DEFAULT_INCLUDE if include is None else include)
+    exclude = _GlobSet(exclude or [])
+    result = []
+    prefix = os.path.join(absolute_target, '')
+    for path in sorted(changed_files):
+        if not path.startswith(prefix):
+            continue
+        relative_path = path[len(prefix):].replace(os.sep, '/')
+        parts = relative_path.split('/')
+        if not include.match(parts[-1], relative_path):
+            continue
+        # Excluded if file or any of its parent directories matches
+        if any(exclude.match(parts[i], '/'.join(parts[:i + 1])) for i in range(len(parts))):
+            continue
+        result.append(os.path.join(target, *parts))
+    return result
+
+
+def _scan_directory(directory):
+    """Return sorted list of (name, is_dir) for directory entries. Symlinks to directories are not followed."""
+    try:
+        if hasattr(os, 'scandir'):
+            # File type is known from directory listing, no need to stat every entry
+            entries = [(x.name, x.is_dir(follow_symlinks=False)) for x in os.scandir(directory)]
+        else:
+            entries = [(x, os.path.isdir(os.path.join(directory, x)) and not os.path.islink(os.path.join(directory, x)))
+                       for x in os.listdir(directory)]
+    except OSError:
+        return []
+    entries.sort()
+    return entries
+
+
+class _GlobSet(object):
+    """Set of glob patterns matched against file name or relative path (and VIRTUALENV_PATTERN, see _find_all_files)."""
+
+    def __init__(self, patterns):
+        import fnmatch
+        self.virtualenvs = VIRTUALENV_PATTERN in patterns
+        patterns = [x for x in patterns if x != VIRTUALENV_PATTERN]
+        name_patterns = [x for x in patterns if '/' not in x.strip('/')]
+        path_patterns = [x.strip('/') for x in patterns if '/' in x.strip('/')]
+        self.name_regex = re.compile('|'.join(fnmatch.translate(x.rstrip('/')) for x in name_patterns)) if name_patterns else None
+        self.path_regex = re.compile('|'.join(fnmatch.translate(x) for x in path_patterns)) if path_patterns else None
+
+    def match(self, name, relative_path):
+        return bool((self.name_regex is not None and self.name_regex.match(name)) or
+                    (self.path_regex is not None and self.path_regex.match(relative_path)))
+
+
+class _GitIgnore(object):
+    """Rules of one .gitignore file, chained to rules of parent directories."""
+
+    def __init__(self, rules, strip_prefix='', add_prefix='', parent=None):
+        """
+        rules: list of (regex, is_negative, is_dir_only)
+        strip_prefix: for .gitignore inside walked directory - its directory relative to walked one, e.g. 'sub/dir/'
+        add_prefix: for .gitignore above walked directory - walked directory relative to .gitignore's one
+        parent: rules of parent directories
+        """
+        self.rules = rules
+        self.strip_prefix = strip_prefix
+        self.add_prefix = add_prefix
+        self.parent = parent
+
+    @classmethod
+    def load(cls, file_name, strip_prefix='', add_prefix='', parent=None):
+        try:
+            with open(file_name, 'rb') as file:
+                lines = file.read().decode('utf-8', 'replace').splitlines()
+        except (IOError, OSError):
+            return parent
+        rules = [x for x in (cls._parse_line(line) for line in lines) if x is not None]
+        return cls(rules, strip_prefix, add_prefix, parent) if rules else parent
+
+    @classmethod
+    def for_directory(cls, directory):
+        """Return rules from repository root down to directory (excluding directory's own .gitignore)."""
+        directory = os.path.abspath(directory)
+        # Find repository root
+        parents = []
+        current = directory
+        while True:
+            if os.path.exists(os.path.join(current, '.git')):
+                break
+            parent = os.path.dirname(current)
+            if parent == current:
+                # Not in repository
+                return None
+            parents.append(current)
+            current = parent
+        root = current
+        rules = cls.load(os.path.join(root, '.git', 'info', 'exclude'), add_prefix=cls._relative(directory, root))
+        # parents[0] is directory itself, its .gitignore is loaded during walk
+        ancestors = [root] + list(reversed(parents[1:])) if parents else []
+        for ancestor in ancestors:
+            rules = cls.load(os.path.join(ancestor, '.gitignore'), add_prefix=cls._relative(directory, ancestor),
+                             parent=rules)
+        return rules
+
+    @staticmethod
+    def _relative(directory, base):
+        """Return path of directory relative to base with trailing slash, or '' if they are equal."""
+        relative = os.path.relpath(directory, base).replace(os.sep, '/')
+        return '' if relative == '.' else relative + '/'
+
+    @staticmethod
+    def _parse_line(line):
+        """Parse .gitignore line, return (regex, is_negative, is_dir_only) or None."""
+        line = line.rstrip()
+        if not line or line.startswith('#'):
+            return None
+        is_negative = line.startswith('!')
+        if is_negative or line.startswith('\\'):
+            line = line[1:]
+        is_dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        if not line:
+            return None
+        is_anchored = '/' in line
+        line = line.lstrip('/')
+        regex = []
+        i = 0
+        while i < len(line):
+            if line.startswith('**/', i):
+                regex.append('(?:.*/)?')
+                i += 3
+            elif line.startswith('**', i):
+                regex.append('.*')
+                i += 2
+            elif line[i] == '*':
+                regex.append('[^/]*')
+                i += 1
+            elif line[i] == '?':
+                regex.append('[^/]')
+                i += 1
+            elif line[i] == '[' and ']' in line[i + 2:]:
+                end = line.index(']', i + 2)
+                regex.append('[' + line[i + 1:end].replace('!', '^', 1).replace('\\', '\\\\') + ']')
+                i = end + 1
+            else:
+                regex.append(re.escape(line[i]))
+                i += 1
+        regex = ''.join(regex) + '$'
+        if not is_anchored:
+            regex = '(?:.*/)?' + regex
+        return re.compile(regex), is_negative, is_dir_only
+
+    def is_ignored(self, relative_path, is_dir):
+        """Return True if path (relative to walked directory, '/'-separated) is ignored."""
+        rules = self
+        while rules is not None:
+            if relative_path.startswith(rules.strip_prefix):
+                path = rules.add_prefix + relative_path[len(rules.strip_prefix):]
+                # Last matching rule wins
+                for regex, is_negative, is_dir_only in reversed(rules.rules):
+                    if (is_dir or not is_dir_only) and regex.match(path):
+                        return not is_negative
+            rules = rules.parent
+        return False
+
+
+def _normalize_versions_list(python_version):
+    """Return versions list in normalized form
+
+    python_version: target python version(s)
+        Allowed formats: '2.6' or (2,6) or [(2,6),(2,7)] or ['2.6','2.7'] or None
+
+    Returns:
+        List of tuples, e.g. [(2,6),(2,7)]
+
+    Raises:
+        TypeError
+    """
+    # Convert comma-separated string to list
+    # '2.6,2.7' -> ['2.6', '2.7']
+    if isinstance(python_version, str) and ',' in python_version:
+        python_version = [x.strip() for x in python_version.split(',') if x.strip()]
+    # Convert single string or tuple or list of int to list
+    # '2.6' -> [(2.6)]
+    # (2,6) -> [(2,6)]
+    # [2,6] -> [[2,6]]
+    if isinstance(python_version, str):
+        python_version = [tuple(int(x) for x in python_version.split('.'))]
+    elif isinstance(python_version, (tuple, list)) and all(isinstance(x, int) for x in python_version):
+        python_version = [python_version]
+
+    # Convert all version items to tuples
+    def convert_item(item):
+        if isinstance(item, str):
+            try:
+                result = tuple(int(x) for x in item.split('.'))
+            except ValueError:
+                raise TypeError()
+        elif isinstance(item, tuple):
+            result = item
+        elif isinstance(item, list):
+            result = tuple(item)
+        else:
+            raise TypeError()
+        if (not isinstance(result, tuple) or
+            not 1 <= len(result) <= 2 or
+            not all(isinstance(x,int) for x in result) or
+            result[0] not in (2,3)):
+            raise TypeError()
+        return result
+    return [convert_item(x) for x in python_version]
+
+
+class InterpreterRegistry(object):
+    """Python interpreters available in PATH.
+
+    PATH is scanned by looking at file names (python, python3, python3.4, python34...),
+    then real version of each interpreter is confirmed by running it once.
+    Versions are remembered by real path and mtime of executable, so interpreter is probed again
+    only if it's replaced. Optionally, versions are saved to JSON file and reused by other processes.
+    """
+
+    NAME_PATTERN = re.compile(r'^python(\d(\.?\d+)?)?(\.exe)?$', re.IGNORECASE)
+    PROBE_CODE = 'import sys; sys.stdout.write("%d.%d" % sys.version_info[:2])'
+    # Seconds to wait for all interpreters which are probed at once
+    PROBE_TIMEOUT = 10.0
+
+    def __init__(self, search_path=None, cache_file=None):
+        """
+        search_path: list of directories, default is PATH environment variable
+        cache_file: JSON file to load and save probed versions, None to keep them in memory only
+        """
+        self.search_path = search_path
+        self.cache_file = cache_file
+        self.lock = allocate_lock()
+        # {real_path: [mtime, [major, minor]]}
+        self._versions = {}
+        self._interpreters = None
+        self._scanned_path = None
+        if cache_file and os.path.isfile(cache_file):
+            try:
+                with open(cache_file) as file:
+                    self._versions = json.load(file)
+            except (IOError, OSError, ValueError):
+                pass
+
+    def _get_search_path(self):
+        if self.search_path is not None:
+            return list(self.search_path)
+        return [x for x in os.environ.get('PATH', '').split(os.pathsep) if x]
+
+    def interpreters(self, refresh=False):
+        """Return list of (version, path) for all found interpreters, in PATH order, e.g. [((2,7), '/usr/bin/python2.7')]"""
+        with self.lock:
+            search_path = self._get_search_path()
+            if refresh or self._interpreters is None or search_path != self._scanned_path:
+                self._interpreters = self._scan(search_path, refresh)
+                self._scanned_path = search_path
+                if self.cache_file:
+                    self.save()
+            return list(self._interpreters)
+
+    def _scan(self, search_path, refresh):
+        candidates = self._candidates(search_path)
+        self._probe(candidates, refresh)
+        return self._probed_interpreters(candidates)
+
+    def _candidates(self, search_path, names=None):
+        """Return paths of executables in search_path, names: only these names are accepted (see _name)."""
+        candidates = []
+        for directory in search_path:
+            try:
+                names_in_directory = sorted(os.listdir(directory))
+            except OSError:
+                continue
+            for name in names_in_directory:
+                if self.NAME_PATTERN.match(name) and (names is None or self._name(name) in names):
+                    path = os.path.join(directory, name)
+                    if os.path.isfile(path) and os.access(path, os.X_OK):
+                        candidates.append(path)
+        return candidates
+
+    def _probed_interpreters(self, candidates):
+        result = []
+        for path in candidates:
+            cached = self._versions.get(os.path.realpath(path))
+            if cached is not None and cached[1]:
+                result.append((tuple(cached[1]), path))
+        return result
+
+    def _probe(self, candidates, refresh):
+        """Probe all new or changed interpreters concurrently, return True if any of them was probed."""
+        processes = {}
+        with open(os.devnull, 'wb') as devnull:
+            for path in candidates:
+                real_path = os.path.realpath(path)
+                try:
+                    mtime = _stat_mtime_ns(os.stat(real_path))
+                except OSError:
+                    continue
+                cached = self._versions.get(real_path)
+                if not refresh and cached is not None and cached[0] == mtime:
+                    continue
+                if real_path not in processes:
+                    try:
+                        processes[real_path] = (mtime, subprocess.Popen([path, '-c', self.PROBE_CODE],
+                                                                        stdout=subprocess.PIPE, stderr=devnull))
+                    except OSError:
+                        self._versions[real_path] = [mtime, None]
+        deadline = time.time() + self.PROBE_TIMEOUT
+        for real_path, (mtime, process) in processes.items():
+            while process.poll() is None and time.time() < deadline:
+                time.sleep(0.005)
+            if process.returncode is None:
+                # Hung candidate (e.g. broken shim) is killed, so it can't block discovery.
+                # It's not remembered, because it may be only slow.
+                try:
+                    process.kill()
+                except OSError:
+                    pass
+                process.wait()
+                process.stdout.close()
+                continue
+            output = process.stdout.read().decode('ascii', 'replace')
+            process.stdout.close()
+            try:
+                version = [int(x) for x in output.strip().split('.')]
+            except ValueError:
+                version = None
+            if process.returncode != 0 or not version:
+                version = None
+            self._versions[real_path] = [mtime, version]
+        return bool(processes)
+
+    @staticmethod
+    def _name(file_name):
+        """Name of interpreter which is compared to version, e.g. 'python2.7' (case-insensitive in Windows)."""
+        if sys.platform == 'win32':
+            return os.path.splitext(file_name)[0].lower()
+        return file_name
+
+    def save(self):
+        """Save probed versions to cache_file."""
+        directory = os.path.dirname(os.path.abspath(self.cache_file))
+        temp_file = '%s.%d.tmp' % (self.cache_file, os.getpid())
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(temp_file, 'w') as file:
+                json.dump(self._versions, file)
+            # Atomic replace, so concurrent processes never see partially written file
+            if sys.platform == 'win32' and os.path.exists(self.cache_file):
+                os.remove(self.cache_file)
+            os.rename(temp_file, self.cache_file)
+        except (IOError, OSError):
+            pass
+
+    def find(self, version):
+        """Return path to interpreter of given version, e.g. (2,) or (2,7). None if not found.
+
+        Interpreters named exactly after the version (python2.7, python27, python2) are preferred.
+        Only they are probed at first, whole PATH is scanned only if none of them has this version.
+        """
+        preferred_names = ['python' + '.'.join(str(x) for x in version), 'python' + ''.join(str(x) for x in version)]
+        path = self._find_in(version, preferred_names, self._named_interpreters(preferred_names))
+        if path is None:
+            path = self._find_in(version, preferred_names, self.interpreters())
+        return path
+
+    def _named_interpreters(self, names):
+        """Return list of (version, path) of interpreters with given names, without scanning whole PATH."""
+        with self.lock:
+            search_path = self._get_search_path()
+            if self._interpreters is not None and search_path == self._scanned_path:
+                return [x for x in self._interpreters if self._name(os.path.basename(x[1])) in names]
+            candidates = self._candidates(search_path, names)
+            if self._probe(candidates, False) and self.cache_file:
+                self.save()
+            return self._probed_interpreters(candidates)
+
+    def _find_in(self, version, preferred_names, interpreters):
+        candidates = []
+        for index, (found_version, path) in enumerate(interpreters):
+            if found_version[:len(version)] == tuple(version):
+                name = self._name(os.path.basename(path))
+                rank = preferred_names.index(name) if name in preferred_names else len(preferred_names)
+                candidates.append((rank, index, path))
+        if not candidates:
+            return None
+        return min(candidates)[2]
+
+
+_interpreter_registry = InterpreterRegistry()
+
+
+def list_python_interpreters(refresh=False):
+    """Return list of (version, path) of Python interpreters in PATH, e.g. [((2,7), '/usr/bin/python2.7')]
+
+    PATH is scanned once per process, unless refresh is True.
+    """
+    return _interpreter_registry.interpreters(refresh=refresh)
+
+
+def use_interpreter_cache_file(cache_file):
+    """Load interpreter versions from JSON file and save them there, to share them between processes."""
+    global _interpreter_registry
+    _interpreter_registry = InterpreterRegistry(cache_file=cache_file)
+
+
+def find_python_executable(python_versions):
+    """Find python executable for given python versions
+    Args:
+        python_versions: List of 1- or 2-tuples, e.g. [(2,6), (2,7)]
+
+    Returns:
+        First found Python version and executable path, e.g. ((2,7), '/usr/bin/python2.7')
+        (None, None) if no Python interpreter is found.
+    """
+    python_versions = _normalize_versions_list(python_versions)
+    for version in python_versions:
+        python_executable = _interpreter_registry.find(version)
+        if python_executable is not None:
+            return (version, python_executable)
+    return (None, None)
+
+
+def _script_file():
+    """Return path to this module's .py file, suitable for running under another interpreter.
+
+    Its bytecode cache is kept: other interpreters import the module, and import recompiles .pyc of another version.
+    """
+    return os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+
+
+class WorkerError(Exception):
+    """Persistent worker process died or sent malformed response."""
+
+
+class _WorkerBusyError(WorkerError):
+    """Worker is used by unfinished streaming request of current thread (e.g. generator which is not closed)."""
+
+
+class _WorkerLimitError(WorkerError):
+    """Worker exceeded timeout or output size limit of request and was killed."""
+
+
+class _OutputLimitExceeded(Exception):
+    """Output of another interpreter exceeded _OutputLimits."""
+
+
+class _OutputReader(object):
+    """Reads lines of process output by separate thread, so that reading can be limited by time and size.
+
+    Lines are read in chunks of limited size, so that a huge line isn't read into memory before its size is checked.
+    Stream is closed at EOF.
+    """
+
+    CHUNK_SIZE = 65536
+
+    def __init__(self, stream):
+        self.chunks = queue.Queue()
+        thread = threading.Thread(target=self._read, args=(stream,))
+        thread.daemon = True
+        thread.start()
+
+    def _read(self, stream):
+        try:
+            while True:
+                chunk = stream.readline(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.chunks.put(chunk)
+        except (IOError, OSError, ValueError):
+            pass
+        finally:
+            self.chunks.put(b'')
+            stream.close()
+
+    def readline(self, limits):
+        """Return next line, b'' at EOF. Raises _OutputLimitExceeded.
+
+        limits: _OutputLimits of the whole request, the line is added to its output size
+        """
+        chunks = []
+        while True:
+            try:
+                if limits.deadline is None:
+                    chunk = self.chunks.get()
+                else:
+                    chunk = self.chunks.get(True, max(0, limits.deadline - time.time()))
+            except queue.Empty:
+                raise _OutputLimitExceeded('timeout, not finished in %s seconds' % limits.timeout)
+            if not chunk:
+                # EOF stays for subsequent reads
+                self.chunks.put(b'')
+                return b''.join(chunks)
+            limits.output_size += len(chunk)
+            if limits.max_output_size is not None and limits.output_size > limits.max_output_size:
+                raise _OutputLimitExceeded('output is larger than %d bytes' % limits.max_output_size)
+            chunks.append(chunk)
+            if chunk.endswith(b'\n'):
+                return b''.join(chunks)
+
+
+class _OutputLimits(object):
+    """Limits of one request to another interpreter: timeout in seconds and maximum output size in bytes.
+
+    None means no limit.
+    """
+
+    def __init__(self, timeout=None, max_output_size=None):
+        self.timeout = timeout
+        self.deadline = None if timeout is None else time.time() + timeout
+        self.max_output_size = max_output_size
+        self.output_size = 0
+
+
+class _Worker(object):
+    """Persistent worker: target interpreter running main() of this module with --worker argument.
+
+    Protocol is line-delimited JSON over stdin/stdout: one request line, one response line.
+    Request: {"cwd": ..., "files": [...], "engine": ..., "jobs": ..., "cache_dir": ..., "walk_options": {...},
+              "max_compile_size": ...}
+        Instead of "files" (files or directories to check recursively), request may contain
+        "file_names": list of already collected files to compile as is, or
+        "sources": in-memory sources [[name, base64-encoded source], ...] (see _encode_sources).
+        If request contains "stats": true, response also contains "<stats>" item (see check_python_syntax).
+        If request contains "errors_only": true, response contains only invalid files and "<summary>" item.
+    Response: {file_path: [is_valid, message]}
+
+    If request contains "stream": true, response is a sequence of NDJSON records
+    (see _ndjson_record) terminated by {"done": true} line.
+
+    All requests can be limited by timeout and output size (see _OutputLimits), worker is killed if it exceeds them.
+    """
+
+    def __init__(self, python_executable):
+        self.python_executable = python_executable
+        self.lock = threading.Lock()
+        # Thread holding the lock, lock is not reentrant
+        self.owner = None
+        # Worker was killed, it may still be running for a while, but must not be used
+        self.killed = False
+        self.process = subprocess.Popen(_child_command(python_executable), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.output = _OutputReader(self.process.stdout)
+
+    def is_alive(self):
+        return not self.killed and self.process.poll() is None
+
+    def kill(self):
+        self.killed = True
+        try:
+            self.process.kill()
+        except OSError:
+            # Already exited
+            pass
+
+    def acquire(self):
+        """Acquire worker for one request, raise _WorkerBusyError instead of deadlock if current thread holds it."""
+        if self.owner is threading.current_thread():
+            raise _WorkerBusyError('Worker %s is busy with unfinished request' % self.python_executable)
+        self.lock.acquire()
+        self.owner = threading.current_thread()
+
+    def release(self):
+        self.owner = None
+        self.lock.release()
+
+    def request(self, request, timeout=None, max_output_size=None, stats=None):
+        """Send request and return decoded response. Raises WorkerError.
+
+        stats: _Stats to record deserialization of response
+        """
+        limits = _OutputLimits(timeout, max_output_size)
+        self.acquire()
+        try:
+            self._send(request, limits)
+            line = self._readline(limits)
+            if not line:
+                raise WorkerError('Worker %s exited with code %s' % (self.python_executable, self.process.wait()))
+            started = _Stats.start()
+            try:
+                response = json.loads(line.decode('utf-8'))
+            except ValueError:
+                raise WorkerError('Failed to load JSON: ' + repr(line))
+            if stats is not None:
+                stats.stop('deserialization', started)
+            return response
+        finally:
+            self.release()
+
+    def request_stream(self, request, timeout=None, max_output_size=None):
+        """Send streaming request and yield (file_path, [is_valid, message]) as they arrive. Raises WorkerError.
+
+        timeout includes time spent by caller between results.
+        Worker is held until the end of response, so another request from the same thread before that
+        (nested call, or generator which is neither exhausted nor closed) raises _WorkerBusyError.
+        If generator is closed before the end of response, worker is killed, because its output is out of sync.
+        """
+        request = dict(request, stream=True)
+        limits = _OutputLimits(timeout, max_output_size)
+        self.acquire()
+        completed = False
+        try:
+            self._send(request, limits)
+            while True:
+                line = self._readline(limits)
+                if not line:
+                    raise WorkerError('Worker %s exited with code %s' % (self.python_executable, self.process.wait()))
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    record = None
+                if not isinstance(record, dict):
+                    raise WorkerError('Failed to load JSON: ' + repr(line))
+                if record.get('done'):
+                    completed = True
+                    return
+                yield _parse_ndjson_record(record)
+        finally:
+            if not completed and self.is_alive():
+                self.kill()
+            self.release()
+
+    def _send(self, request, limits):
+        """Write request to worker. If there is a timeout, it's written by another thread, because it may block."""
+        data = json.dumps(request).encode('utf-8') + b'\n'
+        errors = []
+
+        def write():
+            try:
+                self.process.stdin.write(data)
+                self.process.stdin.flush()
+            except (IOError, OSError) as ex:
+                errors.append(ex)
+
+        if limits.deadline is None:
+            write()
+        else:
+            writer = threading.Thread(target=write)
+            writer.daemon = True
+            writer.start()
+            writer.join(max(0, limits.deadline - time.time()))
+            if writer.is_alive():
+                self.kill()
+                raise _WorkerLimitError('%s: timeout, not finished in %s seconds' % (self.python_executable,
+                                                                                     limits.timeout))
+        if errors:
+            raise WorkerError('Worker %s failed: %s' % (self.python_executable, errors[0]))
+
+    def _readline(self, limits):
+        """Read line of response, kill worker and raise _WorkerLimitError if it exceeds limits."""
+        try:
+            return self.output.readline(limits)
+        except _OutputLimitExceeded as ex:
+            self.kill()
+            raise _WorkerLimitError('%s: %s' % (self.python_executable, ex))
+
+    def close(self):
+        """Stop worker and return its exit code. Raises _WorkerBusyError if current thread holds it."""
+        self.acquire()
+        try:
+            try:
+                # Closing stdin makes worker exit gracefully
+                self.process.stdin.close()
+            except (IOError, OSError):
+                pass
+            return self.process.wait()
+        finally:
+            self.release()
+
+
+class _WorkerPool(object):
+    """Persistent workers, one per python executable. Dead workers are restarted."""
+
+    def __init__(self):
+        self.lock = allocate_lock()
+        self.workers = {}
+        self._atexit_registered = False
+
+    def get_worker(self, python_executable):
+        with self.lock:
+            worker = self.workers.get(python_executable)
+            if worker is None or not worker.is_alive():
+                if not self._atexit_registered:
+                    import atexit
+                    atexit.register(self.close)
+                    self._atexit_registered = True
+                worker = self.workers[python_executable] = _Worker(python_executable)
+            return worker
+
+    def request(self, python_executable, request, timeout=None, max_output_size=None, stats=None):
+        """Send request to worker of given executable, restart worker and retry once if it fails.
+
+        Request which exceeds limits is not retried.
+        If current thread didn't finish its streaming request to that worker, temporary worker is used.
+        """
+        try:
+            return self.get_worker(python_executable).request(request, timeout, max_output_size, stats)
+        except _WorkerBusyError:
+            return _worker_request(python_executable, request, False, timeout, max_output_size, stats)
+        except _WorkerLimitError:
+            self.discard(python_executable)
+            raise
+        except WorkerError:
+            self.discard(python_executable)
+            return self.get_worker(python_executable).request(request, timeout, max_output_size, stats)
+
+    def request_stream(self, python_executable, request, timeout=None, max_output_size=None):
+        """Send streaming request to worker of given executable.
+
+        Worker is restarted and request is retried once if worker fails before sending anything,
+        request which exceeds limits is not retried.
+        If current thread didn't finish its streaming request to that worker, temporary worker is used.
+        """
+        started = False
+        try:
+            for item in self.get_worker(python_executable).request_stream(request, timeout, max_output_size):
+                started = True
+                yield item
+        except _WorkerBusyError:
+            for item in _iter_worker_stream(python_executable, request, False, timeout, max_output_size):
+                yield item
+        except WorkerError as ex:
+            self.discard(python_executable)
+            if started or isinstance(ex, _WorkerLimitError):
+                raise
+            for item in self.get_worker(python_executable).request_stream(request, timeout, max_output_size):
+                yield item
+
+    def discard(self, python_executable):
+        with self.lock:
+            worker = self.workers.pop(python_executable, None)
+        if worker is not None:
+            if worker.is_alive():
+                worker.kill()
+            try:
+                worker.close()
+            except _WorkerBusyError:
+                # Unfinished request of current thread fails when it reads from killed worker
+                pass
+
+    def close(self):
+        for python_executable in list(self.workers):
+            self.discard(python_executable)
+
+
+_worker_pool = _WorkerPool()
+
+
+def shutdown_workers():
+    """Stop all persistent workers started by check_python_syntax(..., persistent_worker=True)."""
+    _worker_pool.close()
+
+
+def _worker_request(python_executable, request, persistent_worker=False, timeout=None, max_output_size=None,
+                    stats=None):
+    """Send request to persistent worker of given executable, or to new worker which handles only this request.
+
+    Raises OSError if worker can't be started, WorkerError.
+    """
+    if persistent_worker:
+        return _worker_pool.request(python_executable, request, timeout, max_output_size, stats)
+    worker = _Worker(python_executable)
+    try:
+        return worker.request(request, timeout, max_output_size, stats)
+    finally:
+        worker.close()
+
+
+def _iter_worker_stream(python_executable, request, persistent_worker=False, timeout=None, max_output_size=None):
+    """Same as _worker_request, but for streaming request: yield (file_path, [is_valid, message]) as they arrive.
+
+    New worker must also exit with zero code after the end of results.
+    """
+    if persistent_worker:
+        for item in _worker_pool.request_stream(python_executable, request, timeout, max_output_size):
+            yield item
+        return
+    worker = _Worker(python_executable)
+    try:
+        for item in worker.request_stream(request, timeout, max_output_size):
+            yield item
+    finally:
+        returncode = worker.close()
+    if returncode:
+        raise WorkerError('Worker %s exited with code %s' % (python_executable, returncode))
+
+
+def _serve_worker():
+    """Worker main loop: read requests from stdin, write responses to stdout. Exits on EOF."""
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    initial_cwd = os.getcwd()
+    while True:
+        line = stdin.readline()
+        if not line:
+            break
+        _serve_request(line, stdout, initial_cwd)
+
+
+def _serve_request(line, stdout, default_cwd):
+    """Handle one worker request (JSON document, see _Worker), write response to stdout."""
+    try:
+        request = json.loads(line.decode('utf-8') if isinstance(line, bytes) else line)
+        os.chdir(request.get('cwd') or default_cwd)
+        stats = _Stats() if request.get('stats') else None
+        options = dict(engine=request.get('engine', 'memory'), jobs=request.get('jobs', 1),
+                       cache_dir=request.get('cache_dir'), stats=stats,
+                       max_compile_size=request.get('max_compile_size'), max_errors=request.get('max_errors'))
+        if request.get('stream'):
+            _write_ndjson_stream(request, options, stdout)
+            return
+        response = _collect_results(_iter_request_results(request, options), request.get('errors_only'))
+        if stats is not None:
+            response['<stats>'] = [True, stats.to_dict()]
+    except Exception as ex:
+        response = {'<exception>': [False, format_exception(ex)]}
+    stdout.write(json.dumps(response).encode('utf-8') + b'\n')
+    stdout.flush()
+
+
+def _write_ndjson_stream(request, options, stdout):
+    """Write NDJSON records for streaming worker request, terminated by {"done": true}
+
+    If request contains "errors_only": true, valid files are only counted in "<summary>" record.
+    """
+    summary = _ResultSummary() if request.get('errors_only') else None
+    try:
+        for file_name, result in _iter_request_results(request, options):
+            if summary is not None:
+                summary.count(file_name, result)
+                if result[0]:
+                    continue
+            stdout.write(json.dumps(_ndjson_record(file_name, result)).encode('utf-8') + b'\n')
+            stdout.flush()
+        if summary is not None:
+            stdout.write(json.dumps(_ndjson_record('<summary>', [True, summary.summary()])).encode('utf-8') + b'\n')
+        if options['stats'] is not None:
+            stdout.write(json.dumps(_ndjson_record('<stats>', [True, options['stats'].to_dict()])).encode('utf-8') + b'\n')
+    except Exception as ex:
+        stdout.write(json.dumps(_ndjson_record('<exception>', [False, format_exception(ex)])).encode('utf-8') + b'\n')
+    stdout.write(b'{"done": true}\n')
+    stdout.flush()
+
+
+def _iter_request_results(request, options):
+    """Yield (file_name, [is_valid, message]) for worker request.
+
+    options: keyword arguments for _iter_check_all_files
+    """
+    if 'sources' in request:
+        return _iter_compile_sources(_decode_sources(request['sources']), jobs=options['jobs'], stats=options['stats'],
+                                     max_compile_size=options['max_compile_size'], max_errors=options['max_errors'],
+                                     engine=options['engine'])
+    if 'file_names' in request:
+        return _iter_compile_files(request['file_names'], **options)
+    return _iter_check_all_files(request['files'], walk_options=request.get('walk_options'), **options)
+
+
+def _ndjson_record(file_name, result):
+    """Return NDJSON record for one file: {"file": file_path, "is_valid": is_valid, "message": message}
+
+    Details of error, if any, are added as "details" field.
+    """
+    record = {'file': file_name, 'is_valid': result[0], 'message': result[1]}
+    if len(result) > 2:
+        record['details'] = result[2]
+    return record
+
+
+def _parse_ndjson_record(record):
+    """Return (file_path, [is_valid, message(, details)]) from NDJSON record."""
+    result = [record['is_valid'], record['message']]
+    if 'details' in record:
+        result.append(record['details'])
+    return record['file'], result
+
+
+def _find_target_python(python_version, _use_this_python=False, feature_version=None):
+    """Find interpreter which should compile files.
+
+    feature_version: if current interpreter emulates target version (see _select_engine), nothing is searched
+
+    Returns:
+        (python_executable, error_message)
+        python_executable is None if current interpreter should be used.
+    """
+    if python_version is None or feature_version is not None:
+        return None, None
+    found_python_version, python_executable = find_python_executable(python_version)
+    if found_python_version is None:
+        return None, 'No Python executable found for %r' % python_version
+    this_python_version = sys.version_info[:min(2, len(found_python_version))]
+    if found_python_version == this_python_version:
+        return None, None
+    # Safeguard against infinite recursion
+    if _use_this_python:
+        return None, 'We are in %s instead of %s' % (this_python_version, found_python_version)
+    return python_executable, None
+
+
+def _walk_options(include=None, exclude=None, gitignore=False, changed_since=None, staged=False):
+    """Return walk_options dict (keyword arguments of _collect_files) without default values."""
+    walk_options = {}
+    if changed_since is not None:
+        walk_options['changed_since'] = changed_since
+    if staged:
+        walk_options['staged'] = True
+    if include is not None:
+        walk_options['include'] = list(include)
+    if exclude is not None:
+        walk_options['exclude'] = list(exclude)
+    if gitignore:
+        walk_options['gitignore'] = True
+    return walk_options
+
+
+def _module_command(python_executable, arguments):
+    """Return command line to run main() of this module in another interpreter.
+
+    Module is imported rather than run as script, so that interpreter can use (and write) its bytecode cache
+    instead of compiling the whole module every time.
+    """
+    script_file = _script_file()
+    code = 'import sys; sys.path.insert(0, sys.argv[1]); import %s; %s.main(sys.argv[2:])' % (
+        (os.path.splitext(os.path.basename(script_file))[0],) * 2)
+    return [python_executable, '-c', code, os.path.dirname(script_file)] + list(arguments)
+
+
+def _child_command(python_executable):
+    """Return command line to run this module as worker (see _Worker) in another interpreter.
+
+    Requests are sent on stdin rather than as arguments, so that command line doesn't depend on the number of files
+    (it would exceed argument size limits of OS) and worker doesn't need to parse options.
+    Worker which handles a single request gets EOF after it.
+    """
+    return _module_command(python_executable, ['--worker'])
+
+
+def _child_request(files_or_directories, engine, jobs, cache_dir, walk_options=None, stats=False,
+                   max_compile_size=None, errors_only=False, max_errors=None):
+    """Return worker request to check files in another interpreter.
+
+    Details are always requested, caller drops them if they are not needed.
+    """
+    return {'cwd': os.getcwd(), 'files': list(files_or_directories), 'engine': engine, 'jobs': jobs,
+            'cache_dir': cache_dir, 'walk_options': walk_options or {}, 'stats': stats,
+            'max_compile_size': max_compile_size, 'errors_only': errors_only, 'max_errors': max_errors}
+
+
+# Default limit of child interpreter output
+DEFAULT_MAX_OUTPUT_SIZE = 1024 * 1024 * 1024
+
+
+def _check_in_child(python_executable, files_or_directories, engine='memory', jobs=1, cache_dir=None,
+                    walk_options=None, timeout=None, max_output_size=DEFAULT_MAX_OUTPUT_SIZE, stats=None,
+                    max_compile_size=None, errors_only=False, max_errors=None, persistent_worker=False):
+    """Run this module in another interpreter (new or persistent worker) and return its results.
+
+    stats: _Stats to collect timing of the child process, child's own stats are merged into it
+    """
+    started = _Stats.start()
+    request = _child_request(files_or_directories, engine, jobs, cache_dir, walk_options, stats=stats is not None,
+                             max_compile_size=max_compile_size, errors_only=errors_only, max_errors=max_errors)
+    try:
+        result = _worker_request(python_executable, request, persistent_worker, timeout, max_output_size, stats)
+    except OSError as ex:
+        return {'<exception>': [False, 'Failed to execute %s: %s' % (python_executable, ex)]}
+    except WorkerError as ex:
+        return {'<exception>': [False, str(ex)]}
+    if stats is not None:
+        stats.stop('subprocess', started)
+        _merge_child_stats(stats, result)
+    return result
+
+
+def _iter_check_in_child(python_executable, request, persistent_worker=False, timeout=None,
+                         max_output_size=DEFAULT_MAX_OUTPUT_SIZE):
+    """Same as _check_in_child, but yield results of another interpreter as they arrive."""
+    try:
+        for item in _iter_worker_stream(python_executable, request, persistent_worker, timeout, max_output_size):
+            yield item
+    except OSError as ex:
+        yield '<exception>', [False, 'Failed to execute %s: %s' % (python_executable, ex)]
+    except WorkerError as ex:
+        yield '<exception>', [False, str(ex)]
+
+
+def _merge_child_stats(stats, result):
+    """Remove '<stats>' item from result of another process and merge it into stats."""
+    child_stats = result.pop('<stats>', None)
+    if child_stats is not None and isinstance(child_stats[1], dict):
+        stats.merge(child_stats[1])
+
+
+def _without_details(result):
+    """Return {file_path: [is_valid, message]} from result which may contain details of errors."""
+    return dict((file_name, file_result[:2]) for file_name, file_result in result.items())
+
+
+def check_python_syntax(files_or_directories, python_version=None, engine='memory', jobs=1, cache_dir=None,
+                        include=None, exclude=None, gitignore=False, changed_since=None, staged=False,
+                        persistent_worker=False, timeout=None, max_output_size=DEFAULT_MAX_OUTPUT_SIZE, stats=False,
+                        max_compile_size=None, errors_only=False, details=False, max_errors=None, level='compile',
+                        _use_this_python=False):
+    """Try to compile target files in the given version of Python.
+
+    Args:
+        files_or_directories: list of files or directories to check recursively
+
+    Kwargs:
+        python_version: target python version(s)
+            Allowed formats: '2.6' or (2,6) or [(2,6),(2,7)] or ['2.6','2.7'] or None
+            Actually supported versions are 2.6, 2.7 and 3.2+
+            If None, current interpreter is used.
+            If multiple versions are specified, first present version is used.
+        engine: how to compile files
+            'memory' (default) - compile in memory with built-in compile(), nothing is written to disk
+            'py_compile' - use py_compile module, bytecode is written to system temp directory
+        jobs: number of processes compiling files in parallel
+            1 (default) - compile in current process
+            0 - use all CPUs
+        cache_dir: directory of persistent result cache, unchanged files are not compiled again
+            None (default) - don't use cache
+        include: glob patterns of files to check in directories, default is DEFAULT_INCLUDE (['*.py'])
+        exclude: glob patterns of files and directories to skip in directories, nothing is skipped by default
+            Patterns without slash are matched against names, patterns with slash - against relative paths.
+            VIRTUALENV_PATTERN matches virtual environments (directories with pyvenv.cfg).
+            Command line tool uses DEFAULT_EXCLUDE (VCS, cache and virtualenv directories).
+        gitignore: skip files and directories ignored by .gitignore (command line tool does it by default)
+        changed_since: git revision, check only files added, modified or renamed since that revision
+            (committed or not, including untracked files). Deleted files are skipped.
+        staged: check only files added, modified or renamed in git index (e.g. in pre-commit hook)
+        persistent_worker: if another interpreter is required, keep it running and reuse it in subsequent calls
+            Workers are restarted if they die, and stopped at exit or by shutdown_workers().
+        timeout: maximum time in seconds for another interpreter to check all files, None means no limit
+        max_output_size: maximum size of another interpreter's output in bytes, None means no limit
+            Both limits apply to persistent workers too. Interpreter which exceeds them is killed.
+        stats: add '<stats>' item to results: [True, {
+                'stages': {stage: {'wall': seconds, 'cpu': seconds}},
+                'files': number of compiled files,
+                'bytes': total size of compiled files,
+                'slowest_files': [[file_path, seconds], ...] (top _Stats.SLOWEST_FILES_COUNT),
+                'cache': {'hits': ..., 'misses': ..., 'hit_rate': ... or None if cache is not used},
+                'peak_rss': peak resident set size in bytes of all processes or None if unknown,
+            }]
+            Stages are 'discovery' (finding interpreter), 'walk', 'compile', 'subprocess' (whole run of another
+            interpreter, including its own stages), 'deserialization' (of its output) and 'total'.
+            Times of parallel processes and another interpreter are added up, CPU time is time of process
+            which ran the stage.
+        max_compile_size: files larger than that many bytes are only checked by tokenizer, line by line,
+            so that memory usage doesn't depend on file size (compiler uses about 100 times more memory than
+            the size of source). Only encoding, indentation (except missing indent), invalid characters,
+            unterminated strings and brackets are checked then.
+            None (default) - compile all files
+        errors_only: return only invalid files and '<summary>' item:
+            [True, {'files': number of checked files, 'valid': number of valid files, 'invalid': number of errors}]
+            Valid files are only counted, so memory usage and size of another interpreter's output
+            are proportional to number of errors, not to number of files.
+        details: add structured details to results of invalid files, taken from SyntaxError:
+            [False, message, {'type': 'SyntaxError', 'message': 'invalid syntax', 'line': 2, 'column': 11,
+                              'end_line': 2, 'end_column': 12, 'text': '    print x'}]
+            Line and column numbers are 1-based, unknown values are None (e.g. end position before Python 3.10).
+            Files which were not found and unexpected errors have no details.
+        max_errors: stop as soon as that many invalid files are found (1 means fail fast) and return partial results
+            Files are compiled as soon as they are found, in walk order, so the walk stops too.
+            Parallel processes and another interpreter stop as well.
+            None (default) - check all files
+        level: how thoroughly files are checked
+            'compile' (default) - generate bytecode in target interpreter, all syntax errors are found
+            'parse' - only parse files (like ast.parse), errors found by compiler (e.g. 'return' outside function)
+                are missed. In CPython it's not faster than 'compile' (building AST objects costs as much as
+                generating bytecode).
+            'tokenize' - only tokenize files, see max_compile_size. It's the fastest level in Python 3.12+,
+                where tokenizer is implemented in C, but slower than 'compile' in older versions.
+            'emulate' - if python_version is an older Python 3 which current interpreter can emulate
+                (3.4+ in Python 3.8-3.12, 3.7+ in Python 3.13+), files are compiled by current interpreter
+                and also parsed with feature_version of target version, without starting another interpreter
+                (and it doesn't have to be installed). Otherwise it's 'compile'. Results are approximate:
+                syntax newer than target version is rejected on best-effort basis (e.g. walrus operator,
+                match statement, except*, but not 'return *a, b', 'continue' in 'finally' for 3.7 or relaxed
+                decorators for 3.8), and code which is valid only in target version (e.g. 'yield' in list
+                comprehension in 3.7) is rejected. Messages are those of current interpreter.
+        _use_this_python:
+            Return error if current python version differs from python_version
+            You should not use it.
+
+    Returns:
+        {file_path: [is_valid, message]}, or {file_path: [is_valid, message, details]} for invalid files
+        if details is True
+
+    Raises:
+        None
+    """
+    collector = _Stats() if stats or _stats_hooks else None
+    started = _Stats.start()
+    try:
+        walk_options = _walk_options(include, exclude, gitignore, changed_since, staged)
+        engine, feature_version = _select_engine(level, engine, python_version)
+        python_executable, error_message = _find_target_python(python_version, _use_this_python, feature_version)
+        if error_message:
+            return {'<exception>': [False, error_message]}
+        if collector is not None:
+            collector.stop('discovery', started)
+        # If this python version is not right, execute required python interpreter in subprocess
+        if python_executable is not None:
+            result = _check_in_child(python_executable, files_or_directories, engine=engine, jobs=jobs,
+                                     cache_dir=cache_dir, walk_options=walk_options, timeout=timeout,
+                                     max_output_size=max_output_size, stats=collector,
+                                     max_compile_size=max_compile_size, errors_only=errors_only,
+                                     max_errors=max_errors, persistent_worker=persistent_worker)
+        else:
+            result = _check_all_files(files_or_directories, engine=engine, jobs=jobs, cache_dir=cache_dir,
+                                      walk_options=walk_options, stats=collector, max_compile_size=max_compile_size,
+                                      errors_only=errors_only, max_errors=max_errors, feature_version=feature_version)
+        if not details:
+            result = _without_details(result)
+        if collector is not None and stats:
+            result['<stats>'] = [True, collector.finish(started)]
+        return result
+    except GitError as ex:
+        return {'<exception>': [False, str(ex)]}
+    except Exception as ex:
+        return {'<exception>': [False, format_exception(ex)]}
+    finally:
+        # Failed checks are reported to stats hooks too
+        if collector is not None:
+            _report_stats(collector.finish(started))
+
+
+def iter_check_python_syntax(files_or_directories, python_version=None, engine='memory', jobs=1, cache_dir=None,
+                             include=None, exclude=None, gitignore=False, changed_since=None, staged=False,
+                             persistent_worker=False, timeout=None, max_output_size=DEFAULT_MAX_OUTPUT_SIZE,
+                             stats=False, max_compile_size=None, errors_only=False, details=False, max_errors=None,
+                             level='compile', _use_this_python=False):
+    """Same as check_python_syntax, but yield results one by one as soon as each file is compiled.
 
+    If another interpreter is used, its results are relayed as they arrive.
+    Its timeout includes time spent by caller between results.
+    If generator is closed early, outstanding work is cancelled.
 
-def _check_all_files(files_or_directories):
-    """Check given files or directories recursively.
+    Yields:
+        (file_path, [is_valid, message]), or (file_path, [is_valid, message, details]) if details is True
+        Errors are reported as ('<exception>', [False, message]), possibly after some results.
+        If stats is True, ('<stats>', [True, stats]) is yielded last (see check_python_syntax),
+        'compile' and 'subprocess' stages don't include time spent by caller between results.
+        If errors_only is True, only invalid files are yielded, then ('<summary>', [True, summary])
 
-    Return dictionary {file_name: (is_valid, message)} for all individual files.
+    Raises:
+        None
     """
-    result = {}
-    # Collect all files from directories recursively
-    all_files = []
-    for file_or_directory in files_or_directories:
-        if os.path.isdir(file_or_directory):
-            file_names = _find_all_files(file_or_directory)
-            # Filter out non-python files
-            file_names = [x for x in file_names if os.path.splitext(x)[1] == '.py']
-        elif os.path.isfile(file_or_directory):
-            file_names = [os.path.abspath(file_or_directory)]
+    collector = _Stats() if stats or _stats_hooks else None
+    started = _Stats.start()
+    reported = False
+    try:
+        walk_options = _walk_options(include, exclude, gitignore, changed_since, staged)
+        engine, feature_version = _select_engine(level, engine, python_version)
+        python_executable, error_message = _find_target_python(python_version, _use_this_python, feature_version)
+        if error_message:
+            yield '<exception>', [False, error_message]
+            return
+        if collector is not None:
+            collector.stop('discovery', started)
+        # Another interpreter sends only invalid files and '<summary>' itself
+        summary = None
+        if python_executable is None:
+            items = _iter_check_all_files(files_or_directories, engine=engine, jobs=jobs, cache_dir=cache_dir,
+                                          walk_options=walk_options, stats=collector, max_compile_size=max_compile_size,
+                                          max_errors=max_errors, feature_version=feature_version)
+            summary = _ResultSummary() if errors_only else None
         else:
-            result[file_or_directory] = [False, 'Target not found']
-            continue
-        all_files.extend(file_names)
-    # Make sure that all files are unique
-    all_files = sorted(set(all_files))
-    # Try to compile all files in current interpreter and record results
-    import py_compile
-    temp_file_name = os.path.join(tempfile.gettempdir(), os.path.splitext(os.path.split(__file__)[1])[0] + '.tmp')
-    for file_name in all_files:
-        try:
-            py_compile.compile(file_name, cfile=temp_file_name, doraise=True)
-            result[file_name] = [True, 'OK']
-        except py_compile.PyCompileError as ex:
-            result[file_name] = [False, ex.msg]
-    return result
-
+            request = _child_request(files_or_directories, engine, jobs, cache_dir, walk_options,
+                                     stats=collector is not None, max_compile_size=max_compile_size,
+                                     errors_only=errors_only, max_errors=max_errors)
+            items = _iter_check_in_child(python_executable, request, persistent_worker, timeout, max_output_size)
+            if collector is not None:
+                items = _iter_timed(items, collector, 'subprocess')
+        for file_name, result in items:
+            if file_name == '<stats>' and collector is not None and isinstance(result[1], dict):
+                # Stats of another interpreter
+                collector.merge(result[1])
+                continue
+            if summary is not None:
+                summary.count(file_name, result)
+                if result[0]:
+                    continue
+            yield file_name, result if details else result[:2]
+        if summary is not None:
+            yield '<summary>', [True, summary.summary()]
+        if collector is not None:
+            reported = True
+            _report_stats(collector.finish(started))
+            if stats:
+                yield '<stats>', [True, collector.finish(started)]
+    except GitError as ex:
+        yield '<exception>', [False, str(ex)]
+    except Exception as ex:
+        yield '<exception>', [False, format_exception(ex)]
+    finally:
+        # Failed and cancelled checks are reported to stats hooks too, before '<stats>' if it's yielded
+        if collector is not None and not reported:
+            _report_stats(collector.finish(started))
 
-def _find_all_files(target_dir):
-    """Find all files in directory and return list of absolute paths."""
-    result = []
-    for current_dir, dir_names, file_names in os.walk(target_dir):
-        result.extend(os.path.join(current_dir, x) for x in file_names)
-    return result
 
+def check_python_sources(sources, python_version=None, jobs=1, persistent_worker=False, timeout=None,
+                         max_output_size=DEFAULT_MAX_OUTPUT_SIZE, stats=False, max_compile_size=None, errors_only=False,
+                         details=False, max_errors=None, level='compile', _use_this_python=False):
+    """Try to compile in-memory sources in the given version of Python, without reading or writing any files.
 
-def _normalize_versions_list(python_version):
-    """Return versions list in normalized form
+    Args:
+        sources: list of (name, source) tuples, e.g. [('package/module.py', b'print(1)\n')]
+            source is bytes (encoding is detected like in files), text is encoded to UTF-8
+            name is only used in results and error messages
 
-    python_version: target python version(s)
-        Allowed formats: '2.6' or (2,6) or [(2,6),(2,7)] or ['2.6','2.7'] or None
+    Kwargs:
+        python_version, jobs, persistent_worker, timeout, max_output_size, stats, max_compile_size, errors_only,
+        details, max_errors, level:
+            same as in check_python_syntax()
+            If another interpreter is required, all sources are sent to it in a single message.
 
     Returns:
-        List of tuples, e.g. [(2,6),(2,7)]
+        {name: [is_valid, message]}
 
     Raises:
-        TypeError
+        None
     """
-    # Convert comma-separated string to list
-    # '2.6,2.7' -> ['2.6', '2.7']
-    if isinstance(python_version, str) and ',' in python_version:
-        python_version = [x.strip() for x in python_version.split(',') if x.strip()]
-    # Convert single string or tuple or list of int to list
-    # '2.6' -> [(2.6)]
-    # (2,6) -> [(2,6)]
-    # [2,6] -> [[2,6]]
-    if isinstance(python_version, str):
-        python_version = [tuple(int(x) for x in python_version.split('.'))]
-    elif isinstance(python_version, (tuple, list)) and all(isinstance(x, int) for x in python_version):
-        python_version = [python_version]
-
-    # Convert all version items to tuples
-    def convert_item(item):
-        if isinstance(item, str):
-            try:
-                result = tuple(int(x) for x in item.split('.'))
-            except ValueError:
-                raise TypeError()
-        elif isinstance(item, tuple):
-            result = item
-        elif isinstance(item, list):
-            result = tuple(item)
+    collector = _Stats() if stats or _stats_hooks else None
+    started = _Stats.start()
+    try:
+        engine, feature_version = _select_engine(level, 'memory', python_version)
+        python_executable, error_message = _find_target_python(python_version, _use_this_python, feature_version)
+        if error_message:
+            return {'<exception>': [False, error_message]}
+        if collector is not None:
+            collector.stop('discovery', started)
+        if python_executable is None:
+            result = _compile_sources(_normalize_sources(sources), jobs=jobs, stats=collector,
+                                      max_compile_size=max_compile_size, errors_only=errors_only, max_errors=max_errors,
+                                      engine=engine, feature_version=feature_version)
         else:
-            raise TypeError()
-        if (not isinstance(result, tuple) or
-            not 1 <= len(result) <= 2 or
-            not all(isinstance(x,int) for x in result) or
-            result[0] not in (2,3)):
-            raise TypeError()
+            request = {'sources': _encode_sources(sources), 'jobs': jobs, 'stats': collector is not None,
+                       'max_compile_size': max_compile_size, 'errors_only': errors_only, 'max_errors': max_errors,
+                       'engine': engine}
+            worker_started = _Stats.start()
+            try:
+                result = _worker_request(python_executable, request, persistent_worker, timeout, max_output_size,
+                                         collector)
+            except OSError as ex:
+                return {'<exception>': [False, 'Failed to execute %s: %s' % (python_executable, ex)]}
+            except WorkerError as ex:
+                return {'<exception>': [False, str(ex)]}
+            if collector is not None:
+                collector.stop('subprocess', worker_started)
+                _merge_child_stats(collector, result)
+        if not details:
+            result = _without_details(result)
+        if collector is not None and stats:
+            result['<stats>'] = [True, collector.finish(started)]
         return result
-    return [convert_item(x) for x in python_version]
+    except Exception as ex:
+        return {'<exception>': [False, format_exception(ex)]}
+    finally:
+        # Failed checks are reported to stats hooks too
+        if collector is not None:
+            _report_stats(collector.finish(started))
 
 
-def find_python_executable(python_versions):
-    """Find python executable name for given python versions
+def check_all_python_versions(files_or_directories, python_versions, engine='memory', jobs=1, cache_dir=None,
+                              include=None, exclude=None, gitignore=False, changed_since=None, staged=False,
+                              persistent_worker=False, timeout=None, max_output_size=DEFAULT_MAX_OUTPUT_SIZE,
+                              max_compile_size=None, errors_only=False, details=False, max_errors=None, level='compile'):
+    """Try to compile target files in each of the given versions of Python.
+
+    Files are collected only once, all interpreters run concurrently.
+
     Args:
-        python_versions: List of 1- or 2-tuples, e.g. [(2,6), (2,7)]
+        files_or_directories: list of files or directories to check recursively
+        python_versions: target python versions, same formats as in check_python_syntax()
+
+    Kwargs:
+        engine, jobs, cache_dir, include, exclude, gitignore, changed_since, staged, persistent_worker, timeout,
+        max_output_size, max_compile_size, errors_only, details, max_errors, level:
+            same as in check_python_syntax(), timeout, max_output_size and max_errors apply to each version separately,
+            level is resolved for each version (emulated versions are checked by current interpreter)
 
     Returns:
-        First found Python version and executable name, e.g. ((2,7), 'python2.7')
-        None if no Python interpreter is found.
+        {version: {file_path: [is_valid, message]}}, e.g. {'2.7': {...}, '3.4': {...}}
+
+    Raises:
+        None
     """
-    python_versions = _normalize_versions_list(python_versions)
-    for version in python_versions:
-        possible_names = ['python' + '.'.join(str(x) for x in version), 'python' + ''.join(str(x) for x in version)]
-        if version == (2,):
-            possible_names.append('python')
-        for python_name in possible_names:
+    try:
+        python_versions = _normalize_versions_list(python_versions)
+        not_found, all_files = _collect_files(files_or_directories,
+                                              **_walk_options(include, exclude, gitignore, changed_since, staged))
+        files_max_errors = max_errors
+        if max_errors is not None:
+            # Not found targets come first and count towards max_errors, as in check_python_syntax()
+            missing = [x for x in files_or_directories if x in not_found][:max_errors]
+            not_found = dict((x, not_found[x]) for x in missing)
+            files_max_errors = max_errors - len(not_found)
+            if files_max_errors == 0:
+                all_files, files_max_errors = [], None
+        result = {}
+        threads = []
+
+        def check_in_worker(version_name, python_executable, engine):
+            request = {'cwd': os.getcwd(), 'file_names': all_files, 'engine': engine, 'jobs': jobs,
+                       'cache_dir': cache_dir, 'max_compile_size': max_compile_size, 'errors_only': errors_only,
+                       'max_errors': files_max_errors}
             try:
-                process = subprocess.Popen([python_name, '--version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                process.wait()
-                process.stdout.close()
-                return (version, python_name)
-            except OSError:
-                pass
-    return (None, None)
+                version_result = _worker_request(python_executable, request, persistent_worker, timeout,
+                                                 max_output_size)
+            except OSError as ex:
+                version_result = {'<exception>': [False, 'Failed to execute %s: %s' % (python_executable, ex)]}
+            except WorkerError as ex:
+                version_result = {'<exception>': [False, str(ex)]}
+            except Exception as ex:
+                version_result = {'<exception>': [False, format_exception(ex)]}
+            result[version_name] = version_result
 
+        # {(engine, feature_version): [version_name, ...]} for versions checked by current interpreter
+        this_python_versions = {}
+        for version in python_versions:
+            version_name = '.'.join(str(x) for x in version)
+            version_engine, feature_version = _select_engine(level, engine, [version])
+            if feature_version is not None:
+                this_python_versions.setdefault((version_engine, feature_version), []).append(version_name)
+                continue
+            found_python_version, python_executable = find_python_executable([version])
+            if found_python_version is None:
+                result[version_name] = {'<exception>': [False, 'No Python executable found for %r' % version_name]}
+            elif found_python_version == sys.version_info[:len(found_python_version)]:
+                this_python_versions.setdefault((version_engine, None), []).append(version_name)
+            else:
+                thread = threading.Thread(target=check_in_worker, args=(version_name, python_executable, version_engine))
+                thread.start()
+                threads.append(thread)
+        # Current interpreter compiles files while others are running
+        for (version_engine, feature_version), version_names in this_python_versions.items():
+            this_result = _compile_files(all_files, engine=version_engine, jobs=jobs, cache_dir=cache_dir,
+                                         max_compile_size=max_compile_size, errors_only=errors_only,
+                                         max_errors=files_max_errors, feature_version=feature_version)
+            for version_name in version_names:
+                result[version_name] = dict(this_result)
+        for thread in threads:
+            thread.join()
+        for version_result in itervalues(result):
+            if '<exception>' not in version_result:
+                version_result.update(not_found)
+                if '<summary>' in version_result:
+                    # Summary may be shared by results of several versions
+                    summary = dict(version_result['<summary>'][1])
+                    summary['files'] += len(not_found)
+                    summary['invalid'] += len(not_found)
+                    version_result['<summary>'] = [True, summary]
+        if not details:
+            result = dict((version_name, _without_details(version_result)) for version_name, version_result in result.items())
+        return result
+    except GitError as ex:
+        return {'<exception>': {'<exception>': [False, str(ex)]}}
+    except Exception as ex:
+        return {'<exception>': {'<exception>': [False, format_exception(ex)]}}
 
-def check_python_syntax(files_or_directories, python_version=None, _use_this_python=False):
-    """Try to compile target files in the given version of Python.
+
+def _iter_compile_in_target(python_executable, file_names, engine='memory', jobs=1, cache_dir=None,
+                            max_compile_size=None, feature_version=None, max_output_size=DEFAULT_MAX_OUTPUT_SIZE):
+    """Compile already collected files in current interpreter (python_executable is None) or in persistent worker."""
+    if python_executable is None:
+        return _iter_compile_files(file_names, engine=engine, jobs=jobs, cache_dir=cache_dir,
+                                   max_compile_size=max_compile_size, feature_version=feature_version)
+    request = {'cwd': os.getcwd(), 'file_names': file_names, 'engine': engine, 'jobs': jobs, 'cache_dir': cache_dir,
+               'max_compile_size': max_compile_size}
+    return _worker_pool.request_stream(python_executable, request, max_output_size=max_output_size)
+
+
+class _WatchedTree(object):
+    """Watched files and directories, with enough context to rescan any directory individually."""
+
+    def __init__(self, files_or_directories, include=None, exclude=None, gitignore=False):
+        self.include = _GlobSet(DEFAULT_INCLUDE if include is None else include)
+        self.exclude = _GlobSet(exclude or [])
+        self.gitignore = gitignore
+        # {directory: walk context}
+        self.contexts = {}
+        # {directory: (set of files, set of subdirectories)}
+        self.children = {}
+        self.individual_files = set()
+        self.not_found = []
+        for target in files_or_directories:
+            if os.path.isdir(target):
+                self._add_directory(_root_walk_context(target, gitignore))
+            elif os.path.isfile(target):
+                self.individual_files.add(os.path.abspath(target))
+            else:
+                self.not_found.append(target)
+
+    def files(self):
+        """Return set of all watched files."""
+        result = set(self.individual_files)
+        for file_names, subdirectories in itervalues(self.children):
+            result.update(file_names)
+        return result
+
+    def _add_directory(self, context):
+        """Walk directory recursively, return set of its files."""
+        found = set()
+        stack = [context]
+        while stack:
+            context = stack.pop()
+            file_names, subdirectories = _scan_walked_directory(context, self.include, self.exclude, self.gitignore)
+            self.contexts[context[0]] = context
+            self.children[context[0]] = (set(file_names), set(x[0] for x in subdirectories))
+            found.update(file_names)
+            stack.extend(subdirectories)
+        return found
+
+    def _remove_directory(self, directory):
+        """Forget directory recursively, return set of its files."""
+        removed = set()
+        stack = [directory]
+        while stack:
+            directory = stack.pop()
+            self.contexts.pop(directory, None)
+            file_names, subdirectories = self.children.pop(directory, (set(), set()))
+            removed.update(file_names)
+            stack.extend(subdirectories)
+        return removed
+
+    def rescan_directory(self, directory):
+        """Compare directory content with known one. Return (added files, removed files)."""
+        context = self.contexts.get(directory)
+        if context is None:
+            return set(), set()
+        if not os.path.isdir(directory):
+            return set(), self._remove_directory(directory)
+        old_files, old_subdirectories = self.children[directory]
+        file_names, subdirectories = _scan_walked_directory(context, self.include, self.exclude, self.gitignore)
+        file_names = set(file_names)
+        subdirectories = dict((x[0], x) for x in subdirectories)
+        added = file_names - old_files
+        removed = old_files - file_names
+        for subdirectory in old_subdirectories - set(subdirectories):
+            removed.update(self._remove_directory(subdirectory))
+        for subdirectory in set(subdirectories) - old_subdirectories:
+            added.update(self._add_directory(subdirectories[subdirectory]))
+        self.children[directory] = (file_names, set(subdirectories))
+        return added, removed
+
+
+class _PollingWatcher(object):
+    """Detect changes of watched tree by periodic stat() of directories and files.
+
+    Directories are checked on every tick and rescanned if their mtime changed, then their files are checked too
+    (it catches new, removed and atomically replaced files). In-place writes don't change mtime of directory,
+    so recently changed files and individual files are checked on every tick, and all files - every SWEEP_INTERVAL,
+    unless tree has at most SMALL_TREE_FILES files, then all of them are checked on every tick.
+    """
+
+    # Seconds between checks of all files
+    SWEEP_INTERVAL = 1.0
+    # Files changed within that many seconds are checked on every tick
+    HOT_PERIOD = 60.0
+    # All files of trees which are not larger than that are checked on every tick (it takes a few milliseconds)
+    SMALL_TREE_FILES = 1000
+
+    def __init__(self, tree, interval=0.1):
+        self.tree = tree
+        self.interval = interval
+        self.sweep_interval = max(interval, self.SWEEP_INTERVAL)
+        self.small_tree_files = self.SMALL_TREE_FILES
+        self.directory_stats = dict((x, self._stat(x)) for x in tree.contexts)
+        self.file_stats = dict((x, self._stat(x)) for x in tree.files())
+        self.last_sweep = time.time()
+        # {file_name: time of its last change}
+        self.hot_files = {}
+
+    @staticmethod
+    def _stat(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return _stat_mtime_ns(stat), stat.st_size
+
+    def wait(self, timeout=None):
+        """Wait for changes, return (changed files, removed files) or None on timeout."""
+        deadline = None if timeout is None else time.time() + timeout
+        while deadline is None or time.time() < deadline:
+            time.sleep(self.interval)
+            now = time.time()
+            changed, removed = set(), set()
+            checked_files = set(self.tree.individual_files)
+            directory_stats = {}
+            for directory in list(self.tree.contexts):
+                if directory not in self.tree.contexts:
+                    # Removed during rescan of its parent
+                    continue
+                stat = directory_stats[directory] = self._stat(directory)
+                if stat != self.directory_stats.get(directory):
+                    added, directory_removed = self.tree.rescan_directory(directory)
+                    changed.update(added)
+                    removed.update(directory_removed)
+                    checked_files.update(self.tree.children.get(directory, (set(), set()))[0])
+            # New directories found during rescan
+            for directory in self.tree.contexts:
+                if directory not in directory_stats:
+                    directory_stats[directory] = self._stat(directory)
+            self.directory_stats = directory_stats
+            for file_name, changed_at in list(self.hot_files.items()):
+                if now - changed_at < self.HOT_PERIOD:
+                    checked_files.add(file_name)
+                else:
+                    del self.hot_files[file_name]
+            if len(self.file_stats) <= self.small_tree_files or now - self.last_sweep >= self.sweep_interval:
+                self.last_sweep = now
+                checked_files.update(self.tree.files())
+                checked_files.update(self.file_stats)
+            for file_name in checked_files | changed:
+                stat = self._stat(file_name)
+                if stat != self.file_stats.get(file_name):
+                    if stat is None:
+                        removed.add(file_name)
+                    else:
+                        changed.add(file_name)
+                        self.hot_files[file_name] = now
+                if stat is None:
+                    self.file_stats.pop(file_name, None)
+                else:
+                    self.file_stats[file_name] = stat
+            for file_name in removed:
+                self.file_stats.pop(file_name, None)
+                self.hot_files.pop(file_name, None)
+            if changed or removed:
+                return changed - removed, removed
+        return None
+
+    def close(self):
+        pass
+
+
+class _InotifyWatcher(object):
+    """Detect changes of watched tree with Linux inotify (via ctypes). Raises OSError if inotify is not available."""
+
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    # Time to collect related events (e.g. write to temporary file and rename) into one batch
+    BATCH_DELAY = 0.01
+
+    def __init__(self, tree):
+        import ctypes
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify is only available on Linux')
+        self.tree = tree
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init'):
+            raise OSError('inotify is not available')
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        # {watch descriptor: directory}, {directory: watch descriptor}
+        self.directories = {}
+        self.descriptors = {}
+        try:
+            self._sync_watches()
+        except OSError:
+            self.close()
+            raise
+
+    def _sync_watches(self):
+        """Watch all directories of the tree and parent directories of individual files.
+
+        Return list of newly watched directories.
+        """
+        import ctypes
+        directories = set(self.tree.contexts)
+        directories.update(os.path.dirname(x) for x in self.tree.individual_files)
+        new_directories = []
+        for directory in directories - set(self.descriptors):
+            path = directory.encode(sys.getfilesystemencoding()) if not isinstance(directory, bytes) else directory
+            descriptor = self.libc.inotify_add_watch(self.fd, path, self.WATCH_MASK)
+            if descriptor < 0:
+                error = ctypes.get_errno()
+                if os.path.isdir(directory):
+                    # E.g. ENOSPC: limit of watches is reached
+                    raise OSError(error, 'inotify_add_watch failed for %s' % directory)
+                continue
+            self.directories[descriptor] = directory
+            self.descriptors[directory] = descriptor
+            new_directories.append(directory)
+        return new_directories
+
+    def _read_events(self, timeout):
+        """Return list of (directory, mask, name) or None on timeout."""
+        import select
+        import struct
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return None
+        data = os.read(self.fd, 65536)
+        while select.select([self.fd], [], [], self.BATCH_DELAY)[0]:
+            data += os.read(self.fd, 65536)
+        events = []
+        offset = 0
+        while offset + 16 <= len(data):
+            descriptor, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+            offset += 16 + length
+            if sys.version_info[0] >= 3:
+                name = os.fsdecode(name)
+            events.append((self.directories.get(descriptor), mask, name))
+            if mask & self.IN_IGNORED:
+                # Watch was removed, e.g. directory was deleted
+                directory = self.directories.pop(descriptor, None)
+                self.descriptors.pop(directory, None)
+        return events
+
+    def wait(self, timeout=None):
+        """Wait for changes, return (changed files, removed files) or None on timeout."""
+        while True:
+            started = time.time()
+            events = self._read_events(timeout)
+            if events is None:
+                return None
+            touched_directories = set()
+            touched_files = set()
+            for directory, mask, name in events:
+                if mask & self.IN_Q_OVERFLOW:
+                    # Some events are lost, rescan everything
+                    touched_directories.update(self.tree.contexts)
+                    touched_files.update(self.tree.files())
+                elif directory is not None and name:
+                    touched_directories.add(directory)
+                    if not mask & self.IN_ISDIR:
+                        touched_files.add(os.path.join(directory, name))
+            changed, removed = set(), set()
+            for directory in touched_directories:
+                added, directory_removed = self.tree.rescan_directory(directory)
+                changed.update(added)
+                removed.update(directory_removed)
+            known_files = self.tree.files()
+            for file_name in touched_files:
+                if file_name in self.tree.individual_files and not os.path.isfile(file_name):
+                    removed.add(file_name)
+                elif file_name in known_files and file_name not in removed:
+                    changed.add(file_name)
+            # Files created in new directories before they were watched
+            new_directories = self._sync_watches()
+            while new_directories:
+                for directory in new_directories:
+                    added, directory_removed = self.tree.rescan_directory(directory)
+                    changed.update(added)
+                    removed.update(directory_removed)
+                new_directories = self._sync_watches()
+            if changed or removed:
+                return changed - removed, removed
+            if timeout is not None:
+                timeout = max(0, timeout - (time.time() - started))
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def watch_python_syntax(files_or_directories, python_version=None, engine='memory', jobs=1, cache_dir=None,
+                        include=None, exclude=None, gitignore=False, interval=0.1, use_inotify=True, timeout=None,
+                        max_compile_size=None, details=False, level='compile', max_output_size=DEFAULT_MAX_OUTPUT_SIZE):
+    """Check files, then keep watching them and re-check files as they change.
+
+    Changes are detected with inotify if available, otherwise by polling mtimes of files and directories.
+    If another interpreter is required, it's kept running as a persistent worker.
 
     Args:
-        files_or_directories: list of files or directories to check recursively
+        files_or_directories, python_version, engine, jobs, cache_dir, include, exclude, gitignore, max_compile_size,
+        details, level, max_output_size:
+            same as in check_python_syntax(), max_output_size applies to each check of changed files
 
     Kwargs:
-        python_version: target python version(s)
-            Allowed formats: '2.6' or (2,6) or [(2,6),(2,7)] or ['2.6','2.7'] or None
-            Actually supported versions are 2.6, 2.7 and 3.2+
-            If None, current interpreter is used.
-            If multiple versions are specified, first present version is used.
-        _use_this_python:
-            Return error if current python version differs from python_version
-            You should not use it.
+        interval: polling interval in seconds, if inotify is not used
+            Directories are checked every interval, but files which didn't change recently and whose directory
+            didn't change are checked only every _PollingWatcher.SWEEP_INTERVAL (1 second).
+        use_inotify: use inotify if available
+        timeout: stop watching if nothing changes for that many seconds, None means watch forever
 
-    Returns:
-        {file_path: [is_valid, message]}
+    Yields:
+        (file_path, [is_valid, message]) for all files, then for every changed or new file,
+        (file_path, None) when file is removed
 
     Raises:
         None
     """
+    watcher = None
     try:
-        # Find existing python version and executable
-        if python_version is not None:
-            found_python_version, python_executable = find_python_executable(python_version)
-            if found_python_version is None:
-                return {'<exception>': [False, 'No Python executable found for %r' % python_version]}
-            this_python_version = sys.version_info[:min(2, len(found_python_version))]
-        else:
-            this_python_version = sys.version_info[:2]
-        # If this python version is not right, execute required python interpreter in subprocess
-        if python_version is not None and found_python_version != this_python_version:
-            # Safeguard against infinite recursion
-            if _use_this_python:
-                return {'<exception>': [False, 'We are in %s instead of %s' % (this_python_version, found_python_version)]}
-            # Ugly workaround for "RuntimeError: Bad magic number in .pyc file" error
-            # (without it, confusing behavior occurs: first run of "python tests.py" is OK and second run fails
-            py_file = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
-            pyc_file = os.path.splitext(os.path.abspath(__file__))[0] + '.pyc'
-            if os.path.isfile(pyc_file):
-                os.remove(pyc_file)
-            # Run under specified interpreter
-            try:
-                process = subprocess.Popen([python_executable, '-B', py_file] + list(files_or_directories),
-                                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                process.wait()
-                output = process.stdout.read().decode()
-                process.stdout.close()
-            except OSError as ex:
-                return {'<exception>': [False, 'Failed to execute %s: %s' % (python_executable, ex)]}
+        engine, feature_version = _select_engine(level, engine, python_version)
+        python_executable, error_message = _find_target_python(python_version, feature_version=feature_version)
+        if error_message:
+            yield '<exception>', [False, error_message]
+            return
+        tree = _WatchedTree(files_or_directories, include=include, exclude=exclude, gitignore=gitignore)
+        # Watching starts before initial check, so that no change is lost
+        if use_inotify:
             try:
-                return json.loads(output)
-            except ValueError:
-                return {'<exception>': [False, 'Failed to load JSON: ' + repr(output)]}
-        else:
-            return _check_all_files(files_or_directories)
+                watcher = _InotifyWatcher(tree)
+            except (OSError, AttributeError):
+                watcher = None
+        if watcher is None:
+            watcher = _PollingWatcher(tree, interval)
+        for target in tree.not_found:
+            yield target, [False, 'Target not found']
+        # Current results, kept to report removed files
+        results = {}
+        file_names = sorted(tree.files())
+        while True:
+            for file_name, result in _iter_compile_in_target(python_executable, file_names, engine=engine, jobs=jobs,
+                                                             cache_dir=cache_dir, max_compile_size=max_compile_size,
+                                                             feature_version=feature_version,
+                                                             max_output_size=max_output_size):
+                results[file_name] = result
+                yield file_name, result if details else result[:2]
+            changes = watcher.wait(timeout)
+            if changes is None:
+                return
+            changed, removed = changes
+            for file_name in sorted(removed):
+                if results.pop(file_name, None) is not None:
+                    yield file_name, None
+            file_names = sorted(changed)
+    except WorkerError as ex:
+        yield '<exception>', [False, str(ex)]
+    except Exception as ex:
+        yield '<exception>', [False, format_exception(ex)]
+    finally:
+        if watcher is not None:
+            watcher.close()
+
+
+# Keyword arguments of check_python_syntax which can be sent to daemon
+DAEMON_OPTIONS = ('python_version', 'engine', 'jobs', 'cache_dir', 'include', 'exclude', 'gitignore', 'changed_since',
+                  'staged', 'timeout', 'max_output_size', 'stats', 'max_compile_size', 'errors_only', 'details',
+                  'max_errors', 'level')
+
+
+# Seconds to wait for daemon to accept connection and to answer status request
+DAEMON_CONNECT_TIMEOUT = 1.0
+# Seconds to wait for daemon to check files after it accepted request, then error is returned
+DAEMON_TIMEOUT = 300.0
+
+
+def default_socket_path():
+    """Return default path of Unix socket of daemon (see serve_daemon)."""
+    return os.path.join(default_cache_dir(), 'daemon.sock')
+
+
+def serve_daemon(socket_path=None):
+    """Check files on requests from Unix socket, until shutdown request or KeyboardInterrupt (or SIGTERM).
+
+    Interpreter registry and persistent workers of target interpreters stay in memory between requests,
+    so editors and git hooks don't pay for startup of Python processes. Requests of different connections
+    are handled in threads, requests of one connection are answered in order.
+
+    Concurrency is limited, so it mostly saves startup time rather than speeds up simultaneous requests:
+    current directory is shared by threads, so requests from different directories wait for each other;
+    persistent worker of each target interpreter answers one request at a time; files checked by daemon
+    itself (current interpreter) are compiled under GIL, unless jobs starts separate processes.
+
+    Protocol is line-delimited JSON, one response line for each request line:
+    Request: {"cwd": ..., "files": [...], keyword arguments of check_python_syntax (see DAEMON_OPTIONS)}
+    Response: {file_path: [is_valid, message]}, same as check_python_syntax() returns in "cwd" directory
+    {"status": true} request returns {"pid": ..., "version": ..., "python": ..., "workers": [python_executable, ...]},
+    {"shutdown": true} request stops daemon.
+
+    Args:
+        socket_path: path of Unix socket, default_socket_path() by default
+
+    Raises:
+        ImportError if asyncio is not available (Python < 3.4)
+        RuntimeError if another daemon is already listening on socket_path, or it's not a socket
+    """
+    import asyncio
+    socket_path = socket_path or default_socket_path()
+    if _daemon_request(socket_path, {'status': True}) is not None:
+        raise RuntimeError('Daemon is already running at %s' % socket_path)
+    directory = os.path.dirname(os.path.abspath(socket_path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if _is_socket(socket_path):
+        # Left by killed daemon
+        os.remove(socket_path)
+    elif os.path.lexists(socket_path):
+        raise RuntimeError('%s exists and is not a socket' % socket_path)
+    loop = asyncio.new_event_loop()
+    directory_lock = _DirectoryLock(os.getcwd())
+    connections = set()
+
+    def create_protocol():
+        protocol = _DaemonProtocol(loop, directory_lock)
+        connections.add(protocol)
+        return protocol
+
+    server = loop.run_until_complete(loop.create_unix_server(create_protocol, socket_path))
+    try:
+        try:
+            import signal
+            loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        except (NotImplementedError, RuntimeError, ValueError):
+            # Not in main thread or not supported on this platform
+            pass
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        for protocol in connections:
+            if protocol.transport is not None:
+                protocol.transport.close()
+        loop.close()
+        if _is_socket(socket_path):
+            os.remove(socket_path)
+        _worker_pool.close()
+
+
+def _is_socket(path):
+    """Return True if path is a Unix socket (not following symlinks)."""
+    import stat
+    try:
+        return stat.S_ISSOCK(os.lstat(path).st_mode)
+    except OSError:
+        return False
+
+
+class _DaemonProtocol(object):
+    """asyncio protocol of daemon connection (see serve_daemon).
+
+    Requests are compiled in threads of loop's default executor, event loop only reads and writes lines
+    and answers status requests.
+    """
+
+    def __init__(self, loop, directory_lock):
+        self.loop = loop
+        self.directory_lock = directory_lock
+        self.transport = None
+        self.buffer = b''
+        self.requests = []
+        self.busy = False
+        self.eof = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+        self.requests.extend(x for x in lines if x.strip())
+        self._next_request()
+
+    def eof_received(self):
+        # Half-closed connection is kept open until pending requests are answered
+        self.eof = True
+        self._next_request()
+        return True
+
+    def connection_lost(self, exc):
+        self.transport = None
+
+    def pause_writing(self):
+        pass
+
+    def resume_writing(self):
+        pass
+
+    def _next_request(self):
+        if self.busy:
+            return
+        if not self.requests:
+            if self.eof and self.transport is not None:
+                self.transport.close()
+            return
+        try:
+            request = json.loads(self.requests.pop(0).decode('utf-8'))
+        except ValueError as ex:
+            self._respond({'<exception>': [False, 'Failed to load JSON: %s' % ex]})
+            self._next_request()
+            return
+        if request.get('shutdown'):
+            self._respond({'shutdown': True})
+            self.loop.call_soon(self.loop.stop)
+            return
+        if request.get('status'):
+            self._respond(_daemon_status())
+            self._next_request()
+            return
+        self.busy = True
+        self.loop.run_in_executor(None, _handle_daemon_request, request, self.directory_lock).add_done_callback(
+            self._request_done)
+
+    def _request_done(self, future):
+        self.busy = False
+        self._respond(future.result())
+        self._next_request()
+
+    def _respond(self, response):
+        if self.transport is not None:
+            self.transport.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class _DirectoryLock(object):
+    """Current directory shared by threads: threads which need the same directory work concurrently,
+    threads which need another directory wait until they finish."""
+
+    def __init__(self, default_directory):
+        self.default_directory = default_directory
+        self.condition = threading.Condition()
+        self.directory = None
+        self.users = 0
+
+    def acquire(self, directory=None):
+        directory = directory or self.default_directory
+        with self.condition:
+            while self.users and self.directory != directory:
+                self.condition.wait()
+            if not self.users:
+                os.chdir(directory)
+                self.directory = directory
+            self.users += 1
+
+    def release(self):
+        with self.condition:
+            self.users -= 1
+            self.condition.notify_all()
+
+
+def _daemon_status():
+    """Return response to status request of daemon (see serve_daemon)."""
+    with _worker_pool.lock:
+        workers = sorted(_worker_pool.workers)
+    return {'pid': os.getpid(), 'version': __version__, 'checker_version': _checker_version(),
+            'python': '%d.%d.%d' % sys.version_info[:3], 'workers': workers}
+
+
+def _handle_daemon_request(request, directory_lock):
+    """Return response to check request of daemon (see serve_daemon)."""
+    try:
+        options = dict((x, request[x]) for x in DAEMON_OPTIONS if x in request)
+        directory_lock.acquire(request.get('cwd'))
+        try:
+            return check_python_syntax(request['files'], persistent_worker=True, **options)
+        finally:
+            directory_lock.release()
     except Exception as ex:
         return {'<exception>': [False, format_exception(ex)]}
 
 
-if __name__ == '__main__':
+class DaemonError(Exception):
+    """Daemon accepted request, but didn't answer it in time or closed connection."""
+
+
+def _daemon_request(socket_path, request, timeout=DAEMON_CONNECT_TIMEOUT, check_version=False):
+    """Send request to daemon and return its response, None if daemon is not running, dies
+    or doesn't answer in timeout seconds.
+
+    check_version: return None without sending request if daemon runs another version of this module
+        or of Python (its results may differ from results of current process). Once daemon has confirmed
+        its version, DaemonError is raised instead of returning None, so that caller doesn't check files again.
+    """
+    import socket
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    status = None
+    try:
+        connection.settimeout(DAEMON_CONNECT_TIMEOUT)
+        connection.connect(socket_path)
+        if check_version:
+            connection.sendall(b'{"status": true}\n')
+            status = _receive_json_line(connection)
+            if status is None or status.get('version') != __version__ or \
+                    status.get('checker_version') != _checker_version() or \
+                    status.get('python') != '%d.%d.%d' % sys.version_info[:3]:
+                return None
+        connection.settimeout(timeout)
+        connection.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        response = _receive_json_line(connection)
+    except (IOError, OSError) as ex:
+        if check_version and status is not None:
+            raise DaemonError('Daemon failed to answer request: %s' % ex)
+        return None
+    finally:
+        connection.close()
+    if response is None and check_version:
+        raise DaemonError('Daemon closed connection without answer')
+    return response
+
+
+def _receive_json_line(connection):
+    """Return JSON document of one line received from socket, None if connection is closed or it's not JSON.
+
+    Daemon sends nothing but responses to requests, so line is not followed by more data.
+    """
+    chunks = []
+    while not chunks or not chunks[-1].endswith(b'\n'):
+        chunk = connection.recv(65536)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+    try:
+        return json.loads(b''.join(chunks).decode('utf-8'))
+    except ValueError:
+        return None
+
+
+def check_python_syntax_via_daemon(files_or_directories, socket_path=None, **kwargs):
+    """Check files in daemon (see serve_daemon) if it's running, otherwise in current process.
+
+    Files are checked in current process as well if daemon runs another version of this module or of Python,
+    or doesn't answer status request in DAEMON_CONNECT_TIMEOUT seconds. If daemon accepted request, but
+    doesn't answer it in DAEMON_TIMEOUT seconds or dies, '<exception>' item is returned instead.
+
+    Args:
+        files_or_directories: list of files or directories to check recursively
+
+    Kwargs:
+        socket_path: path of Unix socket of daemon, default_socket_path() by default
+        other arguments: same as in check_python_syntax(), only those listed in DAEMON_OPTIONS
+
+    Returns:
+        Same as check_python_syntax()
+
+    Raises:
+        TypeError if unsupported argument is given
+    """
+    unsupported = sorted(set(kwargs) - set(DAEMON_OPTIONS))
+    if unsupported:
+        raise TypeError('Arguments not supported by daemon: %s' % ', '.join(unsupported))
+    request = dict(kwargs, cwd=os.getcwd(), files=list(files_or_directories))
+    try:
+        response = _daemon_request(socket_path or default_socket_path(), request, DAEMON_TIMEOUT, check_version=True)
+    except DaemonError as ex:
+        return {'<exception>': [False, str(ex)]}
+    if response is None:
+        return check_python_syntax(files_or_directories, **kwargs)
+    return response
+
+
+# Items of results which are not files
+SPECIAL_RESULTS = ('<exception>', '<summary>', '<stats>')
+
+
+def sarif_report(result):
+    """Return SARIF 2.1.0 log (JSON-serializable dict) of result of check_python_syntax(..., details=True).
+
+    Each invalid file is reported as an error with region of its details, rule id is the exception class name
+    (files which were not found have no rule). Unexpected errors are reported as tool execution notifications.
+    """
+    results = []
+    rules = {}
+    for file_name in sorted(result):
+        if file_name in SPECIAL_RESULTS or result[file_name][0]:
+            continue
+        file_result = result[file_name]
+        details = file_result[2] if len(file_result) > 2 else {}
+        location = {'artifactLocation': {'uri': _file_uri(file_name)}}
+        if details.get('line'):
+            region = {'startLine': details['line']}
+            for key, region_key in (('column', 'startColumn'), ('end_line', 'endLine'), ('end_column', 'endColumn')):
+                if details.get(key):
+                    region[region_key] = details[key]
+            if details.get('text') is not None:
+                region['snippet'] = {'text': details['text']}
+            location['region'] = region
+        sarif_result = {'level': 'error', 'message': {'text': details.get('message') or file_result[1]},
+                        'locations': [{'physicalLocation': location}]}
+        if details.get('type'):
+            sarif_result['ruleId'] = details['type']
+            rules.setdefault(details['type'], {'id': details['type'], 'shortDescription': {'text': details['type']}})
+        results.append(sarif_result)
+    invocation = {'executionSuccessful': '<exception>' not in result}
+    if '<exception>' in result:
+        invocation['toolExecutionNotifications'] = [{'level': 'error',
+                                                     'message': {'text': result['<exception>'][1]}}]
+    run = {
+        'tool': {'driver': {'name': 'check-python-syntax', 'version': __version__,
+                            'informationUri': 'https://github.com/alexanderlukanin13/check-python-syntax',
+                            'rules': [rules[x] for x in sorted(rules)]}},
+        'invocations': [invocation],
+        'results': results,
+    }
+    properties = dict((name[1:-1], result[name][1]) for name in ('<summary>', '<stats>') if name in result)
+    if properties:
+        run['properties'] = properties
+    return {'$schema': 'https://json.schemastore.org/sarif-2.1.0.json', 'version': '2.1.0', 'runs': [run]}
+
+
+def _file_uri(file_name):
+    """Return URI reference of file for SARIF: relative for relative paths, file:// URI for absolute ones."""
+    try:
+        from urllib import pathname2url
+    except ImportError:
+        from urllib.request import pathname2url
+    uri = pathname2url(file_name)
+    if os.path.isabs(file_name):
+        return 'file:' + ('' if uri.startswith('///') else '//') + uri
+    return uri
+
+
+# Characters which are not allowed in XML 1.0
+XML_INVALID_CHARACTERS_REGEX = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def junit_report(result):
+    """Return JUnit XML report (text) of result of check_python_syntax(..., details=True).
+
+    Every file is a test case, invalid files are failures, unexpected error is reported as error.
+    If result has '<summary>' item (errors_only=True), valid files are not listed, but counted in "tests".
+    """
+    from xml.sax.saxutils import escape, quoteattr
+
+    def text(value):
+        if isinstance(value, bytes):
+            value = value.decode('utf-8', 'replace')
+        return XML_INVALID_CHARACTERS_REGEX.sub('?', value)
+
+    def last_line(message):
+        lines = message.strip().splitlines()
+        return lines[-1] if lines else message
+
+    test_cases = []
+    failures = 0
+    for file_name in sorted(result):
+        if file_name in SPECIAL_RESULTS:
+            continue
+        file_result = result[file_name]
+        test_case = '<testcase classname="check_python_syntax" name=%s' % quoteattr(text(file_name))
+        if file_result[0]:
+            test_cases.append(test_case + ' />')
+            continue
+        failures += 1
+        details = file_result[2] if len(file_result) > 2 else {}
+        message = details.get('message') or last_line(file_result[1])
+        if details.get('line'):
+            message += ' (line %d%s)' % (details['line'], ', column %d' % details['column'] if details.get('column') else '')
+        test_cases.append('%s><failure type=%s message=%s>%s</failure></testcase>' % (
+            test_case, quoteattr(text(details.get('type') or 'Error')), quoteattr(text(message)),
+            escape(text(file_result[1]))))
+    errors = 0
+    if '<exception>' in result:
+        errors = 1
+        message = result['<exception>'][1]
+        test_cases.append('<testcase classname="check_python_syntax" name="&lt;exception&gt;">'
+                          '<error message=%s>%s</error></testcase>' % (quoteattr(text(last_line(message))),
+                                                                       escape(text(message))))
+    tests = len(test_cases)
+    if '<summary>' in result:
+        tests = result['<summary>'][1]['files'] + errors
+    elapsed = ''
+    if '<stats>' in result:
+        elapsed = ' time="%.3f"' % result['<stats>'][1]['stages']['total']['wall']
+    lines = ['<?xml version="1.0" encoding="utf-8"?>', '<testsuites>',
+             '<testsuite name="check_python_syntax" tests="%d" failures="%d" errors="%d"%s>'
+             % (tests, failures, errors, elapsed)]
+    lines.extend(test_cases)
+    lines.extend(['</testsuite>', '</testsuites>', ''])
+    return '\n'.join(lines)
+
+
+def _write_result(result, output_format, pretty=False):
+    """Write result of check to stdout in given format: 'json', 'sarif' or 'junit'."""
+    formatting_kwargs = {'sort_keys': True, 'indent': 4, 'separators': (',', ': ')} if pretty else {}
+    if output_format == 'junit':
+        stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+        stdout.write(junit_report(result).encode('utf-8'))
+        stdout.flush()
+        return
+    json.dump(sarif_report(result) if output_format == 'sarif' else result, sys.stdout, **formatting_kwargs)
+    print('')
+
+
+def main(argv=None):
+    """Command line entry point, argv: arguments without program name (sys.argv[1:] by default)."""
+    argv = sys.argv[1:] if argv is None else argv
+    # Another interpreter runs this module as worker or child (see _module_command), without parsing options
+    if argv == ['--worker']:
+        _serve_worker()
+        sys.exit(0)
     try:
         import argparse
     except ImportError:
@@ -206,20 +3461,185 @@ if __name__ == '__main__':
         print('')
         sys.exit(1)
     arguments_parser = argparse.ArgumentParser(description='Perform basic validation (by compilation) of version-specific Python syntax')
-    arguments_parser.add_argument('files_or_dirs', nargs='+', help='Python files or directories')
+    arguments_parser.add_argument('files_or_dirs', nargs='*', help='Python files or directories')
     arguments_parser.add_argument('-v', '--version', nargs='?', help='Python version to use (must be installed)')
+    arguments_parser.add_argument('--all-versions', dest='all_versions', metavar='VERSIONS',
+                                  help='check all given Python versions concurrently, e.g. 2.7,3.6,3.12')
     arguments_parser.add_argument('-p', '--pretty', action='store_true', help='output pretty JSON')
-    arguments_parser.add_argument('--use-this-python', action='store_true', dest='use_this_python', help=argparse.SUPPRESS)
+    arguments_parser.add_argument('-f', '--format', choices=['json', 'ndjson', 'sarif', 'junit'], default='json',
+                                  help='output single JSON document (default), stream one JSON record per file, '
+                                       'or output SARIF or JUnit XML report')
+    arguments_parser.add_argument('--engine', choices=sorted(COMPILE_ENGINES), default='memory',
+                                  help='compile files in memory (default) or with py_compile')
+    arguments_parser.add_argument('--level', choices=LEVELS + ('emulate',), default='compile',
+                                  help='how thoroughly files are checked: only tokenize, only parse, or compile '
+                                       '(default); emulate approximates older Python 3 without running it')
+    arguments_parser.add_argument('-j', '--jobs', type=int, default=1,
+                                  help='number of parallel processes, 0 means number of CPUs (default: 1)')
+    arguments_parser.add_argument('--cache-dir', default=default_cache_dir(),
+                                  help='directory of persistent result cache, not used for a single file (default: %(default)s)')
+    arguments_parser.add_argument('--no-cache', action='store_true', dest='no_cache', help="don't use result cache (versions of interpreters are still cached)")
+    arguments_parser.add_argument('--include', action='append', metavar='PATTERN',
+                                  help='check files matching glob pattern in directories (default: *.py)')
+    arguments_parser.add_argument('--exclude', action='append', default=[], metavar='PATTERN',
+                                  help='skip files and directories matching glob pattern')
+    arguments_parser.add_argument('--no-default-excludes', action='store_true', dest='no_default_excludes',
+                                  help="don't skip VCS, cache and virtualenv directories by default")
+    arguments_parser.add_argument('--no-gitignore', action='store_false', dest='gitignore',
+                                  help="don't skip files ignored by .gitignore")
+    arguments_parser.add_argument('--changed-since', dest='changed_since', metavar='REV',
+                                  help='check only files changed in git since given revision')
+    arguments_parser.add_argument('--staged', action='store_true', help='check only files staged in git index')
+    arguments_parser.add_argument('-w', '--watch', action='store_true',
+                                  help='check files, then keep watching them and stream results of changed files (NDJSON); '
+                                       'without inotify, in-place edits in trees of over 1000 files may take '
+                                       'up to a second to notice')
+    arguments_parser.add_argument('--timeout', type=float,
+                                  help='maximum time in seconds for another interpreter to check all files')
+    arguments_parser.add_argument('--max-output-size', type=int, dest='max_output_size', metavar='BYTES',
+                                  default=DEFAULT_MAX_OUTPUT_SIZE,
+                                  help='maximum size of output of another interpreter, 0 means no limit (default: 1 GiB)')
+    arguments_parser.add_argument('--sources-from-stdin', action='store_true', dest='sources_from_stdin',
+                                  help='check in-memory sources given in stdin as JSON: '
+                                       '{"sources": [[name, base64-encoded source], ...]}')
+    arguments_parser.add_argument('--max-compile-size', type=int, dest='max_compile_size', metavar='BYTES',
+                                  help='only tokenize files larger than that, to limit memory usage')
+    arguments_parser.add_argument('--errors-only', action='store_true', dest='errors_only',
+                                  help='output only invalid files and "<summary>" item with numbers of files')
+    arguments_parser.add_argument('--max-errors', type=int, dest='max_errors', metavar='N',
+                                  help='stop as soon as N invalid files are found and output partial results')
+    arguments_parser.add_argument('--fail-fast', action='store_const', const=1, dest='max_errors',
+                                  help='stop at the first invalid file, same as --max-errors 1')
+    arguments_parser.add_argument('--details', action='store_true',
+                                  help='add structured details (line, column, end position, error class, source line) '
+                                       'to results of invalid files')
+    arguments_parser.add_argument('--stats', action='store_true',
+                                  help='add "<stats>" item with timing of each stage, counters and slowest files')
+    arguments_parser.add_argument('--serve', action='store_true',
+                                  help='run daemon which checks files on requests from Unix socket (see --client)')
+    arguments_parser.add_argument('--client', action='store_true',
+                                  help='check files in daemon if it is running, otherwise in this process')
+    arguments_parser.add_argument('--socket', default=default_socket_path(),
+                                  help='Unix socket of daemon (default: %(default)s)')
 
-    arguments = arguments_parser.parse_args(sys.argv[1:])
+    arguments = arguments_parser.parse_args(argv)
 
-    result = check_python_syntax(arguments.files_or_dirs, python_version=arguments.version, _use_this_python=arguments.use_this_python)
+    cache_dir = None if arguments.no_cache else arguments.cache_dir
+    # Opening result cache costs more than compiling a single file, as editors and git hooks usually check it
+    if len(arguments.files_or_dirs) == 1 and os.path.isfile(arguments.files_or_dirs[0]):
+        cache_dir = None
+    walk_options = dict(include=arguments.include, gitignore=arguments.gitignore, changed_since=arguments.changed_since,
+                        staged=arguments.staged,
+                        exclude=arguments.exclude if arguments.no_default_excludes else DEFAULT_EXCLUDE + arguments.exclude)
+    # Versions of interpreters are cached even with --no-cache, probing them is slower than checking a file
+    use_interpreter_cache_file(os.path.join(arguments.cache_dir, 'interpreters.json'))
+    if arguments.format != 'json' and arguments.all_versions:
+        arguments_parser.error('--format %s is not supported with --all-versions' % arguments.format)
+    if arguments.format in ('sarif', 'junit') and arguments.watch:
+        arguments_parser.error('--format %s is not supported with --watch' % arguments.format)
+    # Reports are built from details
+    details = arguments.details or arguments.format in ('sarif', 'junit')
+    if arguments.serve:
+        if arguments.files_or_dirs or arguments.client:
+            arguments_parser.error('--serve is not supported with files and --client')
+        try:
+            serve_daemon(arguments.socket)
+        except ImportError:
+            arguments_parser.error('--serve requires asyncio (Python 3.4+)')
+        except RuntimeError as ex:
+            arguments_parser.error(str(ex))
+        sys.exit(0)
+    if arguments.client and (arguments.sources_from_stdin or arguments.all_versions or arguments.watch or
+                             arguments.format == 'ndjson'):
+        arguments_parser.error('--client is not supported with --sources-from-stdin, --all-versions, --watch '
+                               'and --format ndjson')
+    if not arguments.files_or_dirs and not arguments.sources_from_stdin:
+        arguments_parser.error('no files or directories given')
+    if arguments.max_errors is not None and arguments.max_errors < 1:
+        arguments_parser.error('--max-errors must be positive')
+    limits = {'timeout': arguments.timeout, 'max_output_size': arguments.max_output_size or None}
+    if arguments.sources_from_stdin:
+        if arguments.files_or_dirs or arguments.all_versions or arguments.watch:
+            arguments_parser.error('--sources-from-stdin is not supported with files, --all-versions and --watch')
+        result = check_python_sources(_decode_sources(json.load(sys.stdin)['sources']), python_version=arguments.version,
+                                      jobs=arguments.jobs, stats=arguments.stats, max_compile_size=arguments.max_compile_size,
+                                      errors_only=arguments.errors_only, details=details,
+                                      max_errors=arguments.max_errors, level=arguments.level, **limits)
+        if arguments.format == 'ndjson':
+            for name in sorted(result, key=lambda x: (x in ('<summary>', '<stats>'), x)):
+                json.dump(_ndjson_record(name, result[name]), sys.stdout)
+                sys.stdout.write('\n')
+        else:
+            _write_result(result, arguments.format, arguments.pretty)
+        sys.exit(int(any(not x[0] for x in itervalues(result))))
+    if arguments.stats and (arguments.all_versions or arguments.watch):
+        arguments_parser.error('--stats is not supported with --all-versions and --watch')
+    if arguments.errors_only and arguments.watch:
+        arguments_parser.error('--errors-only is not supported with --watch')
+    if arguments.max_errors is not None and arguments.watch:
+        arguments_parser.error('--max-errors and --fail-fast are not supported with --watch')
+    if arguments.watch:
+        if arguments.all_versions or arguments.changed_since or arguments.staged:
+            arguments_parser.error('--watch is not supported with --all-versions, --changed-since and --staged')
+        # Stream results forever, until interrupted
+        results = {}
+        try:
+            for file_name, file_result in watch_python_syntax(
+                    arguments.files_or_dirs, python_version=arguments.version, engine=arguments.engine,
+                    jobs=arguments.jobs, cache_dir=cache_dir, include=arguments.include, exclude=walk_options['exclude'],
+                    gitignore=arguments.gitignore, max_compile_size=arguments.max_compile_size, details=details,
+                    level=arguments.level, max_output_size=limits['max_output_size']):
+                if file_result is None:
+                    results.pop(file_name, None)
+                    json.dump({'file': file_name, 'removed': True}, sys.stdout)
+                else:
+                    results[file_name] = file_result
+                    json.dump(_ndjson_record(file_name, file_result), sys.stdout)
+                sys.stdout.write('\n')
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(int(any(not x[0] for x in itervalues(results))))
+    if arguments.format == 'ndjson':
+        # Stream results as they arrive, one JSON record per line
+        failed = False
+        for file_name, file_result in iter_check_python_syntax(
+                arguments.files_or_dirs, python_version=arguments.version, engine=arguments.engine, jobs=arguments.jobs,
+                cache_dir=cache_dir, stats=arguments.stats, max_compile_size=arguments.max_compile_size,
+                errors_only=arguments.errors_only, details=details, max_errors=arguments.max_errors,
+                level=arguments.level, **dict(walk_options, **limits)):
+            failed = failed or not file_result[0]
+            json.dump(_ndjson_record(file_name, file_result), sys.stdout)
+            sys.stdout.write('\n')
+            sys.stdout.flush()
+        sys.exit(int(failed))
+    if arguments.all_versions:
+        result = check_all_python_versions(arguments.files_or_dirs, arguments.all_versions, engine=arguments.engine,
+                                           jobs=arguments.jobs, cache_dir=cache_dir,
+                                           max_compile_size=arguments.max_compile_size, errors_only=arguments.errors_only,
+                                           details=details, max_errors=arguments.max_errors, level=arguments.level,
+                                           **dict(walk_options, **limits))
+        all_results = list(itervalues(result))
+    elif arguments.client:
+        result = check_python_syntax_via_daemon(
+            arguments.files_or_dirs, socket_path=arguments.socket, python_version=arguments.version,
+            engine=arguments.engine, jobs=arguments.jobs, cache_dir=cache_dir, stats=arguments.stats,
+            max_compile_size=arguments.max_compile_size, errors_only=arguments.errors_only, details=details,
+            max_errors=arguments.max_errors, level=arguments.level, **dict(walk_options, **limits))
+        all_results = [result]
+    else:
+        result = check_python_syntax(arguments.files_or_dirs, python_version=arguments.version, engine=arguments.engine,
+                                     jobs=arguments.jobs, cache_dir=cache_dir, stats=arguments.stats,
+                                     max_compile_size=arguments.max_compile_size, errors_only=arguments.errors_only,
+                                     details=details, max_errors=arguments.max_errors, level=arguments.level,
+                                     **dict(walk_options, **limits))
+        all_results = [result]
     # If executed by user, prettify output
-    formatting_kwargs = {}
-    if arguments.pretty:
-        formatting_kwargs = {'sort_keys': True, 'indent': 4, 'separators': (',', ': ')}
-    json.dump(result, sys.stdout, **formatting_kwargs)
-    print('')
+    _write_result(result, arguments.format, arguments.pretty)
 
     # Return 1 if there is at least one error, 0 if all is OK
-    sys.exit(int(any(not x[0] for x in itervalues(result))))
\ No newline at end of file
+    sys.exit(int(any(not x[0] for version_result in all_results for x in itervalues(version_result))))
+
+
+if __name__ == '__main__':
+    main()
@@ -17,6 +17,8 @@ setup(
     url='https://github.com/alexanderlukanin13/check-python-syntax',
     py_modules=['check_python_syntax'],
     scripts=['check_python_syntax.py'],
+    # Unlike script, module imported by entry point is not compiled on every run
+    entry_points={'console_scripts': ['check-python-syntax = check_python_syntax:main']},
     classifiers=(
         'Development Status :: 3 - Alpha',
         'Intended Audience :: Developers',
@@ -1,10 +1,14 @@
 #!/usr/bin/env python
+import json
 import os
 import re
 import shutil
+import socket
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import unittest
 
 import check_python_syntax
@@ -36,63 +40,113 @@ class NormalizeVersionsTest(unittest.TestCase):
         self.assertRaises(TypeError, check_python_syntax._normalize_versions_list, [object()])
 
 
-class SubprocessMock(object):
+class FakeInterpretersTest(unittest.TestCase):
+    """Base class for test cases which need fake Python interpreters in PATH.
 
-    PIPE = subprocess.PIPE
-    STDOUT = subprocess.STDOUT
+    Set self.pythons = {name: version} to create shell scripts which print given version
+    """
 
-    def __init__(self):
-        self.pythons = []
+    def setUp(self):
+        if os.name != 'posix':
+            self.skipTest('Fake interpreters are shell scripts')
+        self.bin_dir = os.path.join(tempfile.gettempdir(), 'check-python-syntax-bin')
+        self._interpreter_registry = check_python_syntax._interpreter_registry
 
-    def Popen(self, arguments, stdout=None, stderr=None):
-        class DummyFile(object):
-            def close(self):
-                pass
-        class process_mock(object):
-            def __init__(self):
-                self.stdout = DummyFile()
-            def wait(self):
-                pass
-        if arguments[0] not in self.pythons:
-            raise OSError()
-        return process_mock()
+    def tearDown(self):
+        check_python_syntax._interpreter_registry = self._interpreter_registry
+        if os.path.isdir(self.bin_dir):
+            shutil.rmtree(self.bin_dir)
 
+    def set_pythons(self, pythons):
+        if os.path.isdir(self.bin_dir):
+            shutil.rmtree(self.bin_dir)
+        os.mkdir(self.bin_dir)
+        for name, version in pythons.items():
+            path = os.path.join(self.bin_dir, name)
+            with open(path, 'w') as file:
+                file.write('#!/bin/sh\necho %s\n' % version)
+            os.chmod(path, 0o755)
+        check_python_syntax._interpreter_registry = check_python_syntax.InterpreterRegistry(search_path=[self.bin_dir])
 
-class FindPythonExecutableTest(unittest.TestCase):
-    def setUp(self):
-        check_python_syntax.subprocess = self.subprocess_mock = SubprocessMock()
+    pythons = property(fset=set_pythons)
 
-    def tearDown(self):
-        check_python_syntax.subprocess = subprocess
+    def path(self, name):
+        return os.path.join(self.bin_dir, name)
 
+
+class FindPythonExecutableTest(FakeInterpretersTest):
     def test(self):
         # 2
-        self.subprocess_mock.pythons = ['python']
-        self.assertEqual(((2,), 'python'), check_python_syntax.find_python_executable([(2,)]))
+        self.pythons = {'python': '2.7'}
+        self.assertEqual(((2,), self.path('python')), check_python_syntax.find_python_executable([(2,)]))
         # 2.6
-        self.subprocess_mock.pythons = ['python2.6']
-        self.assertEqual(((2,6), 'python2.6'), check_python_syntax.find_python_executable([(2,6), (2,7)]))
-        self.subprocess_mock.pythons = ['python26']
-        self.assertEqual(((2,6), 'python26'), check_python_syntax.find_python_executable([(2,6), (2,7)]))
-        self.subprocess_mock.pythons = ['python']
+        self.pythons = {'python2.6': '2.6'}
+        self.assertEqual(((2,6), self.path('python2.6')), check_python_syntax.find_python_executable([(2,6), (2,7)]))
+        self.pythons = {'python26': '2.6'}
+        self.assertEqual(((2,6), self.path('python26')), check_python_syntax.find_python_executable([(2,6), (2,7)]))
+        self.pythons = {'python': '2.5'}
         self.assertEqual((None, None), check_python_syntax.find_python_executable([(2,6), (2,7)]))
         # 3
-        self.subprocess_mock.pythons = ['python2.6', 'python3', 'python3.2']
-        self.assertEqual(((3,), 'python3'), check_python_syntax.find_python_executable([(3,)]))
-        self.subprocess_mock.pythons = ['python26', 'python3', 'python32']
-        self.assertEqual(((3,), 'python3'), check_python_syntax.find_python_executable([(3,)]))
-        self.subprocess_mock.pythons = ['python', 'python3']
-        self.assertEqual(((3,), 'python3'), check_python_syntax.find_python_executable([(3,)]))
-        self.subprocess_mock.pythons = ['python']
+        self.pythons = {'python2.6': '2.6', 'python3': '3.2', 'python3.2': '3.2'}
+        self.assertEqual(((3,), self.path('python3')), check_python_syntax.find_python_executable([(3,)]))
+        self.pythons = {'python26': '2.6', 'python3': '3.2', 'python32': '3.2'}
+        self.assertEqual(((3,), self.path('python3')), check_python_syntax.find_python_executable([(3,)]))
+        self.pythons = {'python': '2.7', 'python3': '3.3'}
+        self.assertEqual(((3,), self.path('python3')), check_python_syntax.find_python_executable([(3,)]))
+        self.pythons = {'python': '2.7'}
         self.assertEqual((None, None), check_python_syntax.find_python_executable([(3,)]))
         # Only second one is present
-        self.subprocess_mock.pythons = ['python3', 'python3.3']
-        self.assertEqual(((3,3), 'python3.3'), check_python_syntax.find_python_executable([(3,4), (3,3)]))
+        self.pythons = {'python3': '3.3', 'python3.3': '3.3'}
+        self.assertEqual(((3,3), self.path('python3.3')), check_python_syntax.find_python_executable([(3,4), (3,3)]))
+        # Name doesn't match real version
+        self.pythons = {'python': '3.4', 'python3.3': '3.4'}
+        self.assertEqual(((3,4), self.path('python')), check_python_syntax.find_python_executable([(2,), (3,3), (3,4)]))
+
+    def test_registry(self):
+        self.pythons = {'python': '2.7', 'python3.4': '3.4', 'python3': '3.4', 'not-python': '3.4', 'python3.4-config': '3.4'}
+        registry = check_python_syntax._interpreter_registry
+        expected_result = [((2,7), self.path('python')), ((3,4), self.path('python3')), ((3,4), self.path('python3.4'))]
+        self.assertEqual(expected_result, check_python_syntax.list_python_interpreters())
+        # Versions are cached by path and mtime
+        with open(self.path('python'), 'w') as file:
+            file.write('#!/bin/sh\necho 2.6\n')
+        os.utime(self.path('python'), (1, 1))
+        self.assertEqual(expected_result, check_python_syntax.list_python_interpreters())
+        self.assertEqual([((2,6), self.path('python'))] + expected_result[1:], check_python_syntax.list_python_interpreters(refresh=True))
+        # Saved to file and loaded by other registry
+        cache_file = os.path.join(self.bin_dir, 'cache', 'interpreters.json')
+        registry.cache_file = cache_file
+        registry.save()
+        os.chmod(self.path('python3'), 0o644)
+        other_registry = check_python_syntax.InterpreterRegistry(search_path=[self.bin_dir], cache_file=cache_file)
+        self.assertEqual([((2,6), self.path('python')), ((3,4), self.path('python3.4'))], other_registry.interpreters())
+
+    def test_named_first(self):
+        self.pythons = {'python': '2.7', 'python3': '3.4', 'python3.4': '3.4'}
+        registry = check_python_syntax._interpreter_registry
+        self.assertEqual(self.path('python3.4'), registry.find((3, 4)))
+        # Other interpreters are not probed if named one has this version
+        self.assertEqual([os.path.realpath(self.path('python3.4'))], list(registry._versions))
+        self.assertEqual(self.path('python'), registry.find((2, 7)))
+        self.assertEqual(3, len(registry._versions))
+
+    def test_probe_timeout(self):
+        self.pythons = {'python3.4': '3.4'}
+        with open(self.path('python'), 'w') as file:
+            file.write('#!/bin/sh\nsleep 60\n')
+        os.chmod(self.path('python'), 0o755)
+        registry = check_python_syntax._interpreter_registry
+        registry.PROBE_TIMEOUT = 0.5
+        started = time.time()
+        self.assertEqual([((3,4), self.path('python3.4'))], registry.interpreters())
+        self.assertTrue(time.time() - started < 30)
+        # Hung interpreter is probed again next time
+        self.assertFalse(os.path.realpath(self.path('python')) in registry._versions)
 
 
 class UnexpectedErrorTest(unittest.TestCase):
     def setUp(self):
-        def dummy_exception(dummy):
+        def dummy_exception(*args, **kwargs):
             raise Exception('Unexpected error')
         self._check_all_files = check_python_syntax._check_all_files
         check_python_syntax._check_all_files = dummy_exception
@@ -117,31 +171,87 @@ class MiscErrorsTest(unittest.TestCase):
             python_version = (3,)
         else:
             python_version = (2,)
-        result = check_python_syntax.check_python_syntax([os.path.join(tempfile.gettempdir(), 'no_such_file.py')], python_version=python_version, _use_this_python=True)
+        find_python_executable = check_python_syntax.find_python_executable
+        check_python_syntax.find_python_executable = lambda versions: (python_version, 'python%d' % python_version)
+        try:
+            result = check_python_syntax.check_python_syntax([os.path.join(tempfile.gettempdir(), 'no_such_file.py')], python_version=python_version, _use_this_python=True)
+        finally:
+            check_python_syntax.find_python_executable = find_python_executable
         if sys.version_info[0] == 2:
             self.assertEqual({'<exception>': [False, "We are in (2,) instead of (3,)"]}, result)
         else:
             self.assertEqual({'<exception>': [False, "We are in (3,) instead of (2,)"]}, result)
 
 
-class SubprocessFailureTest(unittest.TestCase):
+class SubprocessFailureTest(FakeInterpretersTest):
     def setUp(self):
-        # First Popen() will succeed, second will raise OSError
-        class CustomSubprocessMock(SubprocessMock):
-            def Popen(self, arguments, stdout=None, stderr=None):
-                if '--version' in arguments:
-                    return super(CustomSubprocessMock, self).Popen(arguments, stdout=stdout, stderr=stderr)
-                else:
-                    raise OSError('Fake error')
-        check_python_syntax.subprocess = self.subprocess_mock = CustomSubprocessMock()
+        super(SubprocessFailureTest, self).setUp()
+        # Interpreter is found, but Popen() raises OSError
+        class SubprocessMock(object):
+            PIPE = subprocess.PIPE
+            STDOUT = subprocess.STDOUT
+            def Popen(self, arguments, stdin=None, stdout=None, stderr=None):
+                raise OSError('Fake error')
+        self.pythons = {'python2.100': '2.100'}
+        check_python_syntax._interpreter_registry.interpreters()
+        check_python_syntax.subprocess = SubprocessMock()
 
     def tearDown(self):
         check_python_syntax.subprocess = subprocess
+        super(SubprocessFailureTest, self).tearDown()
 
     def test(self):
-        self.subprocess_mock.pythons = ['python2.100']
         result = check_python_syntax.check_python_syntax([os.path.join(tempfile.gettempdir(), 'no_such_file.py')], python_version=(2,100))
-        self.assertEqual({'<exception>': [False, 'Failed to execute python2.100: Fake error']}, result)
+        self.assertEqual({'<exception>': [False, 'Failed to execute %s: Fake error' % self.path('python2.100')]}, result)
+        self.assertEqual([('<exception>', [False, 'Failed to execute %s: Fake error' % self.path('python2.100')])],
+                         list(check_python_syntax.iter_check_python_syntax(['no_such_file.py'], python_version=(2,100))))
+
+    def test_in_process(self):
+        def raise_os_error(*args, **kwargs):
+            raise OSError('Fake error')
+
+        iter_check_all_files = check_python_syntax._iter_check_all_files
+        check_python_syntax._iter_check_all_files = raise_os_error
+        try:
+            items = list(check_python_syntax.iter_check_python_syntax(['no_such_file.py']))
+        finally:
+            check_python_syntax._iter_check_all_files = iter_check_all_files
+        # Only starting another interpreter is reported as failure to execute it
+        self.assertEqual(['<exception>'], [x[0] for x in items])
+        self.assertTrue(items[0][1][1].startswith('Traceback'), items)
+        self.assertTrue('OSError: Fake error' in items[0][1][1], items)
+
+
+class ChildExitTest(FakeInterpretersTest):
+    def write_script(self, name, content):
+        self.pythons = {}
+        path = self.path(name)
+        with open(path, 'w') as file:
+            file.write('#!/bin/sh\n' + content)
+        os.chmod(path, 0o755)
+        return path
+
+    def results_and_error(self, path):
+        """Return results of streaming request to new worker and message of WorkerError."""
+        request = check_python_syntax._child_request(['no_such_file.py'], 'memory', 1, None)
+        results = []
+        try:
+            for item in check_python_syntax._iter_worker_stream(path, request):
+                results.append(item)
+        except check_python_syntax.WorkerError as ex:
+            return results, str(ex)
+        return results, None
+
+    def test(self):
+        # Child exits without the end of results
+        path = self.write_script('python2.100', 'read request\nexit 3\n')
+        self.assertEqual(([], 'Worker %s exited with code 3' % path), self.results_and_error(path))
+        # Child sends all results, but exits with nonzero code
+        path = self.write_script('python2.100', 'read request\n'
+                                 'echo \'{"file": "a.py", "is_valid": true, "message": "OK"}\'\n'
+                                 'echo \'{"done": true}\'\n'
+                                 'exit 3\n')
+        self.assertEqual(([('a.py', [True, 'OK'])], 'Worker %s exited with code 3' % path), self.results_and_error(path))
 
 
 class InterpreterTest(unittest.TestCase):
@@ -287,5 +397,1055 @@ class Python33(InterpreterTest):
         super(Python33, self).test()
 
 
+class CompileEnginesTest(InterpreterTest):
+    """In-memory compilation must give the same results as py_compile"""
+
+    existing_files = dict(STANDARD_SET, **{
+        'indentation.py': 'def f(x):\n  return x\n    return 2',
+        'null_byte.py': 'x = 1\0',
+        'crlf.py': 'def f(x):\r\n    return x\r\n',
+    })
+
+    def test(self):
+        result_memory = check_python_syntax.check_python_syntax([self.temp_dir], engine='memory')
+        result_py_compile = check_python_syntax.check_python_syntax([self.temp_dir], engine='py_compile')
+        self.assertEqual(sorted(os.path.join(self.temp_dir, x) for x in self.existing_files), sorted(result_memory))
+        self.assertEqual(result_py_compile, result_memory)
+
+
+class ParallelTest(InterpreterTest):
+    """Parallel compilation must give exactly the same results as serial one"""
+
+    existing_files = dict(('package%d/module%d.py' % (i % 3, i), 'x = %d\n' % i if i % 5 else 'print x\n') for i in range(20))
+
+    def test(self):
+        serial_result = check_python_syntax.check_python_syntax([self.temp_dir, 'no_such_file.py'], jobs=1)
+        for jobs in (0, 2, 3, 100):
+            parallel_result = check_python_syntax.check_python_syntax([self.temp_dir, 'no_such_file.py'], jobs=jobs)
+            self.assertEqual(serial_result, parallel_result)
+            self.assertEqual(list(serial_result), list(parallel_result))
+        self.assertEqual(21, len(serial_result))
+
+
+class ResultCacheTest(InterpreterTest):
+    existing_files = STANDARD_SET
+
+    def setUp(self):
+        super(ResultCacheTest, self).setUp()
+        self.cache_dir = os.path.join(tempfile.gettempdir(), 'check-python-syntax-cache')
+        if os.path.isdir(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def tearDown(self):
+        super(ResultCacheTest, self).tearDown()
+        shutil.rmtree(self.cache_dir)
+
+    def get_counters(self, file_names):
+        cache = check_python_syntax.ResultCache(self.cache_dir)
+        try:
+            results = [cache.get(x)[0] for x in file_names]
+            return cache.hits, cache.misses, results
+        finally:
+            cache.close()
+
+    def test(self):
+        expected_result = check_python_syntax.check_python_syntax([self.temp_dir], details=True)
+        file_names = sorted(expected_result)
+        # Empty cache
+        self.assertEqual((0, 3, [None, None, None]), self.get_counters(file_names))
+        # Cache is filled
+        self.assertEqual(expected_result, check_python_syntax.check_python_syntax([self.temp_dir], cache_dir=self.cache_dir,
+                                                                                  details=True))
+        self.assertEqual((3, 0, [expected_result[x] for x in file_names]), self.get_counters(file_names))
+        # Same content with different mtime is still a hit
+        os.utime(file_names[0], (0, 0))
+        self.assertEqual((3, 0, [expected_result[x] for x in file_names]), self.get_counters(file_names))
+        # Results of another version of checker are not reused
+        checker_version = check_python_syntax._checker_version()
+        check_python_syntax._checker_version_value = checker_version + '.modified'
+        try:
+            self.assertEqual((0, 3), self.get_counters(file_names)[:2])
+        finally:
+            check_python_syntax._checker_version_value = checker_version
+        # Changed content is a miss
+        with open(file_names[0], 'w') as file:
+            file.write('print(1)\n')
+        self.assertEqual(1, self.get_counters(file_names)[1])
+        result = check_python_syntax.check_python_syntax([self.temp_dir], cache_dir=self.cache_dir, jobs=2)
+        self.assertEqual(check_python_syntax.check_python_syntax([self.temp_dir]), result)
+
+    def test_eviction(self):
+        cache = check_python_syntax.ResultCache(self.cache_dir, max_entries=2)
+        for file_name in sorted(self.existing_files):
+            file_name = os.path.join(self.temp_dir, file_name)
+            cache.get(file_name)
+            cache.put(file_name, [True, 'OK'])
+        cache.close()
+        hits, misses, results = self.get_counters([os.path.join(self.temp_dir, x) for x in sorted(self.existing_files)])
+        self.assertEqual(2, hits)
+
+
+class PersistentWorkerTest(InterpreterTest):
+    existing_files = STANDARD_SET
+
+    def test(self):
+        expected_result = check_python_syntax.check_python_syntax([self.temp_dir, 'no_such_file.py'], details=True)
+        pool = check_python_syntax._WorkerPool()
+        try:
+            request = {'cwd': os.getcwd(), 'files': [self.temp_dir, 'no_such_file.py']}
+            self.assertEqual(expected_result, pool.request(sys.executable, request))
+            # Worker is reused
+            process = pool.workers[sys.executable].process
+            self.assertEqual(expected_result, pool.request(sys.executable, request))
+            self.assertTrue(process is pool.workers[sys.executable].process)
+            # Dead worker is restarted
+            process.kill()
+            process.wait()
+            self.assertEqual(expected_result, pool.request(sys.executable, request))
+            self.assertFalse(process is pool.workers[sys.executable].process)
+        finally:
+            pool.close()
+        self.assertEqual({}, pool.workers)
+
+    def test_nested_requests(self):
+        expected_result = check_python_syntax.check_python_syntax([self.temp_dir], details=True)
+        pool = check_python_syntax._WorkerPool()
+        try:
+            request = {'cwd': os.getcwd(), 'files': [self.temp_dir]}
+            stream = pool.request_stream(sys.executable, request)
+            first_item = next(stream)
+            # Requests of the same thread before the end of streaming response don't deadlock
+            self.assertEqual(expected_result, pool.request(sys.executable, request))
+            self.assertEqual(expected_result, dict(pool.request_stream(sys.executable, request)))
+            self.assertEqual(expected_result, dict([first_item] + list(stream)))
+            self.assertEqual(expected_result, pool.request(sys.executable, request))
+        finally:
+            pool.close()
+
+
+class AllVersionsTest(InterpreterTest):
+    existing_files = STANDARD_SET
+
+    def setUp(self):
+        super(AllVersionsTest, self).setUp()
+        self.find_python_executable = check_python_syntax.find_python_executable
+
+    def test(self):
+        this_version = '%d.%d' % sys.version_info[:2]
+        targets = [self.temp_dir, 'no_such_file.py']
+        result = check_python_syntax.check_all_python_versions(targets, [this_version, '%d' % sys.version_info[0], '2.100'])
+        expected_result = check_python_syntax.check_python_syntax(targets)
+        self.assertEqual({
+            this_version: expected_result,
+            str(sys.version_info[0]): expected_result,
+            '2.100': {'<exception>': [False, "No Python executable found for '2.100'"]},
+        }, result)
+
+    def test_child_interpreters(self):
+        # Pretend that current interpreter is another version, to run it as a child
+        this_version = '%d.%d' % sys.version_info[:2]
+        def find_python_executable(python_versions):
+            return (check_python_syntax._normalize_versions_list(python_versions)[0], sys.executable)
+        check_python_syntax.find_python_executable = find_python_executable
+        try:
+            targets = [self.temp_dir, 'no_such_file.py']
+            for persistent_worker in (False, True):
+                result = check_python_syntax.check_all_python_versions(targets, '2.100,3.100',
+                                                                       persistent_worker=persistent_worker)
+                expected_result = check_python_syntax.check_python_syntax(targets)
+                self.assertEqual({'2.100': expected_result, '3.100': expected_result}, result)
+        finally:
+            check_python_syntax.find_python_executable = self.find_python_executable
+            check_python_syntax.shutdown_workers()
+
+
+class IterCheckTest(InterpreterTest):
+    existing_files = STANDARD_SET
+
+    def setUp(self):
+        super(IterCheckTest, self).setUp()
+        self.find_python_executable = check_python_syntax.find_python_executable
+
+    def tearDown(self):
+        check_python_syntax.find_python_executable = self.find_python_executable
+        check_python_syntax.shutdown_workers()
+        super(IterCheckTest, self).tearDown()
+
+    def test(self):
+        targets = [self.temp_dir, 'no_such_file.py']
+        expected_result = check_python_syntax.check_python_syntax(targets)
+        for jobs in (1, 2):
+            result = list(check_python_syntax.iter_check_python_syntax(targets, jobs=jobs))
+            self.assertEqual(list(expected_result.items()), result)
+
+    def test_child_interpreter(self):
+        # Pretend that current interpreter is another version, to run it as a child
+        check_python_syntax.find_python_executable = lambda python_versions: ((2,100), sys.executable)
+        targets = [self.temp_dir, 'no_such_file.py']
+        expected_result = list(check_python_syntax.iter_check_python_syntax(targets))
+        for persistent_worker in (False, True):
+            result = list(check_python_syntax.iter_check_python_syntax(targets, python_version='2.100',
+                                                                        persistent_worker=persistent_worker))
+            self.assertEqual(expected_result, result)
+            # Closing generator early must not break subsequent calls
+            iterator = check_python_syntax.iter_check_python_syntax(targets, python_version='2.100',
+                                                                    persistent_worker=persistent_worker)
+            self.assertEqual(expected_result[0], next(iterator))
+            iterator.close()
+            result = check_python_syntax.check_python_syntax(targets, python_version='2.100',
+                                                             persistent_worker=persistent_worker)
+            self.assertEqual(dict(expected_result), result)
+
+
+class ChildOutputTest(InterpreterTest):
+    """Child output larger than pipe buffer must not cause deadlock"""
+
+    existing_files = dict(('very_long_directory_name_%d/invalid_module_with_long_name_%d.py' % (i % 10, i),
+                           'def f(:\n    pass\n') for i in range(600))
+
+    def test(self):
+        expected_result = check_python_syntax.check_python_syntax([self.temp_dir], details=True)
+        result = check_python_syntax._check_in_child(sys.executable, [self.temp_dir], timeout=120)
+        self.assertTrue(len(json.dumps(result)) > 65536)
+        self.assertEqual(expected_result, result)
+
+    def test_limits(self):
+        result = check_python_syntax._check_in_child(sys.executable, [self.temp_dir], max_output_size=1000)
+        self.assertEqual({'<exception>': [False, '%s: output is larger than 1000 bytes' % sys.executable]}, result)
+        result = check_python_syntax._check_in_child(sys.executable, [self.temp_dir], timeout=0.001)
+        self.assertEqual({'<exception>': [False, '%s: timeout, not finished in 0.001 seconds' % sys.executable]}, result)
+
+    def test_worker_limits(self):
+        request = check_python_syntax._child_request([self.temp_dir], 'memory', 1, None)
+        limits = [((None, 1000), '%s: output is larger than 1000 bytes' % sys.executable),
+                  ((0.001, None), '%s: timeout, not finished in 0.001 seconds' % sys.executable)]
+        try:
+            for persistent_worker in (False, True):
+                for (timeout, max_output_size), message in limits:
+                    try:
+                        check_python_syntax._worker_request(sys.executable, request, persistent_worker, timeout,
+                                                            max_output_size)
+                    except check_python_syntax.WorkerError as ex:
+                        self.assertEqual(message, str(ex))
+                    else:
+                        self.fail('WorkerError is not raised')
+                    try:
+                        list(check_python_syntax._iter_worker_stream(sys.executable, request, persistent_worker,
+                                                                     timeout, max_output_size))
+                    except check_python_syntax.WorkerError as ex:
+                        self.assertEqual(message, str(ex))
+                    else:
+                        self.fail('WorkerError is not raised')
+            # Worker which exceeded limits is replaced
+            self.assertEqual(check_python_syntax.check_python_syntax([self.temp_dir], details=True),
+                             check_python_syntax._worker_request(sys.executable, request, True))
+        finally:
+            check_python_syntax.shutdown_workers()
+
+    def test_long_request(self):
+        # Request is larger than the limit of a single command line argument (128 KiB in Linux)
+        file_names = [os.path.join(self.temp_dir, file_name) for file_name in self.existing_files] * 3
+        self.assertTrue(len(json.dumps(file_names)) > 131072)
+        expected_result = check_python_syntax.check_python_syntax(file_names, details=True)
+        self.assertEqual(expected_result, check_python_syntax._check_in_child(sys.executable, file_names))
+        request = check_python_syntax._child_request(file_names, 'memory', 1, None)
+        self.assertEqual(expected_result, dict(check_python_syntax._iter_worker_stream(sys.executable, request)))
+
+
+class StatsTest(InterpreterTest):
+    existing_files = STANDARD_SET
+
+    def setUp(self):
+        super(StatsTest, self).setUp()
+        self.cache_dir = os.path.join(tempfile.gettempdir(), 'check-python-syntax-cache')
+        if os.path.isdir(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def tearDown(self):
+        super(StatsTest, self).tearDown()
+        if os.path.isdir(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def test(self):
+        expected_result = check_python_syntax.check_python_syntax([self.temp_dir])
+        reported = []
+        check_python_syntax.add_stats_hook(reported.append)
+        try:
+            for jobs in (1, 2):
+                result = check_python_syntax.check_python_syntax([self.temp_dir], jobs=jobs, cache_dir=self.cache_dir,
+                                                                 stats=True)
+                is_valid, stats = result.pop('<stats>')
+                self.assertEqual(expected_result, result)
+                self.assertTrue(is_valid)
+                self.assertEqual(stats, reported[-1])
+                self.assertEqual(3, stats['files'])
+                self.assertEqual(sum(len(x) for x in self.existing_files.values()), stats['bytes'])
+                self.assertEqual(sorted(expected_result), sorted(x[0] for x in stats['slowest_files']))
+                self.assertEqual(['compile', 'discovery', 'total', 'walk'], sorted(stats['stages']))
+            # Second run is served from cache
+            self.assertEqual({'hits': 3, 'misses': 0, 'hit_rate': 1.0}, stats['cache'])
+            # Hooks get stats even if they are not requested
+            self.assertEqual(expected_result, check_python_syntax.check_python_syntax([self.temp_dir]))
+            self.assertEqual(3, len(reported))
+            # Failed checks are reported once as well
+            del reported[:]
+            self.assertTrue('<exception>' in check_python_syntax.check_python_syntax([self.temp_dir],
+                                                                                     python_version='2.100'))
+            self.assertTrue('<exception>' in check_python_syntax.check_python_sources([], python_version='2.100'))
+            items = list(check_python_syntax.iter_check_python_syntax([self.temp_dir], python_version='2.100',
+                                                                      stats=True))
+            self.assertEqual(['<exception>'], [x[0] for x in items])
+            items = check_python_syntax.iter_check_python_syntax([self.temp_dir], stats=True)
+            next(items)
+            items.close()
+            self.assertEqual(4, len(reported))
+            self.assertTrue(all('total' in x['stages'] for x in reported))
+        finally:
+            check_python_syntax.remove_stats_hook(reported.append)
+
+    def test_child_interpreter(self):
+        expected_result = check_python_syntax.check_python_syntax([self.temp_dir])
+        stats = check_python_syntax._Stats()
+        self.assertEqual(expected_result, check_python_syntax._without_details(
+            check_python_syntax._check_in_child(sys.executable, [self.temp_dir], stats=stats)))
+        stats = stats.to_dict()
+        self.assertEqual(3, stats['files'])
+        # Child handles request directly, without interpreter discovery
+        self.assertEqual(['compile', 'deserialization', 'subprocess', 'walk'], sorted(stats['stages']))
+        items = list(check_python_syntax.iter_check_python_syntax([self.temp_dir], stats=True))
+        self.assertEqual('<stats>', items[-1][0])
+        self.assertEqual(expected_result, dict(items[:-1]))
+        find_python_executable = check_python_syntax.find_python_executable
+        check_python_syntax.find_python_executable = lambda python_versions: ((2,100), sys.executable)
+        try:
+            for persistent_worker in (False, True):
+                items = list(check_python_syntax.iter_check_python_syntax(
+                    [self.temp_dir], python_version='2.100', persistent_worker=persistent_worker, stats=True))
+                self.assertEqual(expected_result, dict(items[:-1]))
+                stats = items[-1][1][1]
+                self.assertEqual(3, stats['files'])
+                self.assertEqual(['compile', 'discovery', 'subprocess', 'total', 'walk'], sorted(stats['stages']))
+        finally:
+            check_python_syntax.find_python_executable = find_python_executable
+            check_python_syntax.shutdown_workers()
+
+
+class SourcesTest(InterpreterTest):
+    existing_files = STANDARD_SET
+
+    def test(self):
+        expected_result = check_python_syntax.check_python_syntax([self.temp_dir])
+        sources = []
+        for file_name in sorted(expected_result):
+            with open(file_name, 'rb') as file:
+                sources.append((file_name, file.read()))
+        self.assertEqual(expected_result, check_python_syntax.check_python_sources(sources))
+        self.assertEqual(expected_result, check_python_syntax.check_python_sources(sources, jobs=2))
+        # Text is encoded to UTF-8
+        text = b'x = "\xc3\xa9"\n'.decode('utf-8')
+        self.assertEqual({'x.py': [True, 'OK']}, check_python_syntax.check_python_sources([('x.py', text)]))
+        # All sources are sent to another interpreter in one message
+        worker = check_python_syntax._Worker(sys.executable)
+        try:
+            request = {'sources': check_python_syntax._encode_sources(sources)}
+            self.assertEqual(expected_result, check_python_syntax._without_details(worker.request(request)))
+        finally:
+            worker.close()
+
+    def test_stdin(self):
+        sources = [('a.py', b'x = 1\n'), ('b.py', b'def f(:\n    pass\n')]
+        expected_result = check_python_syntax.check_python_sources(sources)
+        process = subprocess.Popen([sys.executable, check_python_syntax._script_file(), '--sources-from-stdin'],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        output = process.communicate(json.dumps({'sources': check_python_syntax._encode_sources(sources)}).encode())[0]
+        self.assertEqual(1, process.returncode)
+        self.assertEqual(expected_result, json.loads(output.decode()))
+
+
+class LargeFilesTest(InterpreterTest):
+    existing_files = {
+        'large.py': 'x = 1\n' * 1000,
+        'invalid.py': 'x = = 1\n' * 100,
+        'unterminated.py': 'x = 1\n' * 100 + 'y = """abc\n',
+        'unterminated_quote.py': 'x = 1\n' * 100 + "y = 'abc\n",
+        'latin1.py': '# -*- coding: latin-1 -*-\n' + 'x = 1\n' * 100,
+        'unknown_encoding.py': '# coding: no-such-encoding\n' + 'x = 1\n' * 100,
+    }
+
+    def setUp(self):
+        super(LargeFilesTest, self).setUp()
+        self.mmap_threshold = check_python_syntax.MMAP_THRESHOLD
+        check_python_syntax.MMAP_THRESHOLD = 100
+
+    def tearDown(self):
+        super(LargeFilesTest, self).tearDown()
+        check_python_syntax.MMAP_THRESHOLD = self.mmap_threshold
+
+    def test(self):
+        expected_result = check_python_syntax.check_python_syntax([self.temp_dir], engine='py_compile')
+        self.assertEqual(expected_result, check_python_syntax.check_python_syntax([self.temp_dir]))
+        # Only tokenizer errors are found
+        path = lambda x: os.path.join(self.temp_dir, x)
+        for engine in sorted(check_python_syntax.COMPILE_ENGINES):
+            result = check_python_syntax.check_python_syntax([self.temp_dir], engine=engine, max_compile_size=500)
+            self.assertEqual([True, 'OK'], result[path('large.py')])
+            self.assertEqual([True, 'OK'], result[path('invalid.py')])
+            self.assertEqual([True, 'OK'], result[path('latin1.py')])
+            self.assertEqual([False, '  File "%s", line 101\nSyntaxError: EOF in multi-line string\n' % path('unterminated.py')],
+                             result[path('unterminated.py')])
+            self.assertEqual('SyntaxError: unterminated string literal (detected at line 101)',
+                             result[path('unterminated_quote.py')][1].splitlines()[-1])
+            self.assertFalse(result[path('unknown_encoding.py')][0])
+
+    def test_detect_encoding(self):
+        detect_encoding = check_python_syntax._detect_encoding
+        default_encoding = 'utf-8' if sys.version_info[0] >= 3 else 'ascii'
+        self.assertEqual((default_encoding, 0), detect_encoding(b'x = 1\n# coding: latin-1\n'))
+        self.assertEqual(('utf-8', 3), detect_encoding(b'\xef\xbb\xbfx = 1\n'))
+        self.assertEqual(('iso8859-1', 0), detect_encoding(b'#!/usr/bin/env python\n# -*- coding: latin-1 -*-\n'))
+        self.assertEqual(('iso8859-1', 0), detect_encoding(b'# vim: set fileencoding=latin-1 :'))
+        self.assertEqual((default_encoding, 0), detect_encoding(b'#!/usr/bin/env python\nx = 1\n# coding: latin-1\n'))
+        self.assertRaises(SyntaxError, detect_encoding, b'# coding: no-such-encoding\n')
+        self.assertRaises(SyntaxError, detect_encoding, b'\xef\xbb\xbf# coding: latin-1\n')
+
+
+class ErrorsOnlyTest(InterpreterTest):
+    existing_files = dict(STANDARD_SET, **dict(('package/valid_%d.py' % i, 'x = %d\n' % i) for i in range(20)))
+
+    def test(self):
+        full_result = check_python_syntax.check_python_syntax([self.temp_dir, 'no_such_file.py'])
+        expected_result = dict((x, y) for x, y in full_result.items() if not y[0])
+        expected_result['<summary>'] = [True, {'files': 24, 'valid': 22, 'invalid': 2}]
+        for jobs in (1, 2):
+            self.assertEqual(expected_result, check_python_syntax.check_python_syntax(
+                [self.temp_dir, 'no_such_file.py'], jobs=jobs, errors_only=True))
+        self.assertEqual(expected_result, check_python_syntax._without_details(check_python_syntax._check_in_child(
+            sys.executable, [self.temp_dir, 'no_such_file.py'], errors_only=True)))
+        items = list(check_python_syntax.iter_check_python_syntax([self.temp_dir, 'no_such_file.py'], errors_only=True))
+        self.assertEqual(('<summary>', expected_result['<summary>']), items[-1])
+        self.assertEqual(expected_result, dict(items))
+        # Another interpreter streams only invalid files
+        request = check_python_syntax._child_request([self.temp_dir, 'no_such_file.py'], 'memory', 1, None,
+                                                     errors_only=True)
+        items = list(check_python_syntax._iter_worker_stream(sys.executable, request))
+        self.assertEqual(('<summary>', expected_result['<summary>']), items[-1])
+        self.assertEqual(expected_result, check_python_syntax._without_details(dict(items)))
+        find_python_executable = check_python_syntax.find_python_executable
+        check_python_syntax.find_python_executable = lambda python_versions: ((2,100), sys.executable)
+        try:
+            for persistent_worker in (False, True):
+                items = list(check_python_syntax.iter_check_python_syntax(
+                    [self.temp_dir, 'no_such_file.py'], python_version='2.100', persistent_worker=persistent_worker,
+                    errors_only=True))
+                self.assertEqual(('<summary>', expected_result['<summary>']), items[-1])
+                self.assertEqual(expected_result, dict(items))
+        finally:
+            check_python_syntax.find_python_executable = find_python_executable
+            check_python_syntax.shutdown_workers()
+
+    def test_summary(self):
+        summary = check_python_syntax._ResultSummary()
+        for i in range(100):
+            summary.add(os.path.join('some', 'directory', 'file_%d.py' % i), [i % 10 != 0, 'OK' if i % 10 else 'Error'])
+        summary.add('<exception>', [False, 'Unexpected error'])
+        self.assertEqual({'files': 100, 'valid': 90, 'invalid': 10}, summary.summary())
+        self.assertEqual(11, len(summary.errors))
+        self.assertEqual(2, len(summary.directories))
+        result = summary.to_dict()
+        self.assertEqual([False, 'Error'], result[os.path.join('some', 'directory', 'file_50.py')])
+        self.assertEqual([False, 'Unexpected error'], result['<exception>'])
+
+
+class FindAllFilesTest(InterpreterTest):
+    existing_files = {
+        '.git/HEAD': '',
+        '.git/hooks/hook.py': '',
+        '.gitignore': '/pkg/generated/\n*.log\nignored_*.py\n!ignored_but_included.py\n',
+        'pkg/module.py': '',
+        'pkg/readme.txt': '',
+        'pkg/app.log': '',
+        'pkg/generated/big.py': '',
+        'pkg/sub/.gitignore': 'local.py\ndata/\n',
+        'pkg/sub/local.py': '',
+        'pkg/sub/ignored_x.py': '',
+        'pkg/sub/ignored_but_included.py': '',
+        'pkg/sub/data/module.py': '',
+        'pkg/sub/data.py': '',
+        'pkg/__pycache__/module.py': '',
+        'pkg/node_modules/module.py': '',
+        'pkg/env/pyvenv.cfg': '',
+        'pkg/env/lib/module.py': '',
+        'pkg/scripts/tool': '',
+    }
+
+    # Defaults of command line tool
+    cli_options = {'exclude': check_python_syntax.DEFAULT_EXCLUDE, 'gitignore': True}
+
+    def find(self, directory, **kwargs):
+        directory = os.path.join(self.temp_dir, directory)
+        return sorted(os.path.relpath(x, directory).replace(os.sep, '/')
+                      for x in check_python_syntax._find_all_files(directory, **kwargs))
+
+    def test(self):
+        self.assertEqual(['module.py', 'sub/data.py', 'sub/ignored_but_included.py'], self.find('pkg', **self.cli_options))
+        self.assertEqual(['pkg/module.py', 'pkg/sub/data.py', 'pkg/sub/ignored_but_included.py'],
+                         self.find('', **self.cli_options))
+        self.assertEqual(['data.py', 'ignored_but_included.py'], self.find('pkg/sub', **self.cli_options))
+
+    def test_library_defaults(self):
+        # Nothing is skipped by default, as before include/exclude/gitignore options
+        self.assertEqual(['__pycache__/module.py', 'env/lib/module.py', 'generated/big.py', 'module.py',
+                          'node_modules/module.py', 'sub/data.py', 'sub/data/module.py', 'sub/ignored_but_included.py',
+                          'sub/ignored_x.py', 'sub/local.py'], self.find('pkg'))
+        self.assertEqual(['module.py', 'sub/data.py', 'sub/data/module.py', 'sub/ignored_but_included.py',
+                          'sub/ignored_x.py', 'sub/local.py'],
+                         self.find('pkg', exclude=[check_python_syntax.VIRTUALENV_PATTERN, '__pycache__',
+                                                   'node_modules', 'generated']))
+
+    def test_no_gitignore(self):
+        self.assertEqual(['generated/big.py', 'module.py', 'sub/data.py', 'sub/data/module.py',
+                          'sub/ignored_but_included.py', 'sub/ignored_x.py', 'sub/local.py'],
+                         self.find('pkg', exclude=check_python_syntax.DEFAULT_EXCLUDE))
+
+    def test_include_exclude(self):
+        self.assertEqual(['app.log', 'readme.txt', 'scripts/tool'],
+                         self.find('pkg', gitignore=False, include=['*.txt', '*.log', 'scripts/*']))
+        # Virtual environments are skipped only by VIRTUALENV_PATTERN
+        self.assertEqual(['__pycache__/module.py', 'env/lib/module.py', 'module.py', 'node_modules/module.py',
+                          'sub/data.py'],
+                         self.find('pkg', gitignore=False, exclude=['ignored_*', 'sub/data', 'sub/local.py', 'generated']))
+        self.assertEqual(['__pycache__/module.py', 'env/lib/module.py', 'module.py', 'node_modules/module.py',
+                          'sub/data.py', 'sub/ignored_but_included.py'], self.find('pkg', exclude=[], gitignore=True))
+
+    def test_check(self):
+        # Individual files are always checked
+        result = check_python_syntax.check_python_syntax([os.path.join(self.temp_dir, 'pkg'),
+                                                          os.path.join(self.temp_dir, 'pkg/sub/local.py')],
+                                                         **self.cli_options)
+        self.assertEqual(['module.py', 'sub/data.py', 'sub/ignored_but_included.py', 'sub/local.py'],
+                         sorted(os.path.relpath(x, os.path.join(self.temp_dir, 'pkg')) for x in result))
+
+
+class GitChangedFilesTest(InterpreterTest):
+    existing_files = {
+        'pkg/modified.py': 'x = 1\n',
+        'pkg/deleted.py': 'x = 1\n',
+        'pkg/renamed.py': 'x = 1\n',
+        'pkg/unchanged.py': 'x = 1\n',
+        'other/modified.py': 'x = 1\n',
+    }
+
+    def git(self, *arguments):
+        subprocess.check_call(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com'] + list(arguments),
+                              cwd=self.temp_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def setUp(self):
+        super(GitChangedFilesTest, self).setUp()
+        try:
+            self.git('init', '-q')
+        except OSError:
+            self.skipTest('git is not installed')
+        self.git('add', '.')
+        self.git('commit', '-q', '-m', 'Initial commit')
+        for file_name in ('pkg/modified.py', 'other/modified.py'):
+            with open(os.path.join(self.temp_dir, file_name), 'a') as file:
+                file.write('y = \n')
+        os.remove(os.path.join(self.temp_dir, 'pkg/deleted.py'))
+        self.git('mv', 'pkg/renamed.py', 'pkg/new_name.py')
+        with open(os.path.join(self.temp_dir, 'pkg/untracked.py'), 'w') as file:
+            file.write('x = 1\n')
+        with open(os.path.join(self.temp_dir, 'pkg/added.py'), 'w') as file:
+            file.write('x = 1\n')
+        self.git('add', 'pkg/added.py')
+
+    def check(self, **kwargs):
+        result = check_python_syntax.check_python_syntax([os.path.join(self.temp_dir, 'pkg')], **kwargs)
+        return dict((os.path.relpath(x, self.temp_dir).replace(os.sep, '/'), y[0]) for x, y in result.items())
+
+    def test(self):
+        self.assertEqual({'pkg/modified.py': False, 'pkg/new_name.py': True, 'pkg/untracked.py': True, 'pkg/added.py': True},
+                         self.check(changed_since='HEAD'))
+        self.assertEqual({'pkg/new_name.py': True, 'pkg/added.py': True}, self.check(staged=True))
+        self.assertEqual({'pkg/new_name.py': True, 'pkg/added.py': True}, self.check(staged=True, jobs=2))
+        self.assertEqual({}, self.check(staged=True, include=['*.txt']))
+
+    def test_paths(self):
+        root = os.path.realpath(self.temp_dir)
+
+        def changed_files(paths):
+            result = check_python_syntax._git_changed_files(root, changed_since='HEAD', paths=paths)
+            return sorted(os.path.relpath(x, root).replace(os.sep, '/') for x in result)
+
+        # Working tree is scanned for untracked files only in given paths
+        self.assertEqual(['pkg/added.py', 'pkg/modified.py', 'pkg/new_name.py', 'pkg/untracked.py'],
+                         changed_files(['pkg']))
+        self.assertEqual(['other/modified.py', 'pkg/untracked.py'], changed_files(['other', 'pkg/untracked.py']))
+        self.assertEqual(changed_files(None), changed_files(['.']))
+
+    def test_errors(self):
+        result = check_python_syntax.check_python_syntax([self.temp_dir], changed_since='no-such-revision')
+        self.assertEqual(['<exception>'], list(result))
+        self.assertTrue('no-such-revision' in result['<exception>'][1])
+
+
+class WatchTest(InterpreterTest):
+    existing_files = STANDARD_SET
+
+    def watch(self, use_inotify):
+        iterator = check_python_syntax.watch_python_syntax([self.temp_dir, 'no_such_file.py'], use_inotify=use_inotify,
+                                                           interval=0.01, timeout=10)
+        try:
+            initial_result = dict(next(iterator) for i in range(4))
+            self.assertEqual(check_python_syntax.check_python_syntax([self.temp_dir, 'no_such_file.py']), initial_result)
+            # Changed file
+            changed_file = os.path.join(self.temp_dir, 'print2.py')
+            with open(changed_file, 'w') as file:
+                file.write('print(1)\n')
+            self.assertEqual((changed_file, [True, 'OK']), next(iterator))
+            # New file in new directory
+            os.mkdir(os.path.join(self.temp_dir, 'subdir'))
+            new_file = os.path.join(self.temp_dir, 'subdir', 'new.py')
+            with open(new_file, 'w') as file:
+                file.write('def f(:\n')
+            file_name, result = next(iterator)
+            self.assertEqual(new_file, file_name)
+            self.assertFalse(result[0])
+            # Removed file
+            removed_file = os.path.join(self.temp_dir, 'good.py')
+            os.remove(removed_file)
+            self.assertEqual((removed_file, None), next(iterator))
+        finally:
+            iterator.close()
+
+    def test(self):
+        self.watch(use_inotify=True)
+
+    def test_polling(self):
+        self.watch(use_inotify=False)
+
+    def test_polling_sweep(self):
+        tree = check_python_syntax._WatchedTree([self.temp_dir])
+        watcher = check_python_syntax._PollingWatcher(tree, interval=0.01)
+        watcher.sweep_interval = 3600
+        watcher.small_tree_files = 0
+        checked = []
+        stat = watcher._stat
+        watcher._stat = lambda path: checked.append(path) or stat(path)
+        self.assertEqual(None, watcher.wait(0.05))
+        # Between sweeps only directories are checked
+        self.assertEqual(set(tree.contexts), set(checked))
+        # Atomic replacement changes mtime of directory
+        changed_file = os.path.join(self.temp_dir, 'print2.py')
+        with open(changed_file + '.tmp', 'w') as file:
+            file.write('print(1)\n')
+        os.rename(changed_file + '.tmp', changed_file)
+        self.assertEqual((set([changed_file]), set()), watcher.wait(1))
+        # Changed file is checked on every tick for a while
+        del checked[:]
+        self.assertEqual(None, watcher.wait(0.05))
+        self.assertEqual(set(tree.contexts) | set([changed_file]), set(checked))
+
+    def test_polling_small_tree(self):
+        tree = check_python_syntax._WatchedTree([self.temp_dir])
+        watcher = check_python_syntax._PollingWatcher(tree, interval=0.01)
+        watcher.sweep_interval = 3600
+        # In-place write is noticed on the next tick, though directory didn't change
+        changed_file = os.path.join(self.temp_dir, 'good.py')
+        with open(changed_file, 'a') as file:
+            file.write('y = 2\n')
+        self.assertEqual((set([changed_file]), set()), watcher.wait(0.5))
+
+
+class DetailsTest(InterpreterTest):
+    existing_files = {
+        'good.py': 'x = 1\n',
+        'bad.py': 'x = 1\ny = (1 +* 2)\n',
+        'indent.py': 'if x:\npass\n',
+    }
+
+    def path(self, name):
+        return os.path.join(self.temp_dir, name)
+
+    def test(self):
+        result = check_python_syntax.check_python_syntax([self.temp_dir], details=True)
+        self.assertEqual([True, 'OK'], result[self.path('good.py')])
+        is_valid, message, details = result[self.path('bad.py')]
+        self.assertFalse(is_valid)
+        self.assertEqual(('SyntaxError', 2, 'y = (1 +* 2)'), (details['type'], details['line'], details['text']))
+        self.assertTrue(details['message'] in message)
+        self.assertTrue(details['column'] > 0)
+        details = result[self.path('indent.py')][2]
+        self.assertEqual(('IndentationError', 2), (details['type'], details['line']))
+        # Details are the same in all modes
+        cache_dir = os.path.join(self.temp_dir, 'cache')
+        for options in ({'engine': 'py_compile'}, {'jobs': 2}, {'cache_dir': cache_dir}, {'cache_dir': cache_dir}):
+            self.assertEqual(result, check_python_syntax.check_python_syntax([self.temp_dir], details=True, **options))
+        self.assertEqual(result, dict(check_python_syntax.iter_check_python_syntax([self.temp_dir], details=True)))
+        self.assertEqual(result, check_python_syntax._check_in_child(sys.executable, [self.temp_dir]))
+        self.assertEqual(check_python_syntax._without_details(result),
+                         check_python_syntax.check_python_syntax([self.temp_dir]))
+
+    def test_reports(self):
+        result = check_python_syntax.check_python_syntax([self.temp_dir, 'no_such_file.py'], details=True)
+        sarif = check_python_syntax.sarif_report(result)
+        self.assertEqual('2.1.0', sarif['version'])
+        run = json.loads(json.dumps(sarif))['runs'][0]
+        self.assertEqual(['IndentationError', 'SyntaxError'], [x['id'] for x in run['tool']['driver']['rules']])
+        self.assertEqual([{'executionSuccessful': True}], run['invocations'])
+        locations = dict((x['locations'][0]['physicalLocation']['artifactLocation']['uri'], x) for x in run['results'])
+        self.assertEqual(3, len(locations))
+        self.assertEqual({'level': 'error', 'message': {'text': 'Target not found'},
+                          'locations': [{'physicalLocation': {'artifactLocation': {'uri': 'no_such_file.py'}}}]},
+                         locations['no_such_file.py'])
+        bad = [y for x, y in locations.items() if x.endswith('/bad.py')][0]
+        self.assertEqual('SyntaxError', bad['ruleId'])
+        self.assertEqual((2, 'y = (1 +* 2)'), (bad['locations'][0]['physicalLocation']['region']['startLine'],
+                                                bad['locations'][0]['physicalLocation']['region']['snippet']['text']))
+        if os.name == 'posix':
+            self.assertEqual(['file://' + self.path('bad.py')],
+                             [x for x in locations if x.endswith('/bad.py')])
+        # JUnit
+        import xml.etree.ElementTree as ElementTree
+        suite = ElementTree.fromstring(check_python_syntax.junit_report(result).encode('utf-8')).find('testsuite')
+        self.assertEqual(('4', '3', '0'), (suite.get('tests'), suite.get('failures'), suite.get('errors')))
+        failure = [x for x in suite.findall('testcase') if x.get('name') == self.path('bad.py')][0].find('failure')
+        self.assertEqual('SyntaxError', failure.get('type'))
+        self.assertTrue('(line 2' in failure.get('message'))
+        self.assertEqual(result[self.path('bad.py')][1], failure.text)
+        suite = ElementTree.fromstring(check_python_syntax.junit_report(
+            {'<exception>': [False, 'Traceback\nException: \x01\n']}).encode('utf-8')).find('testsuite')
+        self.assertEqual(('1', '0', '1'), (suite.get('tests'), suite.get('failures'), suite.get('errors')))
+        # Command line
+        for output_format in ('sarif', 'junit'):
+            process = subprocess.Popen([sys.executable, check_python_syntax._script_file(), '--format', output_format,
+                                        '--no-cache', self.temp_dir], stdout=subprocess.PIPE)
+            output = process.communicate()[0]
+            self.assertEqual(1, process.returncode)
+            if output_format == 'sarif':
+                self.assertEqual(2, len(json.loads(output.decode())['runs'][0]['results']))
+            else:
+                self.assertEqual('2', ElementTree.fromstring(output).find('testsuite').get('failures'))
+
+
+class MaxErrorsTest(InterpreterTest):
+    existing_files = dict([('a/bad_1.py', 'def f(:\n'), ('c/bad_2.py', 'x = (\n'), ('c/bad_3.py', 'x = )\n')] +
+                          [('b/valid_%d.py' % i, 'x = %d\n' % i) for i in range(50)])
+
+    def invalid(self, result):
+        return sorted(os.path.relpath(x, self.temp_dir) for x, y in result.items() if not y[0])
+
+    def test(self):
+        bad_1 = os.path.join('a', 'bad_1.py')
+        bad_2 = os.path.join('c', 'bad_2.py')
+        for jobs in (1, 2):
+            # Files are compiled in walk order, as soon as they are found
+            result = check_python_syntax.check_python_syntax([self.temp_dir], jobs=jobs, max_errors=1)
+            self.assertEqual([bad_1], self.invalid(result))
+            result = check_python_syntax.check_python_syntax([self.temp_dir], jobs=jobs, max_errors=2)
+            self.assertEqual([bad_1, bad_2], self.invalid(result))
+            self.assertEqual(52, len(result))
+        self.assertEqual(3, len(self.invalid(check_python_syntax.check_python_syntax([self.temp_dir], max_errors=10))))
+        # Not found targets come first
+        self.assertEqual({'no_such_file.py': [False, 'Target not found']},
+                         check_python_syntax.check_python_syntax(['no_such_file.py', self.temp_dir], max_errors=1))
+        this_version = '%d.%d' % sys.version_info[:2]
+        result = check_python_syntax.check_all_python_versions(['no_such_file.py', self.temp_dir], this_version,
+                                                               max_errors=1)
+        self.assertEqual({this_version: {'no_such_file.py': [False, 'Target not found']}}, result)
+        result = check_python_syntax.check_all_python_versions(['no_1.py', 'no_2.py', self.temp_dir], this_version,
+                                                               max_errors=1)
+        self.assertEqual({this_version: {'no_1.py': [False, 'Target not found']}}, result)
+        result = check_python_syntax.check_all_python_versions(['no_such_file.py', self.temp_dir], this_version,
+                                                               max_errors=2)
+        self.assertEqual(sorted([os.path.relpath('no_such_file.py', self.temp_dir), bad_1]),
+                         self.invalid(result[this_version]))
+        # Another interpreter stops itself
+        result = check_python_syntax._check_in_child(sys.executable, [self.temp_dir], max_errors=1)
+        self.assertEqual([bad_1], self.invalid(result))
+        items = list(check_python_syntax.iter_check_python_syntax([self.temp_dir], max_errors=1, errors_only=True))
+        self.assertEqual([os.path.join(self.temp_dir, bad_1), '<summary>'], [x[0] for x in items])
+        sources = [('x.py', b'x = (\n'), ('y.py', b'x = 1\n'), ('z.py', b'x = )\n')]
+        self.assertEqual(['x.py'], sorted(check_python_syntax.check_python_sources(sources, max_errors=1)))
+        # Command line
+        process = subprocess.Popen([sys.executable, check_python_syntax._script_file(), '--fail-fast', '--no-cache',
+                                    self.temp_dir], stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        self.assertEqual(1, process.returncode)
+        self.assertEqual([bad_1], self.invalid(json.loads(output.decode())))
+
+    def test_cancel(self):
+        closed = []
+
+        def items():
+            try:
+                for i in range(100):
+                    yield 'file_%d.py' % i, [i % 3 != 0, 'message']
+            finally:
+                closed.append(True)
+
+        limited = check_python_syntax._limit_errors(items(), 2)
+        self.assertEqual(['file_0.py', 'file_1.py', 'file_2.py', 'file_3.py'], [x[0] for x in limited])
+        self.assertEqual([True], closed)
+
+    def test_pool_window(self):
+        file_names = sorted(os.path.join(self.temp_dir, x) for x in self.existing_files)
+        consumed = []
+
+        def chunk_arguments():
+            for file_name in file_names:
+                consumed.append(file_name)
+                yield [file_name], 'memory', None, False, None, None
+
+        items = check_python_syntax._iter_chunks_in_pool(check_python_syntax._compile_files_chunk, chunk_arguments(),
+                                                         jobs=2)
+        self.assertEqual(file_names[0], next(items)[0])
+        items.close()
+        # Chunks are submitted only a few at a time ahead of results
+        self.assertTrue(len(consumed) <= check_python_syntax.CHUNKS_AHEAD * 2 + 1, len(consumed))
+        items = check_python_syntax._iter_chunks_in_pool(check_python_syntax._compile_files_chunk, chunk_arguments(),
+                                                         jobs=2)
+        self.assertEqual(file_names, [x[0] for x in items])
+
+
+class LevelsTest(InterpreterTest):
+    existing_files = {
+        'valid.py': 'x = 1\n',
+        'parse_error.py': 'x = = 1\n',
+        'compile_error.py': 'return 1\n',
+        'walrus.py': 'if (x := 1):\n    pass\n' if sys.version_info[:2] >= (3, 8) else 'x = 1\n',
+        'indented.py': '# comment\nif x:  # comment\n\n    y = (1,\n            2)\n',
+    }
+
+    def invalid(self, result):
+        return sorted(os.path.basename(x) for x, y in result.items() if not y[0])
+
+    def test(self):
+        cache_dir = os.path.join(self.temp_dir, 'cache')
+        for kwargs in ({}, {'jobs': 2}, {'cache_dir': cache_dir}, {'cache_dir': cache_dir}):
+            self.assertEqual([], self.invalid(check_python_syntax.check_python_syntax(
+                [self.temp_dir], level='tokenize', **kwargs)))
+            self.assertEqual(['parse_error.py'], self.invalid(check_python_syntax.check_python_syntax(
+                [self.temp_dir], level='parse', **kwargs)))
+            for level in ('compile', 'emulate'):
+                self.assertEqual(['compile_error.py', 'parse_error.py'], self.invalid(
+                    check_python_syntax.check_python_syntax([self.temp_dir], level=level, **kwargs)))
+        # Level is applied by another interpreter as well
+        self.assertEqual(['parse_error.py'], self.invalid(
+            check_python_syntax._check_in_child(sys.executable, [self.temp_dir], engine='parse')))
+        sources = [('x.py', b'x = = 1\n'), ('y.py', b'return 1\n')]
+        self.assertEqual([True, True], [x[0] for x in check_python_syntax.check_python_sources(
+            sources, level='tokenize').values()])
+        sources = [('x.py', b'x = 1\n\tif y:\n\t\tpass\n'), ('y.py', b"x = 'abc\n"),
+                   ('z.py', b'if x:\n    if y:\n\tz = 1\n'), ('w.py', b'if x:\n\tif y:\n\t\tz = (1,\n  2)\n\tw = 1\n')]
+        result = check_python_syntax.check_python_sources(sources, level='tokenize')
+        self.assertEqual([True, 'OK'], result['w.py'])
+        if sys.version_info[0] >= 3:
+            # Same error as compiler reports
+            self.assertEqual(check_python_syntax.check_python_sources(sources[2:3])['z.py'][:2], result['z.py'][:2])
+        self.assertEqual('IndentationError: unexpected indent', result['x.py'][1].splitlines()[-1])
+        self.assertEqual('SyntaxError: unterminated string literal (detected at line 1)',
+                         result['y.py'][1].splitlines()[-1])
+        result = check_python_syntax.check_python_syntax([self.temp_dir], level='fast')
+        self.assertTrue('Unknown level' in result['<exception>'][1])
+
+    def test_emulated_version(self):
+        if sys.version_info[:2] < (3, 8):
+            self.skipTest('Parser of this interpreter has no feature_version')
+        find_python_executable = check_python_syntax.find_python_executable
+
+        def no_interpreters(*args, **kwargs):
+            raise AssertionError('Another interpreter is not needed')
+
+        check_python_syntax.find_python_executable = no_interpreters
+        try:
+            for jobs in (1, 2):
+                self.assertEqual(['compile_error.py', 'parse_error.py', 'walrus.py'], self.invalid(
+                    check_python_syntax.check_python_syntax([self.temp_dir], python_version='3.7', level='emulate', jobs=jobs)))
+            result = check_python_syntax.check_all_python_versions([self.temp_dir], '3.7', level='emulate')
+            self.assertEqual(['compile_error.py', 'parse_error.py', 'walrus.py'], self.invalid(result['3.7']))
+            result = check_python_syntax.check_python_sources([('x.py', b'print(x := 1)\n')], python_version='3.7',
+                                                              level='emulate')
+            self.assertFalse(result['x.py'][0])
+        finally:
+            check_python_syntax.find_python_executable = find_python_executable
+        # Emulation is used only if it is requested and possible
+        self.assertEqual(('memory', None), check_python_syntax._select_engine('compile', 'memory', '3.7'))
+        self.assertEqual(('parse', None), check_python_syntax._select_engine('parse', 'memory', '3.7'))
+        self.assertEqual(('memory', 7), check_python_syntax._select_engine('emulate', 'memory', '3.7'))
+        self.assertEqual(('memory', None), check_python_syntax._select_engine('emulate', 'memory', '2.7'))
+
+
+class DaemonTest(InterpreterTest):
+    existing_files = STANDARD_SET
+
+    def setUp(self):
+        InterpreterTest.setUp(self)
+        try:
+            import asyncio
+        except ImportError:
+            self.skipTest('asyncio is not available')
+        if not hasattr(socket, 'AF_UNIX'):
+            self.skipTest('Unix sockets are not available')
+        self.socket_path = os.path.join(self.temp_dir, 'daemon.sock')
+        self.thread = threading.Thread(target=check_python_syntax.serve_daemon, args=(self.socket_path,))
+        self.thread.start()
+        for i in range(100):
+            if check_python_syntax._daemon_request(self.socket_path, {'status': True}) is not None:
+                break
+            time.sleep(0.05)
+
+    def tearDown(self):
+        check_python_syntax._daemon_request(self.socket_path, {'shutdown': True})
+        self.thread.join()
+
+    def test(self):
+        status = check_python_syntax._daemon_request(self.socket_path, {'status': True})
+        self.assertEqual(os.getpid(), status['pid'])
+        self.assertRaises(RuntimeError, check_python_syntax.serve_daemon, self.socket_path)
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        try:
+            # Paths are relative to client's directory
+            expected_result = check_python_syntax.check_python_syntax(['.', 'no_such_file.py'], details=True)
+            self.assertEqual(expected_result, check_python_syntax.check_python_syntax_via_daemon(
+                ['.', 'no_such_file.py'], socket_path=self.socket_path, details=True))
+        finally:
+            os.chdir(cwd)
+        # Concurrent requests, from different directories
+        expected_result = check_python_syntax.check_python_syntax([self.temp_dir], errors_only=True)
+        expected_results = {'.': self.expected_relative_result(), self.temp_dir: expected_result}
+        results = []
+
+        def check(cwd, target):
+            results.append((target, check_python_syntax._daemon_request(self.socket_path, {
+                'cwd': cwd, 'files': [target], 'errors_only': True})))
+
+        threads = [threading.Thread(target=check, args=(self.temp_dir, '.')) for i in range(3)]
+        threads += [threading.Thread(target=check, args=(cwd, self.temp_dir)) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(6, len(results))
+        for target, result in results:
+            self.assertEqual(expected_results[target], result)
+        os.chdir(cwd)
+        self.assertRaises(TypeError, check_python_syntax.check_python_syntax_via_daemon, [self.temp_dir],
+                          socket_path=self.socket_path, persistent_worker=True)
+        # Command line client
+        process = subprocess.Popen([sys.executable, check_python_syntax._script_file(), '--client', '--socket',
+                                    self.socket_path, '--no-cache', self.temp_dir], stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        self.assertEqual(1, process.returncode)
+        self.assertEqual(check_python_syntax.check_python_syntax([self.temp_dir]), json.loads(output.decode()))
+
+    def expected_relative_result(self):
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        try:
+            return check_python_syntax.check_python_syntax(['.'], errors_only=True)
+        finally:
+            os.chdir(cwd)
+
+    def test_fallback(self):
+        socket_path = os.path.join(self.temp_dir, 'no_daemon.sock')
+        self.assertEqual(check_python_syntax.check_python_syntax([self.temp_dir]),
+                         check_python_syntax.check_python_syntax_via_daemon([self.temp_dir], socket_path=socket_path))
+
+    def test_version(self):
+        request = {'files': [self.temp_dir]}
+        self.assertTrue(check_python_syntax._daemon_request(self.socket_path, request, check_version=True))
+        daemon_status = check_python_syntax._daemon_status
+        check_python_syntax._daemon_status = lambda: dict(daemon_status(), version='0')
+        try:
+            self.assertEqual(None, check_python_syntax._daemon_request(self.socket_path, request, check_version=True))
+        finally:
+            check_python_syntax._daemon_status = daemon_status
+
+    def test_silent_daemon(self):
+        socket_path = os.path.join(self.temp_dir, 'silent.sock')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(socket_path)
+            server.listen(1)
+            start_time = time.time()
+            self.assertEqual(check_python_syntax.check_python_syntax([self.temp_dir]),
+                             check_python_syntax.check_python_syntax_via_daemon([self.temp_dir],
+                                                                                socket_path=socket_path))
+            self.assertTrue(time.time() - start_time < check_python_syntax.DAEMON_TIMEOUT)
+            self.assertEqual(None, check_python_syntax._daemon_request(socket_path, {'status': True}, 0.1))
+        finally:
+            server.close()
+
+    def test_stuck_daemon(self):
+        socket_path = os.path.join(self.temp_dir, 'stuck.sock')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connections = []
+
+        def answer_status_only():
+            connection = server.accept()[0]
+            connections.append(connection)
+            connection.recv(65536)
+            connection.sendall(json.dumps(check_python_syntax._daemon_status()).encode('utf-8') + b'\n')
+
+        daemon_timeout = check_python_syntax.DAEMON_TIMEOUT
+        check_python_syntax.DAEMON_TIMEOUT = 0.5
+        try:
+            server.bind(socket_path)
+            server.listen(1)
+            thread = threading.Thread(target=answer_status_only)
+            thread.start()
+            # Daemon accepted request, so files are not checked again in current process
+            result = check_python_syntax.check_python_syntax_via_daemon([self.temp_dir], socket_path=socket_path)
+            thread.join()
+            self.assertEqual(['<exception>'], list(result))
+            self.assertTrue('timed out' in result['<exception>'][1], result)
+        finally:
+            check_python_syntax.DAEMON_TIMEOUT = daemon_timeout
+            for connection in connections:
+                connection.close()
+            server.close()
+
+    def test_not_socket(self):
+        file_name = os.path.join(self.temp_dir, 'regular_file')
+        with open(file_name, 'w'):
+            pass
+        self.assertRaises(RuntimeError, check_python_syntax.serve_daemon, file_name)
+        self.assertTrue(os.path.isfile(file_name))
+
+
+class StartupTest(InterpreterTest):
+    existing_files = {'valid.py': 'x = 1\n'}
+
+    def imported_modules(self, arguments, input_data=None):
+        """Run main() in new interpreter, return modules (of those which should be imported lazily) it imported.
+
+        Modules imported by interpreter itself at startup are not counted.
+        """
+        code = ('import sys; initial_modules = set(sys.modules)\n'
+                'sys.path.insert(0, sys.argv[1]); import check_python_syntax\n'
+                'try:\n'
+                '    check_python_syntax.main(sys.argv[2:])\n'
+                'finally:\n'
+                '    modules = ["argparse", "heapq", "py_compile", "sqlite3", "subprocess", "tempfile", "threading", "traceback"]\n'
+                '    sys.stderr.write(",".join(x for x in modules if x in sys.modules and x not in initial_modules))\n')
+        process = subprocess.Popen([sys.executable, '-c', code, os.path.dirname(check_python_syntax._script_file())] +
+                                   arguments, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, error_output = process.communicate(input_data)
+        self.assertEqual([True, 'OK'], json.loads(output.decode())[os.path.join(self.temp_dir, 'valid.py')])
+        return [x for x in error_output.decode().split(',') if x]
+
+    def test(self):
+        file_name = os.path.join(self.temp_dir, 'valid.py')
+        modules = self.imported_modules([file_name])
+        self.assertTrue('argparse' in modules)
+        # Some versions of argparse import tempfile themselves, result cache is not opened for a single file
+        self.assertEqual([], [x for x in modules if x in ('heapq', 'py_compile', 'sqlite3', 'subprocess', 'threading',
+                                                                'traceback')])
+        # Child interpreter doesn't parse options
+        request = {'files': [file_name], 'engine': 'memory', 'jobs': 1, 'details': True}
+        self.assertEqual([], self.imported_modules(['--worker'], json.dumps(request).encode('utf-8') + b'\n'))
+
+
 if __name__ == '__main__':
     unittest.main()